@@ -0,0 +1,115 @@
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.dispatch import receiver
+
+from GestioneSensori.models import AggregatoRilevazioni, Rilevazione
+from GestioneSensori.parser_stringhe import da_epoch
+from GestioneSensori.signals import rilevazioni_salvate
+
+COLONNE = ('sensore', 'scala', 'inizio', 'conteggio', 'minimo', 'massimo', 'somma', 'ultimo_valore', 'ultima_dataora')
+
+# Conteggio, minimo, massimo e somma sono commutativi; l'ultimo valore segue la dataora più recente,
+# quindi le letture in ritardo o fuori ordine non cambiano il risultato. ultimo_valore va aggiornato
+# prima di ultima_dataora perché MySQL valuta le assegnazioni da sinistra a destra.
+UPSERT = {
+    'mysql': (
+        'ON DUPLICATE KEY UPDATE '
+        '`ultimo_valore` = IF(VALUES(`ultima_dataora`) >= `ultima_dataora`, VALUES(`ultimo_valore`), `ultimo_valore`), '
+        '`ultima_dataora` = GREATEST(`ultima_dataora`, VALUES(`ultima_dataora`)), '
+        '`conteggio` = `conteggio` + VALUES(`conteggio`), '
+        '`minimo` = LEAST(`minimo`, VALUES(`minimo`)), '
+        '`massimo` = GREATEST(`massimo`, VALUES(`massimo`)), '
+        '`somma` = `somma` + VALUES(`somma`);'
+    ),
+    'sqlite': (
+        'ON CONFLICT (`sensore`, `scala`, `inizio`) DO UPDATE SET '
+        '`ultimo_valore` = CASE WHEN excluded.`ultima_dataora` >= `ultima_dataora` '
+        'THEN excluded.`ultimo_valore` ELSE `ultimo_valore` END, '
+        '`ultima_dataora` = MAX(`ultima_dataora`, excluded.`ultima_dataora`), '
+        '`conteggio` = `conteggio` + excluded.`conteggio`, '
+        '`minimo` = MIN(`minimo`, excluded.`minimo`), '
+        '`massimo` = MAX(`massimo`, excluded.`massimo`), '
+        '`somma` = `somma` + excluded.`somma`;'
+    ),
+}
+DIM_LOTTO_UPSERT = 500
+
+
+def calcola_aggregati(letture):
+    """Raggruppa le letture (id_sensore, dataora, valore) in bucket per tutte le scale."""
+    aggregati = {}
+    for id_sensore, dataora, valore in letture:
+        epoch = int(dataora.timestamp())
+        for scala in AggregatoRilevazioni.SCALE:
+            chiave = (id_sensore, scala, epoch // scala * scala)
+            agg = aggregati.get(chiave)
+            if agg is None:
+                aggregati[chiave] = [1, valore, valore, valore, valore, dataora]
+                continue
+            agg[0] += 1
+            agg[1] = min(agg[1], valore)
+            agg[2] = max(agg[2], valore)
+            agg[3] += valore
+            if dataora >= agg[5]:
+                agg[4] = valore
+                agg[5] = dataora
+    return aggregati
+
+
+def righe_aggregati(aggregati):
+    # Ordinate per chiave, così scritture concorrenti bloccano le righe nello stesso ordine
+    adatta = connection.ops.adapt_datetimefield_value
+    return [
+        (id_sensore, scala, adatta(da_epoch(inizio)),
+         agg[0], agg[1], agg[2], agg[3], agg[4], adatta(agg[5]))
+        for (id_sensore, scala, inizio), agg in sorted(aggregati.items())
+    ]
+
+
+def aggiorna_aggregati(letture):
+    righe = righe_aggregati(calcola_aggregati(letture))
+    if not righe:
+        return
+    intestazione = 'INSERT INTO `%s` (%s) VALUES ' % (
+        AggregatoRilevazioni._meta.db_table, ', '.join('`%s`' % colonna for colonna in COLONNE)
+    )
+    segnaposto = '(%s)' % ', '.join(['%s'] * len(COLONNE))
+    with connection.cursor() as cursor:
+        for inizio in range(0, len(righe), DIM_LOTTO_UPSERT):
+            lotto = righe[inizio:inizio + DIM_LOTTO_UPSERT]
+            cursor.execute(
+                intestazione + ', '.join([segnaposto] * len(lotto)) + ' ' + UPSERT[connection.vendor],
+                [valore for riga in lotto for valore in riga]
+            )
+
+
+@receiver(rilevazioni_salvate)
+def aggiorna_aggregati_ingest(sender, rilevazioni=(), **kwargs):
+    aggiorna_aggregati([(ril.sensore_id, ril.dataora, ril.valore) for ril in rilevazioni])
+
+
+def ricostruisci_aggregati(id_sensore, dal=None, al=None, dim_blocco=10000):
+    """
+    Ricalcola dai dati grezzi gli aggregati di un sensore. L'intervallo viene esteso ai giorni interi
+    così che tutti i bucket di tutte le scale vengano ricalcolati per intero.
+    """
+    rilevazioni = Rilevazione.objects.filter(sensore=id_sensore)
+    aggregati = AggregatoRilevazioni.objects.filter(sensore=id_sensore)
+    if dal is not None:
+        dal = AggregatoRilevazioni.inizio_bucket(dal, AggregatoRilevazioni.SCALA_GIORNO)
+        rilevazioni = rilevazioni.filter(dataora__gte=dal)
+        aggregati = aggregati.filter(inizio__gte=dal)
+    if al is not None:
+        al = AggregatoRilevazioni.inizio_bucket(al, AggregatoRilevazioni.SCALA_GIORNO) + timedelta(days=1)
+        rilevazioni = rilevazioni.filter(dataora__lt=al)
+        aggregati = aggregati.filter(inizio__lt=al)
+    with transaction.atomic():
+        aggregati.delete()
+        letture = []
+        for lettura in rilevazioni.values_list('sensore', 'dataora', 'valore').iterator():
+            letture.append(lettura)
+            if len(letture) >= dim_blocco:
+                aggiorna_aggregati(letture)
+                letture = []
+        aggiorna_aggregati(letture)
@@ -0,0 +1,266 @@
+import logging
+from copy import copy
+from math import sqrt
+from operator import itemgetter
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from GestioneSensori.models import RegolaAllarme, StatoRegola, Allarme, cache_sensori
+from GestioneSensori.signals import rilevazioni_salvate
+
+logger = logging.getLogger(__name__)
+
+COLONNE = ('regola', 'sensore', 'valore', 'media', 'varianza', 'conteggio', 'in_allarme', 'dataora')
+
+# Più processi possono salvare lo stato della stessa coppia (regola, sensore): vince quello con la dataora più
+# recente. dataora è l'ultima colonna perché MySQL valuta le assegnazioni da sinistra a destra.
+UPSERT = {
+    'mysql': 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+        '`{0}` = IF(`dataora` IS NULL OR VALUES(`dataora`) > `dataora`, VALUES(`{0}`), `{0}`)'.format(colonna)
+        for colonna in COLONNE[2:]
+    ) + ';',
+    'sqlite': 'ON CONFLICT (`regola`, `sensore`) DO UPDATE SET ' + ', '.join(
+        '`{0}` = CASE WHEN `dataora` IS NULL OR excluded.`dataora` > `dataora` '
+        'THEN excluded.`{0}` ELSE `{0}` END'.format(colonna)
+        for colonna in COLONNE[2:]
+    ) + ';',
+}
+DIM_LOTTO_UPSERT = 500
+
+
+class Stato:
+    # Stato di una regola per un sensore: dimensione costante, qualunque sia la storia del sensore
+    __slots__ = ('dataora', 'valore', 'media', 'varianza', 'conteggio', 'in_allarme')
+
+    def __init__(self, dataora=None, valore=None, media=0.0, varianza=0.0, conteggio=0, in_allarme=False):
+        self.dataora = dataora
+        self.valore = valore
+        self.media = media
+        self.varianza = varianza
+        self.conteggio = conteggio
+        self.in_allarme = in_allarme
+
+
+def fuori_soglia(regola, valore):
+    if regola.minimo is not None and valore < regola.minimo:
+        return 'valore %s sotto il minimo %s' % (valore, regola.minimo)
+    if regola.massimo is not None and valore > regola.massimo:
+        return 'valore %s sopra il massimo %s' % (valore, regola.massimo)
+    return None
+
+
+def valuta_regola(regola, stato, dataora, valore):
+    """
+    Valuta una rilevazione più recente di stato.dataora (secondi epoch) e aggiorna lo stato. Restituisce
+    la descrizione dell'allarme solo quando la regola entra in allarme: finché resta in allarme non se ne
+    generano altri.
+    """
+    descrizione = None
+    if regola.genere == RegolaAllarme.SOGLIA:
+        descrizione = fuori_soglia(regola, valore)
+    elif regola.genere == RegolaAllarme.VARIAZIONE:
+        if stato.dataora is not None and regola.variazione_max is not None:
+            variazione = (valore - stato.valore) / (dataora - stato.dataora)
+            if abs(variazione) > regola.variazione_max:
+                descrizione = 'variazione di %.3g al secondo oltre %.3g' % (variazione, regola.variazione_max)
+    elif regola.genere == RegolaAllarme.ZSCORE:
+        if stato.conteggio >= regola.finestra and stato.varianza > 0:
+            z = (valore - stato.media) / sqrt(stato.varianza)
+            if abs(z) > regola.soglia_z:
+                descrizione = 'z-score %.2f oltre %.2f (media %.3g)' % (z, regola.soglia_z, stato.media)
+        # Media e varianza mobili esponenziali, con un peso pari a circa finestra rilevazioni
+        if stato.conteggio == 0:
+            stato.media, stato.varianza = float(valore), 0.0
+        else:
+            scarto = valore - stato.media
+            incremento = 2 / (regola.finestra + 1) * scarto
+            stato.media += incremento
+            stato.varianza = (1 - 2 / (regola.finestra + 1)) * (stato.varianza + scarto * incremento)
+        stato.conteggio = min(stato.conteggio + 1, regola.finestra)
+    stato.dataora, stato.valore = dataora, valore
+    entra = descrizione is not None and not stato.in_allarme
+    stato.in_allarme = descrizione is not None
+    return descrizione if entra else None
+
+
+class MotoreAllarmi:
+    """
+    Valuta le regole di allarme sulle rilevazioni appena salvate, senza rileggere la storia: ogni coppia
+    (regola, sensore) ha uno Stato in memoria, caricato dal checkpoint (StatoRegola) la prima volta che il
+    sensore viene visto e salvato al più ogni intervallo_checkpoint secondi. Se più processi valutano lo
+    stesso sensore il checkpoint tiene lo stato più recente e i sensori salvati vengono ricaricati, ma tra
+    due checkpoint ogni processo vede solo le proprie rilevazioni: meglio scriverle da un solo processo
+    (es. la coda di ingest).
+    """
+
+    def __init__(self, carica_regole, carica_stati, ttl, intervallo_checkpoint=None):
+        self.carica_regole = carica_regole
+        self.carica_stati = carica_stati
+        self.ttl = ttl
+        self.intervallo_checkpoint = intervallo_checkpoint
+        self.lock = Lock()
+        self.regole = None
+        self.scadenza = 0
+        self.stati = {}
+        self.caricati = set()
+        self.modificati = set()
+        self.ultimo_checkpoint = monotonic()
+
+    def _regole(self):
+        adesso = monotonic()
+        with self.lock:
+            if self.regole is not None and self.scadenza > adesso:
+                return self.regole
+        per_sensore, per_tipo = {}, {}
+        for regola in self.carica_regole():
+            if regola.sensore_id is not None:
+                per_sensore.setdefault(regola.sensore_id, []).append(regola)
+            elif regola.tipo_id is not None:
+                per_tipo.setdefault(regola.tipo_id, []).append(regola)
+        with self.lock:
+            self.regole = (per_sensore, per_tipo)
+            self.scadenza = adesso + self.ttl
+        return self.regole
+
+    def ha_regole(self):
+        per_sensore, per_tipo = self._regole()
+        return bool(per_sensore or per_tipo)
+
+    def svuota_regole(self):
+        with self.lock:
+            self.regole = None
+
+    def valuta(self, letture):
+        """
+        Valuta letture (id_sensore, id_tipo, dataora, valore) in ordine di dataora. Restituisce gli allarmi
+        (regola, id_sensore, dataora, valore, descrizione) e i nuovi stati, da rendere effettivi con applica()
+        quando le rilevazioni sono state salvate. Le rilevazioni arrivate in ritardo (non più recenti
+        dell'ultima valutata) vengono solo confrontate con le soglie e non cambiano lo stato.
+        """
+        per_sensore, per_tipo = self._regole()
+        regole = {}
+        for id_sensore, id_tipo, _, _ in letture:
+            if id_sensore not in regole:
+                regole[id_sensore] = per_sensore.get(id_sensore, []) + per_tipo.get(id_tipo, [])
+        sensori = {id_sensore for id_sensore, regole_sensore in regole.items() if regole_sensore}
+        with self.lock:
+            da_caricare = sensori - self.caricati
+        if da_caricare:
+            caricati = self.carica_stati(da_caricare)
+            with self.lock:
+                for chiave, stato in caricati.items():
+                    self.stati.setdefault(chiave, stato)
+                self.caricati |= da_caricare
+        allarmi = []
+        nuovi = {}
+        for id_sensore, _, dataora, valore in sorted(letture, key=itemgetter(2)):
+            secondi = dataora.timestamp()
+            for regola in regole[id_sensore]:
+                chiave = (regola.id, id_sensore)
+                stato = nuovi.get(chiave)
+                if stato is None:
+                    with self.lock:
+                        stato = copy(self.stati.get(chiave)) or Stato()
+                    nuovi[chiave] = stato
+                if stato.dataora is not None and secondi <= stato.dataora:
+                    descrizione = fuori_soglia(regola, valore) if regola.genere == RegolaAllarme.SOGLIA else None
+                else:
+                    descrizione = valuta_regola(regola, stato, secondi, valore)
+                if descrizione is not None:
+                    allarmi.append((regola, id_sensore, dataora, valore, descrizione))
+        return allarmi, nuovi
+
+    def applica(self, nuovi):
+        with self.lock:
+            self.stati.update(nuovi)
+            self.modificati |= {id_sensore for _, id_sensore in nuovi}
+            scaduto = self.intervallo_checkpoint is not None and \
+                monotonic() - self.ultimo_checkpoint >= self.intervallo_checkpoint
+        if scaduto:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Salva gli stati dei sensori modificati dall'ultimo checkpoint."""
+        per_sensore, per_tipo = self._regole()
+        regole = {regola.id for gruppo in list(per_sensore.values()) + list(per_tipo.values()) for regola in gruppo}
+        with self.lock:
+            sensori, self.modificati = self.modificati, set()
+            stati = {chiave: copy(stato) for chiave, stato in self.stati.items() if chiave[1] in sensori}
+            self.ultimo_checkpoint = monotonic()
+        if not sensori:
+            return
+        righe = [
+            (id_regola, id_sensore, stato.valore, stato.media, stato.varianza, stato.conteggio, stato.in_allarme,
+             stato.dataora)
+            for (id_regola, id_sensore), stato in sorted(stati.items()) if id_regola in regole
+        ]
+        try:
+            salva_stati(righe)
+        except DatabaseError:
+            logger.exception('Checkpoint degli stati delle regole di allarme fallito')
+            with self.lock:
+                self.modificati |= sensori
+            return
+        with self.lock:
+            # Alla prossima valutazione si riparte dal checkpoint, che può contenere stati di altri processi
+            salvati = sensori - self.modificati
+            self.stati = {chiave: stato for chiave, stato in self.stati.items() if chiave[1] not in salvati}
+            self.caricati -= salvati
+
+
+def salva_stati(righe):
+    """Scrive le righe (regola, sensore, valore, media, varianza, conteggio, in_allarme, dataora) in StatoRegola."""
+    intestazione = 'INSERT INTO `%s` (%s) VALUES ' % (
+        StatoRegola._meta.db_table, ', '.join('`%s`' % colonna for colonna in COLONNE)
+    )
+    segnaposto = '(%s)' % ', '.join(['%s'] * len(COLONNE))
+    with transaction.atomic(), connection.cursor() as cursor:
+        for inizio in range(0, len(righe), DIM_LOTTO_UPSERT):
+            lotto = righe[inizio:inizio + DIM_LOTTO_UPSERT]
+            cursor.execute(
+                intestazione + ', '.join([segnaposto] * len(lotto)) + ' ' + UPSERT[connection.vendor],
+                [valore for riga in lotto for valore in riga]
+            )
+
+
+def carica_regole():
+    return list(RegolaAllarme.objects.filter(attiva=True))
+
+
+def carica_stati(sensori):
+    return {
+        (stato.regola_id, stato.sensore_id): Stato(stato.dataora, stato.valore, stato.media, stato.varianza,
+                                                   stato.conteggio, stato.in_allarme)
+        for stato in StatoRegola.objects.filter(sensore__in=sensori)
+    }
+
+
+motore_allarmi = MotoreAllarmi(carica_regole, carica_stati, settings.ALLARMI_REGOLE_TTL,
+                               settings.ALLARMI_CHECKPOINT_SECONDI)
+
+
+@receiver(rilevazioni_salvate)
+def valuta_allarmi_ingest(sender, rilevazioni=(), **kwargs):
+    if not rilevazioni or not motore_allarmi.ha_regole():
+        return
+    sensori = cache_sensori.get_many({ril.sensore_id for ril in rilevazioni})
+    allarmi, nuovi = motore_allarmi.valuta([
+        (ril.sensore_id, sensori[ril.sensore_id]['tipo_id'], ril.dataora, ril.valore)
+        for ril in rilevazioni if ril.sensore_id in sensori
+    ])
+    Allarme.objects.bulk_create([
+        Allarme(regola=regola, sensore_id=id_sensore, dataora=dataora, valore=valore, descrizione=descrizione[:255])
+        for regola, id_sensore, dataora, valore, descrizione in allarmi
+    ])
+    # Lo stato avanza solo se le rilevazioni vengono davvero salvate
+    transaction.on_commit(lambda: motore_allarmi.applica(nuovi))
+
+
+@receiver([post_save, post_delete], sender=RegolaAllarme)
+def svuota_regole_allarmi(sender, **kwargs):
+    motore_allarmi.svuota_regole()
@@ -1,12 +1,45 @@
+from datetime import datetime, time, timedelta
+from functools import partial
+from hashlib import md5
+from itertools import groupby
+from operator import itemgetter
+from math import ceil
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+from django.utils.http import http_date, quote_etag
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication, TokenAuthentication
-from rest_framework.decorators import api_view, parser_classes, authentication_classes, permission_classes
+from rest_framework.decorators import api_view, parser_classes, authentication_classes, permission_classes, \
+    renderer_classes
 from rest_framework.parsers import JSONParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from rest_framework.response import Response
 
-from GestioneSensori.models import Sensore, Rilevazione, TipoSensore, MarcaSensore
-from GestioneSensori.serializers import SensoreSerializer, RilevazioneSerializer, StringaSerializer
+from GestioneSensori.archivio import leggi_serie, leggi_serie_sensori, colonne_righe
+from GestioneSensori.campionamento import parse_intervallo, aggrega_bucket, combina_bucket, lttb
+from GestioneSensori.coda_ingest import coda_ingest
+from GestioneSensori.ingest import salva_stringhe, righe_da_stream, salva_righe
+from GestioneSensori.colonnare import CONTENT_TYPE as CONTENT_TYPE_COLONNARE, CodificatoreColonnare, SerieColonnare
+from GestioneSensori.duplicati import finestra_duplicati
+from GestioneSensori.esportazione import csv_rilevazioni, colonnare_rilevazioni, comprimi_gzip
+from GestioneSensori.paginazione import CursoreNonValido, codifica_cursore, decodifica_cursore, pagina_keyset, \
+    pagine_keyset, json_in_streaming
+from GestioneSensori.models import Impianto, Sensore, Rilevazione, UltimaRilevazione, AggregatoRilevazioni, \
+    StringaDuplicata, VersioneCatalogo, cache_sensori
+from GestioneSensori.rappresentazioni import query_sensori, sensori_json, sensore_json, ultima_rilevazione_sensore, \
+    rilevazioni_json, rilevazione_json, dataora_json
+from GestioneSensori.parser_stringhe import LEN_DATETIME, scomponi, decodifica_dataora, da_epoch
+from GestioneSensori.renderers import ColonnareRenderer
+from GestioneSensori.serializers import StringaSerializer
+from GestioneSensori.statistiche import statistiche_sensori
+from GestioneSensori.ultimo_contatto import sensori_silenziosi
 
 
 @api_view(['GET'])
@@ -14,87 +47,465 @@ from GestioneSensori.serializers import SensoreSerializer, RilevazioneSerializer
 @permission_classes((IsAuthenticated,))
 def sensori_api(request):
     if request.method == 'GET':
-        context = {'request': request}
-        if request.user.is_staff:
-            query = Sensore.objects.all()
-        else:
-            query = Sensore.objects.filter(impianto__user=request.user)
-        serializer = SensoreSerializer(query, many=True, context=context)
+        query = query_sensori(request.user)
+        if con_ultima_rilevazione(request):
+            return lista_api(request, query, ('id',), partial(sensori_json, ultima_rilevazione=True))
+        return risposta_catalogo(request, lambda: lista_api(request, query, ('id',), sensori_json))
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def sensori_silenziosi_api(request):
+    if request.method == 'GET':
+        ore = request.GET.get('ore', '24')
+        if not ore.isdigit() or int(ore) < 1:
+            return Response({'error': 'ore non valido: %s' % ore}, status=status.HTTP_400_BAD_REQUEST)
+        impianti = None if request.user.is_staff else Impianto.objects.filter(user=request.user).values('id')
         return Response([
             {
-                'id_sensore': data['id'],
-                'tipo': TipoSensore.objects.get(id=data['tipo']).tipo,
-                'marca': MarcaSensore.objects.get(id=data['marca']).marca,
-                'codice_errore': data['codice_errore']
+                'impianto': data['impianto'],
+                'nome_impianto': data['impianto__name'],
+                'id_sensore': data['sensore'],
+                'ultimo_contatto': dataora_json(data['ultimo_contatto']) if data['ultimo_contatto'] else None,
             }
-            for data in serializer.data
+            for data in sensori_silenziosi(int(ore), impianti)
         ])
 
 
+def con_ultima_rilevazione(request):
+    # L'ultima rilevazione cambia ad ogni ingest: chi la chiede rinuncia alle risposte condizionali
+    return request.GET.get('ultima_rilevazione') in ('1', 'true')
+
+
+def risposta_catalogo(request, crea):
+    """
+    Risposta condizionale per le API del catalogo dei sensori. ETag e Last-Modified vengono dalla
+    VersioneCatalogo, quindi If-None-Match e If-Modified-Since ricevono un 304 senza leggere le tabelle
+    dei sensori; altrimenti il corpo viene dalla cache di Django per utente e versione, o da crea().
+    """
+    versione, modificato = VersioneCatalogo.corrente()
+    etag = quote_etag('%d-%d-%d' % (versione, request.user.id, request.user.is_staff))
+    ultima_modifica = int(modificato.timestamp()) if modificato is not None else None
+    risposta = get_conditional_response(request, etag=etag, last_modified=ultima_modifica)
+    if risposta is None:
+        chiave = 'catalogo:' + md5((etag + request.get_full_path()).encode('utf-8')).hexdigest()
+        dati = cache.get(chiave)
+        if dati is not None:
+            risposta = Response(dati)
+        else:
+            risposta = crea()
+            if isinstance(risposta, Response) and risposta.status_code == status.HTTP_200_OK:
+                cache.set(chiave, risposta.data, settings.CACHE_CATALOGO_TTL)
+    if risposta.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        risposta['ETag'] = etag
+        if ultima_modifica is not None:
+            risposta['Last-Modified'] = http_date(ultima_modifica)
+        patch_cache_control(risposta, private=True, no_cache=True)
+    return risposta
+
+
+def lista_api(request, query, campi, in_json, in_colonne=None):
+    """
+    Risposta delle API a lista: la lista intera, una pagina con page_size e/o cursor (paginazione keyset
+    su campi, che devono identificare la riga) o, con stream=1, tutta la lista scritta a blocchi.
+    in_json converte un blocco di righe di query negli elementi della risposta; in_colonne, se c'è,
+    in un blocco (id_sensore, dataora, valore, messaggio, messaggi) per il formato colonnare.
+    """
+    colonnare = in_colonne is not None and getattr(request.accepted_renderer, 'format', None) == 'colonnare'
+    if request.GET.get('stream') in ('1', 'true'):
+        if colonnare:
+            blocchi = (in_colonne(righe) for righe in pagine_keyset(query, campi, settings.API_STREAM_BLOCCO))
+            return StreamingHttpResponse(stream_colonnare(blocchi), content_type=CONTENT_TYPE_COLONNARE)
+        elementi = (
+            elemento
+            for righe in pagine_keyset(query, campi, settings.API_STREAM_BLOCCO)
+            for elemento in in_json(righe)
+        )
+        return StreamingHttpResponse(json_in_streaming(elementi), content_type='application/json')
+    if 'page_size' not in request.GET and 'cursor' not in request.GET:
+        if colonnare:
+            return Response(SerieColonnare([in_colonne(list(query.order_by(*campi)))]))
+        return Response(in_json(list(query)))
+    dimensione = request.GET.get('page_size', str(settings.API_PAGINA))
+    if not dimensione.isdigit() or not 1 <= int(dimensione) <= settings.API_PAGINA_MAX:
+        return Response({'error': 'page_size deve essere tra 1 e %d' % settings.API_PAGINA_MAX},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        dopo = decodifica_cursore(request.GET['cursor']) if 'cursor' in request.GET else None
+    except CursoreNonValido as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    righe, dopo = pagina_keyset(query, campi, dopo, int(dimensione))
+    if colonnare:
+        # Il corpo binario non ha spazio per il cursore: va in un header
+        risposta = Response(SerieColonnare([in_colonne(righe)]))
+        if dopo is not None:
+            risposta['X-Next-Cursor'] = codifica_cursore(dopo)
+        return risposta
+    return Response({
+        'results': in_json(righe),
+        'next': codifica_cursore(dopo) if dopo is not None else None,
+    })
+
+
+def stream_colonnare(blocchi):
+    codificatore = CodificatoreColonnare()
+    yield codificatore.intestazione()
+    for blocco in blocchi:
+        yield codificatore.blocco(*blocco)
+    yield codificatore.fine()
+
+
 @api_view(['GET'])
 @authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def show_sensore_api(request):
     if request.method == 'GET':
-        id_sensore_get = request.GET.get("id_sensore", None)
-        context = {'request': request}
-        try:
-            sensore = Sensore.objects.get(id=id_sensore_get)
-            serializer = SensoreSerializer(sensore, context=context)
-            data = serializer.data
-            return Response({
-                'id_sensore': data['id'],
-                'tipo': TipoSensore.objects.get(id=data['tipo']).tipo,
-                'marca': MarcaSensore.objects.get(id=data['marca']).marca,
-                'codice_errore': data['codice_errore']
-            })
-        except Sensore.DoesNotExist:
-            return Response({'error': 'id_sensore non presente nel sistema'}, status=status.HTTP_400_BAD_REQUEST)
+        if con_ultima_rilevazione(request):
+            return sensore_api_json(request, ultima_rilevazione=True)
+        return risposta_catalogo(request, lambda: sensore_api_json(request))
+
+
+def sensore_api_json(request, ultima_rilevazione=False):
+    id_sensore_get = request.GET.get("id_sensore", None)
+    sensore = cache_sensori.get(id_sensore_get)
+    if sensore is None:
+        return Response({'error': 'id_sensore non presente nel sistema'}, status=status.HTTP_400_BAD_REQUEST)
+    data = sensore_json(sensore)
+    if ultima_rilevazione:
+        data['ultima_rilevazione'] = ultima_rilevazione_sensore(sensore['id_sensore'])
+    return Response(data)
 
 
 @api_view(['GET'])
 @authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer, ColonnareRenderer))
 def rilevazioni_api(request):
     if request.method == 'GET':
-        context = {'request': request}
         id_sensore_get = request.GET.get("id_sensore", None)
-        try:
-            sensore = Sensore.objects.get(id=id_sensore_get)
-        except Sensore.DoesNotExist:
+        sensore = cache_sensori.get(id_sensore_get)
+        if sensore is None:
             return Response({'error': 'id_sensore non presente nel sistema'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            dal, al, punti, larghezza, metodo = parse_campionamento(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        colonnare = request.accepted_renderer.format == 'colonnare'
+        if punti is not None or larghezza is not None:
+            return Response(serie_campionata(sensore['id_sensore'], dal, al, punti, larghezza, metodo, colonnare))
         rilevazioni = Rilevazione.objects.filter(sensore=id_sensore_get)
-        serializer = RilevazioneSerializer(rilevazioni, many=True, context=context)
+        if dal is not None:
+            rilevazioni = rilevazioni.filter(dataora__gte=dal)
+        if al is not None:
+            rilevazioni = rilevazioni.filter(dataora__lt=al)
+        return lista_api(
+            request, rilevazioni.values('id', 'dataora', 'valore', 'messaggio'), ('dataora', 'id'),
+            partial(rilevazioni_json, sensore['id_sensore']),
+            lambda righe: colonne_blocco(sensore['id_sensore'], righe)
+        )
+
+
+def colonne_blocco(id_sensore, righe):
+    messaggi = []
+    colonne = colonne_righe([(data['dataora'], data['valore'], data['messaggio']) for data in righe], messaggi)
+    return id_sensore, colonne['dataora'], colonne['valore'], colonne['messaggio'], messaggi
+
+
+def parse_dataora_get(valore):
+    """Dataora dai parametri GET: ISO 8601 (data o data e ora) oppure AAAAMMGGhhmmss come nelle stringhe."""
+    if valore is None:
+        return None
+    valore = valore.strip()
+    if len(valore) == LEN_DATETIME and valore.isdigit():
+        dataora = decodifica_dataora(valore)
+    else:
+        dataora = parse_datetime(valore)
+    if dataora is None:
+        data = parse_date(valore)
+        if data is None:
+            raise ValueError('Data non valida: %s' % valore)
+        dataora = datetime.combine(data, time())
+    if timezone.is_naive(dataora):
+        dataora = timezone.make_aware(dataora, timezone.utc)
+    return dataora
+
+
+def parse_campionamento(request):
+    """from, to, points, bucket e metodo della richiesta; ValueError con il messaggio per il client."""
+    dal = parse_dataora_get(request.GET.get('from'))
+    al = parse_dataora_get(request.GET.get('to'))
+    punti = request.GET.get('points')
+    if punti is not None:
+        if not punti.isdigit():
+            raise ValueError('points non valido: %s' % punti)
+        punti = int(punti)
+        if not 1 <= punti <= settings.RILEVAZIONI_MAX_PUNTI:
+            raise ValueError('points deve essere tra 1 e %d' % settings.RILEVAZIONI_MAX_PUNTI)
+    larghezza = parse_intervallo(request.GET['bucket']) if 'bucket' in request.GET else None
+    # Per default i bucket, che usano gli aggregati; LTTB legge le rilevazioni grezze e richiede un intervallo limitato
+    metodo = request.GET.get('metodo', 'bucket')
+    if metodo not in ('bucket', 'lttb') or (metodo == 'lttb' and punti is None and larghezza is not None):
+        raise ValueError('metodo non valido')
+    if metodo == 'lttb' and punti is not None:
+        if dal is None or al is None:
+            raise ValueError('metodo=lttb richiede from e to')
+        if al - dal > timedelta(days=settings.RILEVAZIONI_LTTB_MAX_GIORNI):
+            raise ValueError('metodo=lttb: intervallo massimo %d giorni' % settings.RILEVAZIONI_LTTB_MAX_GIORNI)
+    return dal, al, punti, larghezza, metodo
+
+
+def serie_campionata(id_sensore, dal, al, punti, larghezza, metodo, colonnare=False):
+    """
+    Serie ridotta per i grafici: bucket con minimo/massimo/media (dagli aggregati quando la larghezza
+    del bucket lo permette) oppure i punti scelti da LTTB sulle rilevazioni di archivio e database.
+    Con colonnare i punti LTTB vengono restituiti come SerieColonnare; i bucket restano sempre in JSON.
+    """
+    inizio = int(dal.timestamp()) if dal is not None else None
+    fine = int(ceil(al.timestamp())) if al is not None else None
+    if metodo == 'lttb':
+        serie = leggi_serie(id_sensore, inizio, fine)
+        scelti = lttb(serie['dataora'], serie['valore'], punti)
+        if colonnare:
+            return SerieColonnare([colonne_serie(id_sensore, serie, scelti)])
+        return serie_json(id_sensore, serie, scelti)
+    if larghezza is None:
+        larghezza = larghezza_bucket(id_sensore, inizio, fine, punti)
+    return bucket_json(id_sensore, bucket_rilevazioni(id_sensore, inizio, fine, larghezza))
+
+
+def serie_json(id_sensore, serie, indici=None):
+    # Punti di una serie di leggi_serie (solo quelli in indici, se ci sono) come in rilevazioni_api
+    indici = range(len(serie['dataora'])) if indici is None else indici
+    return [
+        {
+            'id_sensore': id_sensore,
+            'dataora': dataora_json(da_epoch(int(serie['dataora'][i]))),
+            'valore': int(serie['valore'][i]),
+            'messaggio': serie['messaggi'][serie['messaggio'][i]] if serie['messaggio'][i] >= 0 else None,
+        }
+        for i in indici
+    ]
+
+
+def colonne_serie(id_sensore, serie, indici=None):
+    if indici is None:
+        return id_sensore, serie['dataora'], serie['valore'], serie['messaggio'], serie['messaggi']
+    return id_sensore, serie['dataora'][indici], serie['valore'][indici], serie['messaggio'][indici], \
+        serie['messaggi']
+
+
+def bucket_json(id_sensore, bucket):
+    return [
+        {
+            'id_sensore': id_sensore,
+            'dataora': dataora_json(da_epoch(int(bucket['inizio'][i]))),
+            'minimo': int(bucket['minimo'][i]),
+            'massimo': int(bucket['massimo'][i]),
+            'media': float(bucket['media'][i]),
+            'conteggio': int(bucket['conteggio'][i]),
+        }
+        for i in range(len(bucket['inizio']))
+    ]
+
+
+def larghezza_bucket(id_sensore, inizio, fine, punti):
+    # Senza un intervallo esplicito si copre [from, to) (o tutto lo storico) con al massimo punti bucket,
+    # arrotondando a multipli di una scala degli aggregati per poterli usare
+    if inizio is None or fine is None:
+        prima = AggregatoRilevazioni.objects.filter(sensore=id_sensore).order_by('inizio') \
+            .values_list('inizio', flat=True).first()
+        ultima = UltimaRilevazione.objects.filter(sensore=id_sensore).values_list('dataora', flat=True).first()
+        inizio = inizio if inizio is not None else int(prima.timestamp()) if prima else 0
+        fine = fine if fine is not None else int(ultima.timestamp()) + 1 if ultima else inizio + 1
+    larghezza = max(1, int(ceil((fine - inizio) / punti)))
+    for scala in reversed(AggregatoRilevazioni.SCALE):
+        if larghezza > scala:
+            return int(ceil(larghezza / scala)) * scala
+    return larghezza
+
+
+def bucket_rilevazioni(id_sensore, inizio, fine, larghezza):
+    return bucket_sensori([id_sensore], inizio, fine, larghezza)[id_sensore]
+
+
+def bucket_sensori(sensori, inizio, fine, larghezza):
+    """Bucket di larghezza secondi per ogni sensore (dizionario id_sensore -> bucket), con una query in tutto."""
+    scale = [scala for scala in AggregatoRilevazioni.SCALE if larghezza % scala == 0]
+    if not scale:
+        return {
+            id_sensore: aggrega_bucket(serie['dataora'], serie['valore'], larghezza)
+            for id_sensore, serie in leggi_serie_sensori(sensori, inizio, fine).items()
+        }
+    # La scala più grossa che divide il bucket: si combinano gli aggregati senza leggere le rilevazioni
+    aggregati = AggregatoRilevazioni.objects.filter(sensore__in=sensori, scala=scale[-1])
+    if inizio is not None:
+        aggregati = aggregati.filter(inizio__gte=da_epoch(inizio // larghezza * larghezza))
+    if fine is not None:
+        aggregati = aggregati.filter(inizio__lt=da_epoch(fine))
+    righe = aggregati.order_by('sensore_id', 'inizio') \
+        .values_list('sensore', 'inizio', 'conteggio', 'minimo', 'massimo', 'somma')
+    gruppi = {id_sensore: [] for id_sensore in sensori}
+    for id_sensore, gruppo in groupby(righe, key=itemgetter(0)):
+        gruppi[id_sensore] = [riga[1:] for riga in gruppo]
+    bucket = {}
+    for id_sensore, righe in gruppi.items():
+        colonne = list(zip(*righe)) or [[]] * 5
+        bucket[id_sensore] = combina_bucket(
+            np.fromiter((int(dataora.timestamp()) for dataora in colonne[0]), dtype=np.int64, count=len(righe)),
+            *colonne[1:], larghezza=larghezza
+        )
+    return bucket
+
+
+def sensori_richiesti(request):
+    """
+    I sensori di id_sensore (ripetuto o separato da virgole) oppure dell'impianto, con il controllo dei
+    permessi fatto in una query per tutti. Restituisce (sensori, impianto); ValueError se la richiesta
+    non è valida o contiene sensori che l'utente non può vedere.
+    """
+    ids = list(dict.fromkeys(
+        id_sensore for valore in request.GET.getlist('id_sensore') for id_sensore in valore.split(',') if id_sensore
+    ))
+    id_impianto_get = request.GET.get('impianto', None)
+    if bool(ids) == (id_impianto_get is not None):
+        raise ValueError('specificare id_sensore oppure impianto')
+    if id_impianto_get is not None:
+        impianti = Impianto.objects.filter(id=id_impianto_get) if id_impianto_get.isdigit() else Impianto.objects.none()
+        if not request.user.is_staff:
+            impianti = impianti.filter(user=request.user)
+        impianto = impianti.first()
+        if impianto is None:
+            raise ValueError('impianto non presente nel sistema')
+        return [sensore.id for sensore in impianto.get_sensori()], impianto
+    sensori = Sensore.objects.filter(id__in=ids)
+    if not request.user.is_staff:
+        sensori = sensori.filter(impianto__user=request.user)
+    trovati = set(sensori.values_list('id', flat=True).distinct())
+    mancanti = [id_sensore for id_sensore in ids if id_sensore not in trovati]
+    if mancanti:
+        raise ValueError('id_sensore non presente nel sistema: %s' % ', '.join(mancanti))
+    return ids, None
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+@renderer_classes((JSONRenderer, BrowsableAPIRenderer, ColonnareRenderer))
+def serie_rilevazioni_api(request):
+    """
+    Le serie di più sensori (sensori_richiesti) in [from, to), in una sola risposta raggruppata per sensore,
+    con lo stesso campionamento di rilevazioni_api (points, bucket, metodo), obbligatorio con più sensori.
+    """
+    if request.method == 'GET':
+        try:
+            sensori, _ = sensori_richiesti(request)
+            dal, al, punti, larghezza, metodo = parse_campionamento(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if dal is None or al is None:
+            return Response({'error': 'from e to sono obbligatori'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sensori) > settings.SERIE_MAX_SENSORI:
+            return Response({'error': 'al massimo %d sensori per richiesta' % settings.SERIE_MAX_SENSORI},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(sensori) > 1 and punti is None and larghezza is None:
+            # Le rilevazioni grezze di più sensori si scaricano con api/rilevazioni/export/
+            return Response({'error': 'con più sensori points o bucket sono obbligatori'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        inizio, fine = int(dal.timestamp()), int(ceil(al.timestamp()))
+        if metodo == 'bucket' and (punti is not None or larghezza is not None):
+            larghezza = larghezza or larghezza_bucket(None, inizio, fine, punti)
+            bucket = bucket_sensori(sensori, inizio, fine, larghezza)
+            return Response([
+                {'id_sensore': id_sensore, 'rilevazioni': bucket_json(id_sensore, bucket[id_sensore])}
+                for id_sensore in sensori
+            ])
+        serie = leggi_serie_sensori(sensori, inizio, fine)
+        scelti = {
+            id_sensore: lttb(serie[id_sensore]['dataora'], serie[id_sensore]['valore'], punti)
+            if punti is not None else None
+            for id_sensore in sensori
+        }
+        if request.accepted_renderer.format == 'colonnare':
+            return Response(SerieColonnare([
+                colonne_serie(id_sensore, serie[id_sensore], scelti[id_sensore]) for id_sensore in sensori
+            ]))
         return Response([
-            {
-                'id_sensore': sensore.id,
-                'dataora': data['dataora'],
-                'valore': data['valore'],
-                'messaggio': data['messaggio'],
-            }
-            for data in serializer.data
+            {'id_sensore': id_sensore, 'rilevazioni': serie_json(id_sensore, serie[id_sensore], scelti[id_sensore])}
+            for id_sensore in sensori
         ])
 
 
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def statistiche_rilevazioni_api(request):
+    """
+    Minimo, massimo, media, deviazione standard, percentili 50/95/99 e conteggi delle rilevazioni in
+    [from, to) dei sensori richiesti (sensori_richiesti), per sensore, per tipo di sensore e in totale.
+    """
+    if request.method == 'GET':
+        try:
+            sensori, _ = sensori_richiesti(request)
+            dal = parse_dataora_get(request.GET.get('from'))
+            al = parse_dataora_get(request.GET.get('to'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if dal is None or al is None:
+            return Response({'error': 'from e to sono obbligatori'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sensori) > settings.SERIE_MAX_SENSORI:
+            return Response({'error': 'al massimo %d sensori per richiesta' % settings.SERIE_MAX_SENSORI},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(statistiche_sensori(sensori, int(dal.timestamp()), int(ceil(al.timestamp()))))
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def export_rilevazioni_api(request):
+    if request.method == 'GET':
+        formato = request.GET.get('formato', 'csv')
+        if formato not in ('csv', 'colonnare'):
+            return Response({'error': 'formato non valido'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            sensori, impianto = sensori_richiesti(request)
+            dal = parse_dataora_get(request.GET.get('from'))
+            al = parse_dataora_get(request.GET.get('to'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sensori) > settings.SERIE_MAX_SENSORI:
+            return Response({'error': 'al massimo %d sensori per richiesta' % settings.SERIE_MAX_SENSORI},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if impianto is not None:
+            nome = 'impianto_%s' % impianto.id
+        else:
+            nome = 'sensore_%s' % sensori[0] if len(sensori) == 1 else 'sensori_%d' % len(sensori)
+        inizio = int(dal.timestamp()) if dal is not None else None
+        fine = int(ceil(al.timestamp())) if al is not None else None
+        if formato == 'csv':
+            contenuto, content_type, estensione = csv_rilevazioni(sensori, inizio, fine), 'text/csv', 'csv'
+        else:
+            contenuto = colonnare_rilevazioni(sensori, inizio, fine)
+            content_type, estensione = CONTENT_TYPE_COLONNARE, 'bin'
+        if request.GET.get('gzip') in ('1', 'true'):
+            contenuto, estensione = comprimi_gzip(contenuto), estensione + '.gz'
+        risposta = StreamingHttpResponse(contenuto, content_type=content_type)
+        risposta['Content-Disposition'] = 'attachment; filename="rilevazioni_%s.%s"' % (
+            ''.join(c if c.isalnum() or c in '-_' else '_' for c in nome), estensione
+        )
+        return risposta
+
+
 @api_view(['GET'])
 @authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def show_rilevazione_api(request):
     if request.method == 'GET':
-        context = {'request': request}
         id_ril_get = request.GET.get("id", None)
-        try:
-            rilevazione = Rilevazione.objects.get(id=id_ril_get)
-            serializer = RilevazioneSerializer(rilevazione, context=context)
-            data = serializer.data
-            return Response({
-                'id_sensore': data['sensore'],
-                'dataora': data['dataora'],
-                'valore': data['valore'],
-                'messaggio': data['messaggio'],
-            })
-        except Rilevazione.DoesNotExist:
+        data = rilevazione_json(id_ril_get)
+        if data is None:
             return Response({'error': 'rilevazione non presente nel sistema'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data)
 
 
 @api_view(['POST'])
@@ -106,9 +517,82 @@ def add_rilevazione_api(request):
         context = {'request': request}
         serializer = StringaSerializer(data=request.data, context=context)
         if serializer.is_valid():
+            if settings.INGEST_ASYNC:
+                return accoda_stringa(serializer.validated_data['stringa'])
             try:
                 serializer.save()
+            except StringaDuplicata:
+                return Response({'status': 'ok', 'duplicata': True}, status=status.HTTP_200_OK)
             except Exception:
                 return Response({'status': 'fail', 'message': 'bad format'}, status=status.HTTP_400_BAD_REQUEST)
             return Response({'status': 'ok'}, status=status.HTTP_201_CREATED)
         return Response({'status': 'fail'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def accoda_stringa(stringa):
+    try:
+        scomponi(stringa)
+    except (IndexError, ValueError):
+        return Response({'status': 'fail', 'message': 'bad format'}, status=status.HTTP_400_BAD_REQUEST)
+    if not coda_ingest.accoda(stringa):
+        return Response({'status': 'fail', 'message': 'coda piena, riprovare più tardi'},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS)
+    return Response({'status': 'accepted'}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['POST'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+@parser_classes((JSONParser,))
+def add_rilevazioni_batch_api(request):
+    if request.method == 'POST':
+        stringhe = request.data
+        if not isinstance(stringhe, list):
+            return Response({'status': 'fail', 'message': 'attesa una lista di stringhe'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(stringhe) > settings.INGEST_BATCH_MAX:
+            return Response({'status': 'fail', 'message': 'troppe stringhe nella richiesta'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        esiti = salva_stringhe(stringhe)
+        accettate = sum(1 for esito in esiti if esito['status'] == 'ok')
+        return Response({
+            'status': 'ok' if accettate == len(esiti) else 'partial',
+            'accettate': accettate,
+            'rifiutate': len(esiti) - accettate,
+            'esiti': esiti,
+        }, status=status.HTTP_400_BAD_REQUEST if esiti and not accettate else status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def add_rilevazioni_stream_api(request):
+    if request.method == 'POST':
+        if not request.content_type.startswith('text/plain'):
+            return Response({'status': 'fail', 'message': 'attesa una richiesta text/plain'},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').lower()
+        if encoding not in ('', 'identity', 'gzip'):
+            return Response({'status': 'fail', 'message': 'content-encoding non supportato'},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        # Il corpo viene letto direttamente dalla richiesta WSGI, senza passare dai parser di DRF
+        righe = righe_da_stream(request._request, compresso=encoding == 'gzip')
+        riepilogo = salva_righe(righe, settings.INGEST_STREAM_LOTTO)
+        riepilogo['status'] = 'ok' if not riepilogo['rifiutate'] and not riepilogo['troncato'] else 'partial'
+        if riepilogo['troncato']:
+            riepilogo['message'] = 'corpo gzip non valido: salvate solo le righe precedenti'
+        riepilogo['errori_troncati'] = len(riepilogo['errori']) < riepilogo['rifiutate']
+        fallita = (riepilogo['rifiutate'] or riepilogo['troncato']) and not riepilogo['accettate']
+        return Response(riepilogo, status=status.HTTP_400_BAD_REQUEST if fallita else status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAdminUser,))
+def metriche_api(request):
+    if request.method == 'GET':
+        return Response({
+            'cache_sensori': cache_sensori.statistiche(),
+            'ingest_async': coda_ingest.statistiche(),
+            'duplicati': finestra_duplicati.statistiche(),
+        })
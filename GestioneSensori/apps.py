@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class GestioneSensoreConfig(AppConfig):
     name = 'GestioneSensori'
+
+    def ready(self):
+        # Registra i receiver che aggiornano aggregati, ultime rilevazioni, ultimo contatto, contatori
+        # dei sensori e delle eccezioni e valutano le regole di allarme
+        from GestioneSensori import aggregati, ultime_rilevazioni, ultimo_contatto, contatori_sensori, \
+            contatori_eccezioni, allarmi  # noqa
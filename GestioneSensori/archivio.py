@@ -0,0 +1,228 @@
+import json
+import os
+from itertools import groupby
+from operator import itemgetter
+from urllib.parse import quote
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from GestioneSensori.models import Rilevazione
+from GestioneSensori.paginazione import pagine_keyset
+from GestioneSensori.parser_stringhe import da_epoch
+
+NOME_INDICE = 'indice.json'
+COLONNE = {
+    # dataora in secondi epoch, messaggio come codice nel dizionario dei messaggi (-1 = nessun messaggio)
+    'dataora': np.int64,
+    'valore': np.int32,
+    'messaggio': np.int32,
+}
+
+
+class ArchivioSensore:
+    """
+    Archivio colonnare delle rilevazioni di un sensore: segmenti in sola aggiunta, ordinati per dataora,
+    con un file .npy per colonna. L'indice (segmenti, dizionario dei messaggi e dataora fino a cui
+    l'archivio è completo) viene sostituito in modo atomico dopo la scrittura di ogni segmento, quindi
+    i lettori vedono sempre un archivio coerente.
+    """
+
+    def __init__(self, id_sensore, cartella=None):
+        self.id_sensore = id_sensore
+        self.cartella = os.path.join(cartella or settings.ARCHIVIO_DIR, quote(id_sensore, safe=''))
+
+    def indice(self):
+        try:
+            with open(os.path.join(self.cartella, NOME_INDICE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'fino_a': None, 'segmenti': [], 'messaggi': []}
+
+    def _scrivi_indice(self, indice):
+        percorso = os.path.join(self.cartella, NOME_INDICE)
+        with open(percorso + '.tmp', 'w') as f:
+            json.dump(indice, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(percorso + '.tmp', percorso)
+
+    def aggiungi(self, dataora, valore, messaggi, fino_a):
+        """Aggiunge un segmento (dataora ordinate, successive all'archivio) e sposta il limite a fino_a."""
+        indice = self.indice()
+        os.makedirs(self.cartella, exist_ok=True)
+        codici = {messaggio: codice for codice, messaggio in enumerate(indice['messaggi'])}
+        colonne = {
+            'dataora': np.asarray(dataora, dtype=COLONNE['dataora']),
+            'valore': np.asarray(valore, dtype=COLONNE['valore']),
+            'messaggio': np.fromiter(
+                (-1 if messaggio is None else codici.setdefault(messaggio, len(codici)) for messaggio in messaggi),
+                dtype=COLONNE['messaggio'], count=len(messaggi)
+            ),
+        }
+        if len(colonne['dataora']):
+            nome = '%06d' % len(indice['segmenti'])
+            for colonna, dati in colonne.items():
+                np.save(os.path.join(self.cartella, '%s.%s.npy' % (nome, colonna)), dati)
+            indice['segmenti'].append({
+                'nome': nome,
+                'primo': int(colonne['dataora'][0]),
+                'ultimo': int(colonne['dataora'][-1]),
+                'righe': len(colonne['dataora']),
+            })
+        indice['messaggi'] = sorted(codici, key=codici.get)
+        indice['fino_a'] = fino_a
+        self._scrivi_indice(indice)
+
+    def segmenti(self, dal=None, al=None, indice=None):
+        """
+        Restituisce, per ogni segmento che interseca [dal, al) (secondi epoch), le colonne come viste
+        NumPy sul file mappato in memoria: nessun dato viene copiato.
+        """
+        indice = indice or self.indice()
+        for segmento in indice['segmenti']:
+            if (dal is not None and segmento['ultimo'] < dal) or (al is not None and segmento['primo'] >= al):
+                continue
+            colonne = {
+                colonna: np.load(os.path.join(self.cartella, '%s.%s.npy' % (segmento['nome'], colonna)),
+                                 mmap_mode='r')
+                for colonna in COLONNE
+            }
+            inizio = 0 if dal is None else np.searchsorted(colonne['dataora'], dal, side='left')
+            fine = len(colonne['dataora']) if al is None else np.searchsorted(colonne['dataora'], al, side='left')
+            yield {colonna: dati[inizio:fine] for colonna, dati in colonne.items()}
+
+
+def archivia(id_sensore, fino_a, cartella=None, righe_segmento=None):
+    """
+    Copia nell'archivio le rilevazioni del sensore successive all'ultimo limite e precedenti a fino_a
+    (secondi epoch). Le rilevazioni arrivate in ritardo con dataora già archiviata restano solo nel database.
+    """
+    righe_segmento = righe_segmento or settings.ARCHIVIO_RIGHE_SEGMENTO
+    archivio = ArchivioSensore(id_sensore, cartella)
+    dal = archivio.indice()['fino_a']
+    if dal is not None and dal >= fino_a:
+        return 0
+    rilevazioni = Rilevazione.objects.filter(sensore=id_sensore, dataora__lt=da_epoch(fino_a))
+    if dal is not None:
+        rilevazioni = rilevazioni.filter(dataora__gte=da_epoch(dal))
+    archiviate = 0
+    blocco = ([], [], [])
+    for dataora, valore, messaggio in rilevazioni.order_by('dataora', 'id') \
+            .values_list('dataora', 'valore', 'messaggio').iterator():
+        blocco[0].append(int(dataora.timestamp()))
+        blocco[1].append(valore)
+        blocco[2].append(messaggio)
+        if len(blocco[0]) >= righe_segmento:
+            # Il segmento si chiude prima dell'ultimo secondo, che potrebbe continuare nella riga successiva:
+            # così il limite dell'indice resta esatto anche se l'archiviazione si interrompe
+            taglio = blocco[0].index(blocco[0][-1])
+            if taglio:
+                archivio.aggiungi(*(colonna[:taglio] for colonna in blocco), fino_a=blocco[0][-1])
+                archiviate += taglio
+                blocco = tuple(colonna[taglio:] for colonna in blocco)
+    archivio.aggiungi(*blocco, fino_a=fino_a)
+    return archiviate + len(blocco[0])
+
+
+def _rilevazioni_dopo_archivio(id_sensore, limite, dal, al):
+    # Nel database solo ciò che l'archivio non copre: da max(limite, dal) ad al
+    rilevazioni = Rilevazione.objects.filter(sensore=id_sensore)
+    inizio = limite if dal is None or (limite is not None and limite > dal) else dal
+    if inizio is not None:
+        rilevazioni = rilevazioni.filter(dataora__gte=da_epoch(inizio))
+    if al is not None:
+        rilevazioni = rilevazioni.filter(dataora__lt=da_epoch(al))
+    return rilevazioni
+
+
+def colonne_righe(righe, messaggi):
+    # righe (dataora, valore, messaggio) in colonne; i messaggi nuovi vengono aggiunti in coda al dizionario
+    codici = {messaggio: codice for codice, messaggio in enumerate(messaggi)}
+    colonne = {
+        'dataora': np.fromiter((int(riga[0].timestamp()) for riga in righe),
+                               dtype=COLONNE['dataora'], count=len(righe)),
+        'valore': np.fromiter((riga[1] for riga in righe), dtype=COLONNE['valore'], count=len(righe)),
+        'messaggio': np.fromiter(
+            (-1 if riga[2] is None else codici.setdefault(riga[2], len(codici)) for riga in righe),
+            dtype=COLONNE['messaggio'], count=len(righe)
+        ),
+    }
+    messaggi.extend(sorted(codici, key=codici.get)[len(messaggi):])
+    return colonne
+
+
+def leggi_serie(id_sensore, dal=None, al=None, cartella=None):
+    """
+    Serie continua delle rilevazioni di un sensore in [dal, al) (secondi epoch): archivio fino al suo limite,
+    database da lì in poi. Restituisce le colonne dataora, valore e messaggio (codici) insieme al dizionario
+    dei messaggi. Se i dati stanno in un solo segmento le colonne sono viste sul file, senza copie.
+    """
+    return leggi_serie_sensori([id_sensore], dal, al, cartella)[id_sensore]
+
+
+def leggi_serie_sensori(sensori, dal=None, al=None, cartella=None):
+    """
+    Come leggi_serie per più sensori, restituite in un dizionario id_sensore -> serie. Gli archivi si leggono
+    sensore per sensore (solo file); dal database arriva una sola query per tutti i sensori.
+    """
+    parti, messaggi, da_leggere = {}, {}, {}
+    for id_sensore in sensori:
+        archivio = ArchivioSensore(id_sensore, cartella)
+        indice = archivio.indice()
+        messaggi[id_sensore] = list(indice['messaggi'])
+        parti[id_sensore] = list(archivio.segmenti(dal, al, indice))
+        limite = indice['fino_a']
+        if limite is None or al is None or al > limite:
+            # I sensori archiviati fino allo stesso limite condividono la stessa condizione sulla dataora
+            inizio = limite if dal is None or (limite is not None and limite > dal) else dal
+            da_leggere.setdefault(inizio, []).append(id_sensore)
+    if da_leggere:
+        condizione = Q()
+        for inizio, ids in da_leggere.items():
+            condizione |= Q(sensore__in=ids, dataora__gte=da_epoch(inizio)) if inizio is not None \
+                else Q(sensore__in=ids)
+        rilevazioni = Rilevazione.objects.filter(condizione)
+        if al is not None:
+            rilevazioni = rilevazioni.filter(dataora__lt=da_epoch(al))
+        righe = rilevazioni.order_by('sensore_id', 'dataora', 'id') \
+            .values_list('sensore', 'dataora', 'valore', 'messaggio')
+        for id_sensore, gruppo in groupby(righe.iterator(), key=itemgetter(0)):
+            parti[id_sensore].append(colonne_righe([riga[1:] for riga in gruppo], messaggi[id_sensore]))
+    serie = {}
+    for id_sensore in sensori:
+        if len(parti[id_sensore]) == 1:
+            serie[id_sensore] = parti[id_sensore][0]
+        elif parti[id_sensore]:
+            serie[id_sensore] = {
+                colonna: np.concatenate([parte[colonna] for parte in parti[id_sensore]]) for colonna in COLONNE
+            }
+        else:
+            serie[id_sensore] = {colonna: np.empty(0, dtype=tipo) for colonna, tipo in COLONNE.items()}
+        serie[id_sensore]['messaggi'] = messaggi[id_sensore]
+    return serie
+
+
+def blocchi_serie(id_sensore, dal=None, al=None, dimensione=10000, cartella=None):
+    """
+    Come leggi_serie, ma a blocchi di al massimo dimensione righe e con memoria costante: i segmenti
+    dell'archivio vengono letti a fette e il database a pagine keyset. Il dizionario dei messaggi
+    restituito con ogni blocco cresce solo in aggiunta, quindi i codici dei blocchi precedenti restano validi.
+    """
+    archivio = ArchivioSensore(id_sensore, cartella)
+    indice = archivio.indice()
+    messaggi = list(indice['messaggi'])
+    for segmento in archivio.segmenti(dal, al, indice):
+        for inizio in range(0, len(segmento['dataora']), dimensione):
+            blocco = {colonna: dati[inizio:inizio + dimensione] for colonna, dati in segmento.items()}
+            blocco['messaggi'] = messaggi
+            yield blocco
+    limite = indice['fino_a']
+    if limite is None or al is None or al > limite:
+        rilevazioni = _rilevazioni_dopo_archivio(id_sensore, limite, dal, al) \
+            .values('id', 'dataora', 'valore', 'messaggio')
+        for righe in pagine_keyset(rilevazioni, ('dataora', 'id'), dimensione):
+            blocco = colonne_righe([(r['dataora'], r['valore'], r['messaggio']) for r in righe], messaggi)
+            blocco['messaggi'] = messaggi
+            yield blocco
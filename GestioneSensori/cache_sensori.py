@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class CacheSensori:
+    """
+    Cache LRU in memoria dei metadati dei sensori (id -> codice_errore, tipo, marca, impianto attuale).
+    Le voci vengono invalidate dai segnali dei modelli; il TTL limita quanto a lungo un processo
+    può servire dati modificati da un altro processo.
+    """
+
+    def __init__(self, loader, max_size, ttl):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.voci = OrderedDict()
+        self.lock = Lock()
+        self.generazione = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _leggi(self, id_sensore, adesso):
+        voce = self.voci.get(id_sensore)
+        if voce is None or voce[0] < adesso:
+            return None
+        self.voci.move_to_end(id_sensore)
+        return voce[1]
+
+    def get(self, id_sensore):
+        return self.get_many([id_sensore]).get(id_sensore)
+
+    def get_many(self, ids):
+        adesso = monotonic()
+        trovati = {}
+        mancanti = set()
+        with self.lock:
+            generazione = self.generazione
+            for id_sensore in ids:
+                if id_sensore in trovati or id_sensore in mancanti:
+                    continue
+                dati = self._leggi(id_sensore, adesso)
+                if dati is None:
+                    mancanti.add(id_sensore)
+                    self.misses += 1
+                else:
+                    trovati[id_sensore] = dati
+                    self.hits += 1
+        if mancanti:
+            # I sensori inesistenti non vengono memorizzati: un sensore appena creato è subito visibile
+            caricati = self.loader(mancanti)
+            scadenza = monotonic() + self.ttl
+            with self.lock:
+                # Se nel frattempo c'è stata un'invalidazione i dati letti potrebbero essere già vecchi
+                if generazione == self.generazione:
+                    for id_sensore, dati in caricati.items():
+                        self.voci[id_sensore] = (scadenza, dati)
+                        self.voci.move_to_end(id_sensore)
+                    while len(self.voci) > self.max_size:
+                        self.voci.popitem(last=False)
+            trovati.update(caricati)
+        return trovati
+
+    def invalida(self, id_sensore):
+        with self.lock:
+            self.generazione += 1
+            self.voci.pop(id_sensore, None)
+
+    def svuota(self):
+        with self.lock:
+            self.generazione += 1
+            self.voci.clear()
+
+    def statistiche(self):
+        with self.lock:
+            richieste = self.hits + self.misses
+            return {
+                'voci': len(self.voci),
+                'max_voci': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / richieste if richieste else None,
+            }
@@ -0,0 +1,76 @@
+import re
+
+import numpy as np
+
+UNITA_INTERVALLO = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+FORMATO_INTERVALLO = re.compile(r'^(\d+)([smhd]?)$')
+
+
+def parse_intervallo(intervallo):
+    """Durata in secondi da stringhe come '90', '30s', '5m', '1h', '1d'."""
+    trovato = FORMATO_INTERVALLO.match(intervallo.strip())
+    if trovato is None or int(trovato.group(1)) == 0:
+        raise ValueError('Intervallo non valido: %s' % intervallo)
+    return int(trovato.group(1)) * UNITA_INTERVALLO[trovato.group(2) or 's']
+
+
+def aggrega_bucket(dataora, valore, larghezza, inizio=0):
+    """
+    Minimo, massimo, media e conteggio per bucket di larghezza secondi allineati a inizio.
+    dataora deve essere ordinata; vengono restituiti solo i bucket con almeno una rilevazione.
+    """
+    valore = np.asarray(valore, dtype=np.int64)
+    return combina_bucket(dataora, np.ones(len(valore), dtype=np.int64), valore, valore, valore, larghezza, inizio)
+
+
+def combina_bucket(dataora, conteggio, minimo, massimo, somma, larghezza, inizio=0):
+    """Come aggrega_bucket, partendo da aggregati parziali (es. gli aggregati al minuto o all'ora)."""
+    if not len(dataora):
+        vuoto = np.empty(0, dtype=np.int64)
+        return {'inizio': vuoto, 'minimo': vuoto, 'massimo': vuoto, 'media': np.empty(0), 'conteggio': vuoto}
+    bucket = (np.asarray(dataora, dtype=np.int64) - inizio) // larghezza
+    # bucket è ordinato: ogni gruppo è un tratto contiguo che inizia dove il bucket cambia
+    primi = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    conteggio = np.add.reduceat(np.asarray(conteggio, dtype=np.int64), primi)
+    return {
+        'inizio': bucket[primi] * larghezza + inizio,
+        'minimo': np.minimum.reduceat(np.asarray(minimo, dtype=np.int64), primi),
+        'massimo': np.maximum.reduceat(np.asarray(massimo, dtype=np.int64), primi),
+        'media': np.add.reduceat(np.asarray(somma, dtype=np.int64), primi) / conteggio,
+        'conteggio': conteggio,
+    }
+
+
+def lttb(dataora, valore, punti):
+    """
+    Indici dei punti scelti dal Largest-Triangle-Three-Buckets: riduce la serie a punti elementi
+    mantenendone la forma (picchi compresi). Il primo e l'ultimo punto sono sempre inclusi.
+    """
+    n = len(dataora)
+    if punti >= n:
+        return np.arange(n)
+    if punti < 3:
+        return np.array([0, n - 1][:punti], dtype=np.int64)
+    x = np.asarray(dataora, dtype=np.float64)
+    y = np.asarray(valore, dtype=np.float64)
+    # Limiti dei punti - 2 bucket interni, il primo e l'ultimo punto fanno bucket a sé
+    limiti = np.linspace(1, n - 1, punti - 1).astype(np.int64)
+    scelti = np.empty(punti, dtype=np.int64)
+    scelti[0] = 0
+    scelti[-1] = n - 1
+    # Media del bucket successivo a ogni bucket, calcolata una volta sola per tutti
+    somme_x = np.add.reduceat(x[:-1], limiti[:-1])
+    somme_y = np.add.reduceat(y[:-1], limiti[:-1])
+    larghezze = np.diff(limiti)
+    medie_x = np.r_[somme_x / larghezze, x[-1]]
+    medie_y = np.r_[somme_y / larghezze, y[-1]]
+    precedente = 0
+    for b in range(punti - 2):
+        inizio, fine = limiti[b], limiti[b + 1]
+        area = np.abs(
+            (x[precedente] - medie_x[b + 1]) * (y[inizio:fine] - y[precedente])
+            - (x[precedente] - x[inizio:fine]) * (medie_y[b + 1] - y[precedente])
+        )
+        precedente = inizio + int(np.argmax(area))
+        scelti[b + 1] = precedente
+    return scelti
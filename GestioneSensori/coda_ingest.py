@@ -0,0 +1,126 @@
+import atexit
+import logging
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from GestioneSensori.ingest import salva_stringhe
+
+logger = logging.getLogger(__name__)
+
+FINE = object()
+
+
+class CodaIngest:
+    """
+    Coda in memoria per l'ingest asincrono: le richieste accodano le stringhe e un thread di scrittura
+    le salva a gruppi (group commit) appena si raggiungono flush_items stringhe o sono passati flush_ms
+    millisecondi dalla prima stringa del gruppo.
+    """
+
+    def __init__(self, max_size, flush_items, flush_ms, scrivi=salva_stringhe):
+        self.coda = Queue(maxsize=max_size)
+        self.flush_items = flush_items
+        self.flush_secondi = flush_ms / 1000
+        self.scrivi = scrivi
+        self.thread = None
+        self.lock = Lock()
+        self.accodate = 0
+        self.rifiutate = 0
+        self.lotti = 0
+        self.ultimo_lotto = 0
+        self.durata_ultimo_lotto = 0
+        self.durata_lotti = 0
+        self.scritte = 0
+        self.scartate = 0
+        self.perse = 0
+
+    def avvia(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._ciclo_scrittura, name='coda-ingest', daemon=True)
+                self.thread.start()
+
+    def accoda(self, stringa):
+        if self.thread is None:
+            self.avvia()
+        try:
+            self.coda.put_nowait(stringa)
+        except Full:
+            with self.lock:
+                self.rifiutate += 1
+            return False
+        with self.lock:
+            self.accodate += 1
+        return True
+
+    def chiudi(self, timeout=None):
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.coda.put(FINE)
+        self.thread.join(timeout)
+
+    def _ciclo_scrittura(self):
+        fine = False
+        while not fine:
+            primo = self.coda.get()
+            if primo is FINE:
+                break
+            lotto = [primo]
+            scadenza = monotonic() + self.flush_secondi
+            while len(lotto) < self.flush_items:
+                attesa = scadenza - monotonic()
+                if attesa <= 0:
+                    break
+                try:
+                    stringa = self.coda.get(timeout=attesa)
+                except Empty:
+                    break
+                if stringa is FINE:
+                    fine = True
+                    break
+                lotto.append(stringa)
+            self._commit(lotto)
+
+    def _commit(self, lotto):
+        close_old_connections()
+        inizio = monotonic()
+        try:
+            esiti = self.scrivi(lotto)
+        except Exception:
+            logger.exception('Scrittura di un lotto di %d stringhe fallita', len(lotto))
+            self.perse += len(lotto)
+            return
+        finally:
+            close_old_connections()
+        ok = sum(1 for esito in esiti if esito['status'] == 'ok')
+        self.durata_ultimo_lotto = monotonic() - inizio
+        self.durata_lotti += self.durata_ultimo_lotto
+        self.lotti += 1
+        self.ultimo_lotto = len(lotto)
+        self.scritte += ok
+        self.scartate += len(lotto) - ok
+
+    def statistiche(self):
+        return {
+            'attiva': settings.INGEST_ASYNC,
+            'profondita': self.coda.qsize(),
+            'max_profondita': self.coda.maxsize,
+            'accodate': self.accodate,
+            'rifiutate': self.rifiutate,
+            'lotti': self.lotti,
+            'ultimo_lotto': self.ultimo_lotto,
+            'media_lotto': (self.scritte + self.scartate) / self.lotti if self.lotti else None,
+            'latenza_ultimo_lotto_ms': self.durata_ultimo_lotto * 1000,
+            'latenza_media_lotto_ms': self.durata_lotti * 1000 / self.lotti if self.lotti else None,
+            'scritte': self.scritte,
+            'scartate': self.scartate,
+            'perse': self.perse,
+        }
+
+
+coda_ingest = CodaIngest(settings.INGEST_CODA_MAX, settings.INGEST_FLUSH_ITEMS, settings.INGEST_FLUSH_MS)
+atexit.register(coda_ingest.chiudi)
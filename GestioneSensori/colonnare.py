@@ -0,0 +1,130 @@
+"""
+Formato binario colonnare per le rilevazioni, scrivibile e leggibile a blocchi.
+
+Dopo l'intestazione MAGIC seguono blocchi <tag di 4 byte><lunghezza uint32><contenuto>, tutto little-endian:
+
+- SENS: lista JSON (utf-8) di id sensore da aggiungere al dizionario dei sensori
+- MSGS: lista JSON di messaggi da aggiungere al dizionario dei messaggi
+- DATA: codice sensore int32, righe n uint32, poi le colonne dataora int64[n] (secondi epoch), valore int32[n]
+  e messaggio int32[n] (codice nel dizionario, -1 = nessun messaggio)
+- FINE: fine dello stream, senza contenuto
+
+I dizionari crescono solo in aggiunta, quindi ogni id sensore e ogni messaggio viene scritto una volta sola.
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'GSCOL\x00\x01\x00'
+CONTENT_TYPE = 'application/x-rilevazioni-colonnare'
+BLOCCO = struct.Struct('<4sI')
+DATI = struct.Struct('<iI')
+COLONNE = (('dataora', '<i8'), ('valore', '<i4'), ('messaggio', '<i4'))
+
+
+class FormatoNonValido(ValueError):
+    pass
+
+
+def _blocco(tag, contenuto):
+    return BLOCCO.pack(tag, len(contenuto)) + contenuto
+
+
+class CodificatoreColonnare:
+    def __init__(self):
+        self.sensori = {}
+        self.messaggi = {}
+
+    def intestazione(self):
+        return MAGIC
+
+    def blocco(self, id_sensore, dataora, valore, messaggio, messaggi):
+        """
+        Un blocco di rilevazioni di un sensore: messaggio contiene i codici nel dizionario messaggi
+        (lista del chiamante), che vengono ricodificati nel dizionario dello stream.
+        """
+        parti = []
+        if id_sensore not in self.sensori:
+            self.sensori[id_sensore] = len(self.sensori)
+            parti.append(_blocco(b'SENS', json.dumps([id_sensore]).encode('utf-8')))
+        nuovi = [m for m in messaggi if m not in self.messaggi]
+        if nuovi:
+            for m in nuovi:
+                self.messaggi[m] = len(self.messaggi)
+            parti.append(_blocco(b'MSGS', json.dumps(nuovi).encode('utf-8')))
+        messaggio = np.asarray(messaggio, dtype=np.int32)
+        if len(messaggi):
+            mappa = np.fromiter((self.messaggi[m] for m in messaggi), dtype=np.int32, count=len(messaggi))
+            messaggio = np.where(messaggio >= 0, mappa[np.maximum(messaggio, 0)], -1)
+        contenuto = [DATI.pack(self.sensori[id_sensore], len(messaggio))]
+        for (_, tipo), colonna in zip(COLONNE, (dataora, valore, messaggio)):
+            contenuto.append(np.asarray(colonna).astype(tipo, copy=False).tobytes())
+        parti.append(_blocco(b'DATA', b''.join(contenuto)))
+        return b''.join(parti)
+
+    def fine(self):
+        return _blocco(b'FINE', b'')
+
+
+class SerieColonnare:
+    """Rilevazioni già in colonne, a blocchi (id_sensore, dataora, valore, messaggio, messaggi), da codificare."""
+
+    def __init__(self, blocchi=()):
+        self.blocchi = list(blocchi)
+
+    def aggiungi(self, id_sensore, dataora, valore, messaggio, messaggi):
+        self.blocchi.append((id_sensore, dataora, valore, messaggio, messaggi))
+
+    def codifica(self):
+        codificatore = CodificatoreColonnare()
+        return b''.join(
+            [codificatore.intestazione()]
+            + [codificatore.blocco(*blocco) for blocco in self.blocchi]
+            + [codificatore.fine()]
+        )
+
+
+def decodifica(dati):
+    """
+    Decoder di riferimento: restituisce le colonne sensore (codici), dataora, valore e messaggio (codici)
+    come array NumPy, insieme ai dizionari sensori e messaggi.
+    """
+    dati = memoryview(dati)
+    if bytes(dati[:len(MAGIC)]) != MAGIC:
+        raise FormatoNonValido('intestazione non valida')
+    sensori, messaggi = [], []
+    blocchi = {'sensore': [], 'dataora': [], 'valore': [], 'messaggio': []}
+    posizione = len(MAGIC)
+    while True:
+        if posizione + BLOCCO.size > len(dati):
+            raise FormatoNonValido('stream troncato')
+        tag, lunghezza = BLOCCO.unpack_from(dati, posizione)
+        posizione += BLOCCO.size
+        contenuto = dati[posizione:posizione + lunghezza]
+        if len(contenuto) != lunghezza:
+            raise FormatoNonValido('stream troncato')
+        posizione += lunghezza
+        if tag == b'FINE':
+            break
+        elif tag == b'SENS':
+            sensori.extend(json.loads(bytes(contenuto).decode('utf-8')))
+        elif tag == b'MSGS':
+            messaggi.extend(json.loads(bytes(contenuto).decode('utf-8')))
+        elif tag == b'DATA':
+            sensore, n = DATI.unpack_from(contenuto)
+            inizio = DATI.size
+            blocchi['sensore'].append(np.full(n, sensore, dtype=np.int32))
+            for nome, tipo in COLONNE:
+                fine = inizio + n * np.dtype(tipo).itemsize
+                blocchi[nome].append(np.frombuffer(contenuto[inizio:fine], dtype=tipo))
+                inizio = fine
+        else:
+            raise FormatoNonValido('blocco sconosciuto: %r' % tag)
+    risultato = {
+        nome: np.concatenate(parti) if parti else np.empty(0, dtype=tipo)
+        for (nome, parti), tipo in zip(blocchi.items(), ('<i4', '<i8', '<i4', '<i4'))
+    }
+    risultato['sensori'] = sensori
+    risultato['messaggi'] = messaggi
+    return risultato
@@ -0,0 +1,128 @@
+from datetime import timedelta
+from time import sleep
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from GestioneSensori.aggregati import ricostruisci_aggregati
+from GestioneSensori.models import AggregatoRilevazioni, Eccezione, Rilevazione, Stringa
+
+QUERY_DIMENSIONE_RIGA = {
+    # Media dalle statistiche della tabella: la stima dei byte liberati è indicativa
+    'mysql': 'SELECT AVG_ROW_LENGTH FROM information_schema.TABLES '
+             'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s;',
+}
+
+
+def politica_conservazione(tipo):
+    """Giorni di conservazione delle rilevazioni e di ogni scala di aggregati per un tipo di sensore."""
+    eccezioni = settings.RETENZIONE_PER_TIPO.get(tipo, {})
+    aggregati = dict(settings.RETENZIONE_AGGREGATI_GIORNI)
+    aggregati.update(eccezioni.get('aggregati', {}))
+    return {
+        'rilevazioni': eccezioni.get('rilevazioni', settings.RETENZIONE_RILEVAZIONI_GIORNI),
+        'aggregati': aggregati,
+    }
+
+
+def limite_conservazione(giorni, adesso=None):
+    # Allineato all'inizio del giorno (UTC): un giorno viene eliminato sempre per intero
+    if giorni is None:
+        return None
+    adesso = adesso or timezone.now()
+    return AggregatoRilevazioni.inizio_bucket(adesso - timedelta(days=giorni), AggregatoRilevazioni.SCALA_GIORNO)
+
+
+def dimensione_media_riga(model):
+    query = QUERY_DIMENSIONE_RIGA.get(connection.vendor)
+    if query is None:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(query, [model._meta.db_table])
+        riga = cursor.fetchone()
+    return riga[0] if riga else None
+
+
+def aggregati_mancanti(id_sensore, limite):
+    """
+    Vero se le rilevazioni da eliminare non sono tutte coperte dagli aggregati giornalieri
+    (es. dati salvati prima dell'introduzione degli aggregati).
+    """
+    grezzi = Rilevazione.objects.filter(sensore=id_sensore, dataora__lt=limite).aggregate(
+        primo=Min('dataora'), conteggio=Count('id')
+    )
+    if not grezzi['conteggio']:
+        return False
+    aggregati = AggregatoRilevazioni.objects.filter(
+        sensore=id_sensore, scala=AggregatoRilevazioni.SCALA_GIORNO,
+        inizio__gte=AggregatoRilevazioni.inizio_bucket(grezzi['primo'], AggregatoRilevazioni.SCALA_GIORNO),
+        inizio__lt=limite,
+    ).aggregate(conteggio=Sum('conteggio'))
+    return (aggregati['conteggio'] or 0) != grezzi['conteggio']
+
+
+def completa_aggregati(id_sensore, limite):
+    primo = Rilevazione.objects.filter(sensore=id_sensore, dataora__lt=limite).aggregate(primo=Min('dataora'))['primo']
+    if primo is not None:
+        ricostruisci_aggregati(id_sensore, primo, limite - timedelta(seconds=1))
+
+
+def stima_rilevazioni(id_sensore, limite):
+    rilevazioni = Rilevazione.objects.filter(sensore=id_sensore, dataora__lt=limite)
+    return rilevazioni.aggregate(rilevazioni=Count('id'), stringhe=Count('stringa', distinct=True))
+
+
+def stima_aggregati(id_sensore, scala, limite):
+    return AggregatoRilevazioni.objects.filter(sensore=id_sensore, scala=scala, inizio__lt=limite).count()
+
+
+def elimina_rilevazioni(id_sensore, limite, lotto=None, pausa_ms=None):
+    """
+    Elimina le rilevazioni precedenti al limite a lotti, ognuno in una transazione breve, insieme alle stringhe
+    rimaste senza rilevazioni né eccezioni. Le eccezioni non hanno una data e vengono conservate.
+    """
+    lotto = lotto or settings.RETENZIONE_LOTTO
+    pausa_ms = settings.RETENZIONE_PAUSA_MS if pausa_ms is None else pausa_ms
+    eliminate = {'rilevazioni': 0, 'stringhe': 0}
+    while True:
+        with transaction.atomic():
+            righe = list(
+                Rilevazione.objects.filter(sensore=id_sensore, dataora__lt=limite)
+                .order_by('dataora').values_list('id', 'stringa')[:lotto]
+            )
+            if not righe:
+                break
+            Rilevazione.objects.filter(id__in=[id_ril for id_ril, _ in righe]).delete()
+            stringhe = {id_stringa for _, id_stringa in righe}
+            stringhe -= set(Rilevazione.objects.filter(stringa__in=stringhe).values_list('stringa', flat=True))
+            stringhe -= set(Eccezione.objects.filter(stringa__in=stringhe).values_list('stringa', flat=True))
+            if stringhe:
+                Stringa.objects.filter(id__in=stringhe).delete()
+        eliminate['rilevazioni'] += len(righe)
+        eliminate['stringhe'] += len(stringhe)
+        if len(righe) < lotto:
+            break
+        sleep(pausa_ms / 1000)
+    return eliminate
+
+
+def elimina_aggregati(id_sensore, scala, limite, lotto=None, pausa_ms=None):
+    lotto = lotto or settings.RETENZIONE_LOTTO
+    pausa_ms = settings.RETENZIONE_PAUSA_MS if pausa_ms is None else pausa_ms
+    eliminati = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                AggregatoRilevazioni.objects.filter(sensore=id_sensore, scala=scala, inizio__lt=limite)
+                .order_by('inizio').values_list('id', flat=True)[:lotto]
+            )
+            if not ids:
+                break
+            AggregatoRilevazioni.objects.filter(id__in=ids).delete()
+        eliminati += len(ids)
+        if len(ids) < lotto:
+            break
+        sleep(pausa_ms / 1000)
+    return eliminati
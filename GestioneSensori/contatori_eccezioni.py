@@ -0,0 +1,121 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.dispatch import receiver
+from django.utils import timezone
+
+from GestioneSensori.models import Eccezione, Installazione, ContatoreEccezioni, InizioContatoriEccezioni, \
+    ContatoreEccezioniImpianto, TotaleEccezioni, EccezioneRecente, cache_sensori
+from GestioneSensori.signals import rilevazioni_salvate
+
+UPSERT = {
+    'mysql': 'ON DUPLICATE KEY UPDATE `conteggio` = `conteggio` + VALUES(`conteggio`);',
+    'sqlite': 'ON CONFLICT (%s) DO UPDATE SET `conteggio` = `conteggio` + excluded.`conteggio`;',
+}
+inizio_registrato = False
+
+
+def incrementa(model, chiavi, conteggi):
+    """Somma conteggi ({(valori di chiavi): n}) ai contatori di model, creando le righe che mancano."""
+    if not conteggi:
+        return
+    colonne = list(chiavi) + ['conteggio']
+    righe = [tuple(chiave) + (n,) for chiave, n in sorted(conteggi.items())]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO `%s` (%s) VALUES %s %s' % (
+                model._meta.db_table,
+                ', '.join('`%s`' % colonna for colonna in colonne),
+                ', '.join(['(%s)' % ', '.join(['%s'] * len(colonne))] * len(righe)),
+                UPSERT[connection.vendor].replace('%s', ', '.join('`%s`' % chiave for chiave in chiavi)),
+            ),
+            [valore for riga in righe for valore in riga]
+        )
+
+
+def accorcia_recenti(impianti):
+    # Tiene solo le ultime ECCEZIONI_RECENTI eccezioni di ogni impianto
+    for id_impianto in impianti:
+        soglia = EccezioneRecente.objects.filter(impianto=id_impianto).order_by('-eccezione') \
+            .values_list('eccezione', flat=True)[settings.ECCEZIONI_RECENTI - 1:settings.ECCEZIONI_RECENTI]
+        soglia = list(soglia)
+        if soglia:
+            EccezioneRecente.objects.filter(impianto=id_impianto, eccezione__lt=soglia[0]).delete()
+
+
+def aggiorna_contatori(eccezioni, giorno=None):
+    """
+    Conta eccezioni (id_sensore, id_eccezione) nel giorno di arrivo, per sensore e per l'impianto in cui il
+    sensore è installato in quel momento, e le aggiunge alle eccezioni recenti dell'impianto.
+    """
+    if not eccezioni:
+        return
+    giorno = connection.ops.adapt_datefield_value(giorno or timezone.now().date())
+    sensori = cache_sensori.get_many({id_sensore for id_sensore, _ in eccezioni})
+    con_impianto = [
+        (sensori[id_sensore]['impianto'], id_sensore, id_eccezione) for id_sensore, id_eccezione in eccezioni
+        if id_sensore in sensori and sensori[id_sensore]['impianto'] is not None
+    ]
+    incrementa(ContatoreEccezioni, ('sensore', 'giorno'),
+               Counter((id_sensore, giorno) for id_sensore, _ in eccezioni))
+    incrementa(ContatoreEccezioniImpianto, ('impianto', 'giorno'),
+               Counter((id_impianto, giorno) for id_impianto, _, _ in con_impianto))
+    incrementa(TotaleEccezioni, ('impianto', 'sensore'),
+               Counter((id_impianto, id_sensore) for id_impianto, id_sensore, _ in con_impianto))
+    EccezioneRecente.objects.bulk_create([
+        EccezioneRecente(impianto_id=id_impianto, eccezione_id=id_eccezione)
+        for id_impianto, _, id_eccezione in con_impianto
+    ])
+    accorcia_recenti({id_impianto for id_impianto, _, _ in con_impianto})
+
+
+def registra_inizio():
+    """
+    Registra in InizioContatoriEccezioni il primo giorno in cui l'ingest conta le eccezioni: i giorni
+    precedenti non hanno contatori e non vanno letti come giorni senza eccezioni. Una query per processo.
+    """
+    global inizio_registrato
+    if inizio_registrato:
+        return
+    InizioContatoriEccezioni.objects.get_or_create(id=1, defaults={'giorno': timezone.now().date()})
+
+    def registrato():
+        global inizio_registrato
+        inizio_registrato = True
+    transaction.on_commit(registrato)
+
+
+@receiver(rilevazioni_salvate)
+def aggiorna_contatori_ingest(sender, eccezioni=(), **kwargs):
+    registra_inizio()
+    aggiorna_contatori([(ecc.sensore_id, ecc.id) for ecc in eccezioni])
+
+
+def ricostruisci_contatori(impianti=None):
+    """
+    Ricalcola totali ed eccezioni recenti dalla tabella delle eccezioni, attribuendole all'impianto in cui
+    ogni sensore è installato ora. I contatori per giorno non si possono ricostruire: le eccezioni non
+    hanno una data.
+    """
+    installazioni = Installazione.objects.filter(data_fine__isnull=True)
+    if impianti is not None:
+        installazioni = installazioni.filter(impianto__in=impianti)
+    impianto_sensore = dict(installazioni.order_by('id').values_list('sensore', 'impianto'))
+    impianti = set(impianto_sensore.values()) if impianti is None else set(impianti)
+    with transaction.atomic():
+        TotaleEccezioni.objects.filter(impianto__in=impianti).delete()
+        EccezioneRecente.objects.filter(impianto__in=impianti).delete()
+        totali = Eccezione.objects.filter(sensore__in=list(impianto_sensore)).values('sensore') \
+            .annotate(n=Count('id')).values_list('sensore', 'n')
+        incrementa(TotaleEccezioni, ('impianto', 'sensore'),
+                   {(impianto_sensore[id_sensore], id_sensore): n for id_sensore, n in totali})
+        for id_impianto in impianti:
+            sensori = [id_sensore for id_sensore, impianto in impianto_sensore.items() if impianto == id_impianto]
+            recenti = Eccezione.objects.filter(sensore__in=sensori).order_by('-id') \
+                .values_list('id', flat=True)[:settings.ECCEZIONI_RECENTI]
+            EccezioneRecente.objects.bulk_create([
+                EccezioneRecente(impianto_id=id_impianto, eccezione_id=id_eccezione) for id_eccezione in recenti
+            ])
+    return impianti
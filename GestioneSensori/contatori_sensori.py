@@ -0,0 +1,102 @@
+from threading import local
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from GestioneSensori.models import Impianto, Installazione, Sensore, ContatoreTipiImpianto
+
+_eliminazioni = local()
+
+
+def impianti_in_eliminazione():
+    if not hasattr(_eliminazioni, 'impianti'):
+        _eliminazioni.impianti = set()
+    return _eliminazioni.impianti
+
+
+def conta_sensori(impianti=None):
+    """Sensori installati ora per (impianto, tipo), contati dalle installazioni aperte."""
+    installazioni = Installazione.objects.filter(data_fine__isnull=True)
+    if impianti is not None:
+        installazioni = installazioni.filter(impianto__in=impianti)
+    righe = installazioni.values('impianto', 'sensore__tipo').annotate(num=Count('sensore', distinct=True)) \
+        .values_list('impianto', 'sensore__tipo', 'num')
+    return {(id_impianto, id_tipo): num for id_impianto, id_tipo, num in righe}
+
+
+def ricalcola_contatori(impianti):
+    """
+    Riscrive num_sensori e i contatori per tipo degli impianti. L'impianto viene bloccato, quindi due
+    modifiche concorrenti allo stesso impianto non si sovrappongono.
+    """
+    for id_impianto in impianti:
+        with transaction.atomic():
+            if not Impianto.objects.select_for_update().filter(id=id_impianto).exists():
+                continue
+            conteggi = conta_sensori([id_impianto])
+            ContatoreTipiImpianto.objects.filter(impianto=id_impianto).delete()
+            ContatoreTipiImpianto.objects.bulk_create([
+                ContatoreTipiImpianto(impianto_id=id_impianto, tipo_id=id_tipo, num=num)
+                for (_, id_tipo), num in sorted(conteggi.items())
+            ])
+            # update() e non save(): i contatori non cambiano la versione del catalogo
+            Impianto.objects.filter(id=id_impianto).update(num_sensori=sum(conteggi.values()))
+
+
+@receiver(post_save, sender=Installazione)
+def ricalcola_contatori_installazione(sender, instance=None, **kwargs):
+    # Creazione, chiusura (elimina/sposta) e riapertura (ripristina) di un'installazione
+    ricalcola_contatori([instance.impianto_id])
+
+
+@receiver(post_delete, sender=Installazione)
+def ricalcola_contatori_installazione_eliminata(sender, instance=None, **kwargs):
+    # Un'installazione chiusa non era contata; quelle cancellate con l'impianto non hanno più contatori da
+    # aggiornare. Così eliminare un impianto o un sensore con tutta la sua storia non ricalcola a ogni riga.
+    if instance.data_fine is None and instance.impianto_id not in impianti_in_eliminazione():
+        ricalcola_contatori([instance.impianto_id])
+
+
+@receiver(pre_delete, sender=Impianto)
+def segna_impianto_in_eliminazione(sender, instance=None, **kwargs):
+    # pre_delete dell'impianto arriva prima dei post_delete delle installazioni cancellate in cascata
+    impianti_in_eliminazione().add(instance.id)
+
+
+@receiver(post_delete, sender=Impianto)
+def impianto_eliminato(sender, instance=None, **kwargs):
+    impianti_in_eliminazione().discard(instance.id)
+
+
+@receiver(post_save, sender=Sensore)
+def ricalcola_contatori_sensore(sender, instance=None, created=False, **kwargs):
+    # Il tipo di un sensore installato può essere cambiato
+    if not created:
+        ricalcola_contatori(set(
+            Installazione.objects.filter(sensore=instance.id, data_fine__isnull=True).values_list('impianto', flat=True)
+        ))
+
+
+def verifica_contatori(correggi=True):
+    """
+    Confronta i contatori di tutti gli impianti con le installazioni e, con correggi, ricalcola quelli
+    sbagliati. Restituisce le differenze {id_impianto: (num_sensori, salvati, attesi)}, con i contatori
+    salvati e attesi come dizionari tipo -> num.
+    """
+    attesi = {}
+    for (id_impianto, id_tipo), num in conta_sensori().items():
+        attesi.setdefault(id_impianto, {})[id_tipo] = num
+    salvati = {}
+    for id_impianto, id_tipo, num in ContatoreTipiImpianto.objects.values_list('impianto', 'tipo', 'num'):
+        salvati.setdefault(id_impianto, {})[id_tipo] = num
+    differenze = {}
+    for id_impianto, num_sensori in Impianto.objects.values_list('id', 'num_sensori'):
+        attesi_impianto = attesi.get(id_impianto, {})
+        salvati_impianto = salvati.get(id_impianto, {})
+        if salvati_impianto != attesi_impianto or num_sensori != sum(attesi_impianto.values()):
+            differenze[id_impianto] = (num_sensori, salvati_impianto, attesi_impianto)
+    if correggi:
+        ricalcola_contatori(differenze)
+    return differenze
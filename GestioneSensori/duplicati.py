@@ -0,0 +1,78 @@
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+
+
+class FinestraDuplicati:
+    """
+    Insieme delle chiavi (id_sensore, epoch, valore) delle rilevazioni salvate di recente, diviso in bucket
+    temporali: quando il bucket più vecchio esce dalla finestra viene scartato in blocco. Un bucket viene chiuso
+    anche quando raggiunge la sua quota di chiavi, così la memoria resta limitata anche durante i picchi.
+    """
+
+    def __init__(self, durata, n_bucket, max_chiavi):
+        self.durata_bucket = durata / n_bucket
+        self.max_chiavi_bucket = max(1, max_chiavi // n_bucket)
+        self.bucket = deque([set()], maxlen=n_bucket)
+        self.inizio_bucket = monotonic()
+        self.lock = Lock()
+        self.nuove = 0
+        self.duplicate = 0
+        self.duplicate_db = 0
+
+    def _ruota(self):
+        adesso = monotonic()
+        trascorsi = int((adesso - self.inizio_bucket) // self.durata_bucket)
+        if trascorsi == 0 and len(self.bucket[-1]) < self.max_chiavi_bucket:
+            return
+        for _ in range(min(max(trascorsi, 1), self.bucket.maxlen)):
+            self.bucket.append(set())
+        self.inizio_bucket = adesso
+
+    def filtra(self, chiavi):
+        """Restituisce le posizioni delle chiavi già presenti nella finestra o ripetute nella lista stessa."""
+        with self.lock:
+            self._ruota()
+            viste = set()
+            duplicate = set()
+            for posizione, chiave in enumerate(chiavi):
+                if chiave in viste or any(chiave in bucket for bucket in self.bucket):
+                    duplicate.add(posizione)
+                viste.add(chiave)
+            self.duplicate += len(duplicate)
+            return duplicate
+
+    def registra(self, chiavi):
+        # Da chiamare solo a commit avvenuto: una chiave di una transazione annullata non è un duplicato
+        with self.lock:
+            for chiave in chiavi:
+                self._ruota()
+                self.bucket[-1].add(chiave)
+                self.nuove += 1
+
+    def conta_duplicate_db(self, n):
+        with self.lock:
+            self.duplicate_db += n
+
+    def statistiche(self):
+        with self.lock:
+            duplicate = self.duplicate + self.duplicate_db
+            totale = self.nuove + duplicate
+            return {
+                'chiavi': sum(len(bucket) for bucket in self.bucket),
+                'nuove': self.nuove,
+                'duplicate': self.duplicate,
+                'duplicate_db': self.duplicate_db,
+                'tasso_duplicati': duplicate / totale if totale else None,
+            }
+
+
+def chiave_rilevazione(id_sensore, epoch, valore):
+    return id_sensore, int(epoch), int(valore)
+
+
+finestra_duplicati = FinestraDuplicati(
+    settings.DUPLICATI_FINESTRA, settings.DUPLICATI_BUCKET, settings.DUPLICATI_MAX_CHIAVI
+)
@@ -0,0 +1,51 @@
+import csv
+import io
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from GestioneSensori.archivio import blocchi_serie
+from GestioneSensori.colonnare import CodificatoreColonnare
+
+INTESTAZIONE_CSV = ('id_sensore', 'dataora', 'valore', 'messaggio')
+
+
+def csv_rilevazioni(sensori, dal=None, al=None):
+    """CSV delle rilevazioni dei sensori in [dal, al) (secondi epoch), un blocco di righe alla volta."""
+    buffer = io.StringIO()
+    scrittore = csv.writer(buffer)
+    scrittore.writerow(INTESTAZIONE_CSV)
+    for id_sensore in sensori:
+        for blocco in blocchi_serie(id_sensore, dal, al, settings.EXPORT_BLOCCO):
+            dataora = np.asarray(blocco['dataora'], dtype='datetime64[s]').astype(str)
+            messaggi = blocco['messaggi']
+            scrittore.writerows(
+                (id_sensore, dataora[i] + 'Z', valore, messaggi[codice] if codice >= 0 else '')
+                for i, (valore, codice) in enumerate(zip(blocco['valore'].tolist(), blocco['messaggio'].tolist()))
+            )
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def colonnare_rilevazioni(sensori, dal=None, al=None):
+    """Le stesse rilevazioni nel formato binario colonnare (vedi colonnare.py)."""
+    codificatore = CodificatoreColonnare()
+    yield codificatore.intestazione()
+    for id_sensore in sensori:
+        for blocco in blocchi_serie(id_sensore, dal, al, settings.EXPORT_BLOCCO):
+            yield codificatore.blocco(id_sensore, blocco['dataora'], blocco['valore'], blocco['messaggio'],
+                                      blocco['messaggi'])
+    yield codificatore.fine()
+
+
+def comprimi_gzip(blocchi, livello=6):
+    compressore = zlib.compressobj(livello, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for blocco in blocchi:
+        compresso = compressore.compress(blocco)
+        if compresso:
+            yield compresso
+    yield compressore.flush()
@@ -0,0 +1,288 @@
+import zlib
+
+from django.db import connection, transaction, IntegrityError
+
+from GestioneSensori.duplicati import finestra_duplicati, chiave_rilevazione
+from GestioneSensori.models import Stringa, Rilevazione, Eccezione, cache_sensori
+from GestioneSensori.parser_stringhe import parse_batch, id_sensore_stringa, da_epoch, letture_colonne
+from GestioneSensori.signals import rilevazioni_salvate
+
+MAX_LEN_STRINGA = Stringa._meta.get_field('stringa').max_length
+
+# Una riga più lunga di così non può essere una stringa valida: viene scartata senza accumularla in memoria
+MAX_LEN_RIGA = 4 * MAX_LEN_STRINGA
+MAX_ERRORI_RIEPILOGO = 1000
+
+QUERY_ULTIMO_ID = {
+    # MySQL restituisce l'id della prima riga della INSERT multi-riga, SQLite quello dell'ultima
+    'mysql': ('SELECT LAST_INSERT_ID();', 0),
+    'sqlite': ('SELECT last_insert_rowid();', 1),
+}
+
+
+def bulk_create_con_id(model, objs):
+    if not objs or connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    query, da_ultimo = QUERY_ULTIMO_ID[connection.vendor]
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    batch_size = connection.ops.bulk_batch_size(fields, objs) or len(objs)
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        model.objects.bulk_create(batch)
+        # Le righe di una stessa INSERT ricevono id consecutivi (innodb_autoinc_lock_mode <= 1 su MySQL)
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            primo_id = cursor.fetchone()[0] - da_ultimo * (len(batch) - 1)
+        for i, obj in enumerate(batch):
+            obj.pk = primo_id + i
+    return objs
+
+
+def analizza_stringhe(stringhe):
+    sensori = cache_sensori.get_many({id_sensore_stringa(string) for string in stringhe} - {None})
+    codici = {id_sensore: sensore['codice_errore'] for id_sensore, sensore in sensori.items()}
+    return parse_batch(stringhe, codici, max_len=MAX_LEN_STRINGA)
+
+
+def salva_stringhe(stringhe, traduci=True):
+    return salva_colonne(analizza_stringhe(stringhe), traduci=traduci)
+
+
+def salva_colonne(colonne, traduci=True, id_stringhe=None):
+    """
+    Salva le stringhe già scomposte da parse_batch. Con traduci=False vengono salvate solo le Stringa,
+    da tradurre in seguito con traduci_stringhe_mancanti; se id_stringhe è indicato le Stringa esistono
+    già (una per posizione) e vengono create solo le rilevazioni e le eccezioni.
+    """
+    esiti = [{'status': 'fail', 'message': errore} for errore in colonne['errore']]
+    indici = [i for i, errore in enumerate(colonne['errore']) if errore is None]
+    if not traduci:
+        _scrivi_stringhe(colonne, indici, [], id_stringhe, traduci=False)
+        for i in indici:
+            esiti[i] = {'status': 'ok'}
+        return esiti
+    # Una lettura per rilevazione: (posizione della stringa, chiave, epoch, valore, messaggio)
+    letture = [
+        (i, chiave_rilevazione(colonne['id_sensore'][i], dataora, valore), dataora, valore, messaggio)
+        for i in indici if not colonne['eccezione'][i]
+        for dataora, valore, messaggio in letture_colonne(colonne, i)
+    ]
+    duplicate = finestra_duplicati.filtra([lettura[1] for lettura in letture])
+    letture = [lettura for posizione, lettura in enumerate(letture) if posizione not in duplicate]
+    try:
+        _scrivi_stringhe(colonne, _da_scrivere(colonne, indici, letture), letture, id_stringhe)
+    except IntegrityError:
+        # Rilevazioni già salvate ma uscite dalla finestra (ad esempio dopo un riavvio): si scartano e si riprova
+        presenti = Rilevazione.chiavi_presenti([lettura[1] for lettura in letture])
+        nuove = [lettura for lettura in letture if lettura[1] not in presenti]
+        finestra_duplicati.conta_duplicate_db(len(letture) - len(nuove))
+        letture = nuove
+        try:
+            _scrivi_stringhe(colonne, _da_scrivere(colonne, indici, letture), letture, id_stringhe)
+        except IntegrityError:
+            # Un altro processo ha scritto le stesse rilevazioni nel frattempo: una alla volta, saltando i conflitti
+            scritte = _scrivi_stringhe(colonne, _da_scrivere(colonne, indici, letture), letture, id_stringhe,
+                                       una_alla_volta=True)
+            finestra_duplicati.conta_duplicate_db(len(letture) - len(scritte))
+            letture = scritte
+    return _esiti_salvataggio(esiti, colonne, indici, letture)
+
+
+def _da_scrivere(colonne, indici, letture):
+    # Si salvano le eccezioni e le stringhe con almeno una lettura non duplicata
+    con_letture = {lettura[0] for lettura in letture}
+    return [i for i in indici if colonne['eccezione'][i] or i in con_letture]
+
+
+def _esiti_salvataggio(esiti, colonne, indici, letture):
+    scritte = {}
+    for lettura in letture:
+        scritte[lettura[0]] = scritte.get(lettura[0], 0) + 1
+    for i in indici:
+        esiti[i] = {'status': 'ok'}
+        if colonne['eccezione'][i]:
+            continue
+        if i not in scritte:
+            esiti[i]['duplicata'] = True
+        if colonne['letture'][i] is not None:
+            esiti[i]['letture'] = scritte.get(i, 0)
+            esiti[i]['duplicate'] = len(colonne['letture'][i]) - scritte.get(i, 0)
+    return esiti
+
+
+def _scrivi_stringhe(colonne, indici, letture, id_stringhe=None, traduci=True, una_alla_volta=False):
+    """
+    Scrive stringhe, rilevazioni ed eccezioni in una transazione. Con una_alla_volta le rilevazioni già
+    presenti vengono saltate invece di far fallire tutto, e le stringhe nuove rimaste senza rilevazioni
+    non vengono salvate. Restituisce le letture scritte.
+    """
+    if not indici:
+        return letture
+    with transaction.atomic():
+        if id_stringhe is None:
+            oggetti = bulk_create_con_id(Stringa, [Stringa(stringa=colonne['stringa'][i]) for i in indici])
+            ids = dict(zip(indici, (stringa.id for stringa in oggetti)))
+        else:
+            ids = {i: id_stringhe[i] for i in indici}
+        if not traduci:
+            return letture
+        rilevazioni = [
+            Rilevazione(
+                stringa_id=ids[i],
+                sensore_id=colonne['id_sensore'][i],
+                messaggio=messaggio,
+                valore=valore,
+                dataora=da_epoch(dataora),
+            )
+            for i, _, dataora, valore, messaggio in letture
+        ]
+        eccezioni = [
+            Eccezione(
+                stringa_id=ids[i],
+                sensore_id=colonne['id_sensore'][i],
+                messaggio=colonne['messaggio'][i],
+            )
+            for i in indici if colonne['eccezione'][i]
+        ]
+        if una_alla_volta:
+            salvate = Rilevazione.salva_una_alla_volta(rilevazioni)
+            rilevazioni = [rilevazioni[posizione] for posizione in salvate]
+            letture = [letture[posizione] for posizione in salvate]
+            if id_stringhe is None:
+                vuote = set(indici) - set(_da_scrivere(colonne, indici, letture))
+                Stringa.objects.filter(id__in=[ids[i] for i in vuote]).delete()
+        else:
+            Rilevazione.objects.bulk_create(rilevazioni)
+        # Le eccezioni servono con l'id per aggiornare l'ultima eccezione del sensore
+        bulk_create_con_id(Eccezione, eccezioni)
+        rilevazioni_salvate.send(sender=Stringa, rilevazioni=rilevazioni, eccezioni=eccezioni)
+        scritte = [lettura[1] for lettura in letture]
+        transaction.on_commit(lambda: finestra_duplicati.registra(scritte))
+    return letture
+
+
+def traduci_stringhe_mancanti(da_id=0, dim_lotto=5000):
+    """
+    Crea rilevazioni ed eccezioni per le Stringa salvate senza traduzione (ad esempio da import_stringhe
+    con --senza-traduzione). Le stringhe che risultano duplicate vengono eliminate, quelle non valide
+    restano non tradotte. Restituisce il numero di stringhe tradotte, duplicate e non valide.
+    """
+    riepilogo = {'tradotte': 0, 'duplicate': 0, 'non_valide': 0}
+    ultimo_id = da_id - 1
+    while True:
+        righe = list(
+            Stringa.objects.filter(id__gt=ultimo_id, rilevazione__isnull=True, eccezione__isnull=True)
+            .order_by('id').values_list('id', 'stringa')[:dim_lotto]
+        )
+        if not righe:
+            return riepilogo
+        ultimo_id = righe[-1][0]
+        with transaction.atomic():
+            esiti = salva_colonne(analizza_stringhe([stringa for _, stringa in righe]),
+                                  id_stringhe=[id_stringa for id_stringa, _ in righe])
+            duplicate = [id_stringa for (id_stringa, _), esito in zip(righe, esiti) if esito.get('duplicata')]
+            Stringa.objects.filter(id__in=duplicate).delete()
+        riepilogo['duplicate'] += len(duplicate)
+        riepilogo['non_valide'] += sum(1 for esito in esiti if esito['status'] != 'ok')
+        riepilogo['tradotte'] += sum(1 for esito in esiti if esito['status'] == 'ok' and not esito.get('duplicata'))
+
+
+def _decomprimi(stream, dim_blocco):
+    decompressore = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        blocco = stream.read(dim_blocco)
+        if not blocco:
+            break
+        dati = decompressore.decompress(blocco, dim_blocco)
+        while dati:
+            yield dati
+            dati = decompressore.decompress(decompressore.unconsumed_tail, dim_blocco)
+    dati = decompressore.flush()
+    if dati:
+        yield dati
+    if not decompressore.eof:
+        raise zlib.error('stream gzip troncato')
+
+
+def _leggi(stream, dim_blocco):
+    while True:
+        blocco = stream.read(dim_blocco)
+        if not blocco:
+            break
+        yield blocco
+
+
+def righe_da_stream(stream, compresso=False, dim_blocco=65536):
+    """
+    Legge uno stream di byte (eventualmente gzip) un blocco alla volta e restituisce le righe numerate
+    a partire da 1. Le righe non decodificabili o troppo lunghe vengono restituite come None.
+    """
+    blocchi = _decomprimi(stream, dim_blocco) if compresso else _leggi(stream, dim_blocco)
+    numero = 0
+    resto = b''
+    troppo_lunga = False
+    for blocco in blocchi:
+        righe = (resto + blocco).split(b'\n')
+        resto = righe.pop()
+        for riga in righe:
+            numero += 1
+            if troppo_lunga:
+                troppo_lunga = False
+                yield numero, None
+            else:
+                yield numero, _decodifica_riga(riga)
+        if len(resto) > MAX_LEN_RIGA:
+            troppo_lunga = True
+            resto = b''
+    if resto or troppo_lunga:
+        yield numero + 1, None if troppo_lunga else _decodifica_riga(resto)
+
+
+def _decodifica_riga(riga):
+    if len(riga) > MAX_LEN_RIGA:
+        return None
+    try:
+        return riga.rstrip(b'\r').decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+
+def salva_righe(righe, dim_lotto):
+    """
+    Salva le righe numerate a lotti di dim_lotto, ognuno nella propria transazione, e ne riassume l'esito.
+    Se il corpo gzip si rivela corrotto o troncato a metà, le righe lette fin lì vengono salvate comunque
+    e il riepilogo ha troncato a True: i lotti precedenti sono già stati scritti.
+    """
+    riepilogo = {'righe': 0, 'accettate': 0, 'rifiutate': 0, 'troncato': False, 'errori': []}
+    lotto = []
+
+    def salva_lotto():
+        esiti = salva_stringhe([stringa for _, stringa in lotto])
+        for (numero, _), esito in zip(lotto, esiti):
+            if esito['status'] == 'ok':
+                riepilogo['accettate'] += 1
+            else:
+                _rifiuta(riepilogo, numero, esito['message'])
+        del lotto[:]
+
+    try:
+        for numero, stringa in righe:
+            riepilogo['righe'] = numero
+            if stringa is None:
+                _rifiuta(riepilogo, numero, 'bad format')
+            elif stringa.strip():
+                lotto.append((numero, stringa))
+                if len(lotto) >= dim_lotto:
+                    salva_lotto()
+    except zlib.error:
+        riepilogo['troncato'] = True
+    if lotto:
+        salva_lotto()
+    riepilogo['errori'].sort(key=lambda errore: errore['riga'])
+    return riepilogo
+
+
+def _rifiuta(riepilogo, numero, messaggio):
+    riepilogo['rifiutate'] += 1
+    if len(riepilogo['errori']) < MAX_ERRORI_RIEPILOGO:
+        riepilogo['errori'].append({'riga': numero, 'message': messaggio})
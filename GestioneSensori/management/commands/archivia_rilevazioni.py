@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from GestioneSensori.archivio import archivia
+from GestioneSensori.models import AggregatoRilevazioni, Sensore
+
+
+class Command(BaseCommand):
+    help = 'Copia le rilevazioni storiche nell\'archivio colonnare (un segmento in più per sensore a ogni esecuzione)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensore', action='append', help='id del sensore (ripetibile)')
+        parser.add_argument('--ritardo-giorni', type=int, default=settings.ARCHIVIO_RITARDO_GIORNI,
+                            help='giorni più recenti da lasciare solo nel database')
+        parser.add_argument('--cartella', default=settings.ARCHIVIO_DIR)
+
+    def handle(self, *args, **options):
+        fino_a = AggregatoRilevazioni.inizio_bucket(
+            timezone.now() - timedelta(days=options['ritardo_giorni']), AggregatoRilevazioni.SCALA_GIORNO
+        )
+        sensori = options['sensore'] or list(Sensore.objects.order_by('id').values_list('id', flat=True))
+        totale = 0
+        for id_sensore in sensori:
+            archiviate = archivia(id_sensore, int(fino_a.timestamp()), options['cartella'])
+            if archiviate:
+                self.stdout.write('%s: %d rilevazioni archiviate' % (id_sensore, archiviate))
+            totale += archiviate
+        self.stdout.write('Archivio aggiornato fino al %s: %d rilevazioni' % (fino_a, totale))
@@ -0,0 +1,145 @@
+import asyncio
+from time import monotonic
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from GestioneSensori.coda_ingest import CodaIngest
+from GestioneSensori.ingest import MAX_LEN_RIGA
+
+
+class ProtocolloUDP(asyncio.DatagramProtocol):
+    def __init__(self, comando):
+        self.comando = comando
+
+    def datagram_received(self, data, addr):
+        for riga in data.split(b'\n'):
+            if riga.strip():
+                self.comando.accoda(riga, attendi=False)
+
+
+async def scarta_riga(reader):
+    # Scarta il resto di una riga troppo lunga, a capo compreso, senza accumularla in memoria
+    while True:
+        try:
+            await reader.readuntil(b'\n')
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
+
+
+class Command(BaseCommand):
+    help = 'Riceve le stringhe dei sensori su TCP e/o UDP (una per riga) e le salva a lotti'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--tcp', type=int, help='porta TCP su cui ascoltare')
+        parser.add_argument('--udp', type=int, help='porta UDP su cui ascoltare')
+        parser.add_argument('--lotto', type=int, default=settings.INGEST_FLUSH_ITEMS,
+                            help='numero massimo di stringhe per transazione')
+        parser.add_argument('--flush-ms', type=int, default=settings.INGEST_FLUSH_MS,
+                            help='attesa massima prima di salvare un lotto incompleto')
+        parser.add_argument('--coda', type=int, default=settings.INGEST_CODA_MAX,
+                            help='stringhe in attesa oltre le quali le connessioni TCP vengono rallentate')
+        parser.add_argument('--report', type=float, default=10, help='secondi tra due report')
+
+    def handle(self, *args, **options):
+        if options['tcp'] is None and options['udp'] is None:
+            raise CommandError('Specificare almeno una tra --tcp e --udp')
+        self.coda = CodaIngest(options['coda'], options['lotto'], options['flush_ms'])
+        self.righe_non_valide = 0
+        self.udp_perse = 0
+        self.connessioni = 0
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server_tcp = trasporto_udp = None
+        if options['tcp'] is not None:
+            server_tcp = loop.run_until_complete(asyncio.start_server(
+                self.gestisci_connessione, options['host'], options['tcp'], limit=MAX_LEN_RIGA
+            ))
+            self.stdout.write('In ascolto su tcp://%s:%d' % (options['host'], options['tcp']))
+        if options['udp'] is not None:
+            trasporto_udp, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+                lambda: ProtocolloUDP(self), local_addr=(options['host'], options['udp'])
+            ))
+            self.stdout.write('In ascolto su udp://%s:%d' % (options['host'], options['udp']))
+        self.coda.avvia()
+        self.ultimo_report = (monotonic(), 0)
+        report = loop.create_task(self.report(options['report']))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            report.cancel()
+            if server_tcp is not None:
+                server_tcp.close()
+                loop.run_until_complete(server_tcp.wait_closed())
+            if trasporto_udp is not None:
+                trasporto_udp.close()
+            self.coda.chiudi()
+            loop.close()
+            self.scrivi_report()
+
+    def accoda(self, riga, attendi=True):
+        try:
+            stringa = riga.rstrip(b'\r').decode('utf-8')
+        except UnicodeDecodeError:
+            self.righe_non_valide += 1
+            return True
+        if self.coda.accoda(stringa):
+            return True
+        if not attendi:
+            self.udp_perse += 1
+        return False
+
+    async def gestisci_connessione(self, reader, writer):
+        self.connessioni += 1
+        try:
+            while True:
+                try:
+                    riga = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    # Fine della connessione: l'ultima riga può non avere l'a capo
+                    riga = e.partial
+                except asyncio.LimitOverrunError:
+                    # Riga oltre il limite: viene scartata fino all'a capo e si continua con la successiva
+                    self.righe_non_valide += 1
+                    await scarta_riga(reader)
+                    continue
+                if not riga:
+                    break
+                riga = riga.rstrip(b'\n')
+                if not riga.strip():
+                    continue
+                # Con la coda piena si smette di leggere dal socket: il controllo di flusso TCP rallenta il mittente
+                while not self.accoda(riga):
+                    await asyncio.sleep(self.coda.flush_secondi)
+        except ConnectionError:
+            pass
+        finally:
+            self.connessioni -= 1
+            writer.close()
+
+    async def report(self, intervallo):
+        while True:
+            await asyncio.sleep(intervallo)
+            self.scrivi_report()
+
+    def scrivi_report(self):
+        stat = self.coda.statistiche()
+        adesso = monotonic()
+        elaborate = stat['scritte'] + stat['scartate']
+        inizio, elaborate_prima = self.ultimo_report
+        self.ultimo_report = (adesso, elaborate)
+        self.stdout.write(
+            '%.0f righe/s | scritte %d, scartate %d, non valide %d, udp perse %d | connessioni %d | '
+            'coda %d | lotto medio %s, latenza lotto %.1f ms' % (
+                (elaborate - elaborate_prima) / (adesso - inizio) if adesso > inizio else 0,
+                stat['scritte'], stat['scartate'], self.righe_non_valide, self.udp_perse,
+                self.connessioni, stat['profondita'],
+                '%.0f' % stat['media_lotto'] if stat['media_lotto'] else '-', stat['latenza_ultimo_lotto_ms'],
+            )
+        )
@@ -0,0 +1,55 @@
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from GestioneSensori.allarmi import MotoreAllarmi
+from GestioneSensori.models import RegolaAllarme
+from GestioneSensori.parser_stringhe import da_epoch
+
+
+def letture_sintetiche(sensori, righe):
+    generatore = np.random.default_rng(0)
+    valori = 500 + np.cumsum(generatore.integers(-5, 6, (sensori, righe)), axis=1)
+    return [
+        ('B%d' % sensore, 1, da_epoch(1483228800 + riga * 60), int(valori[sensore, riga]))
+        for riga in range(righe) for sensore in range(sensori)
+    ]
+
+
+def regole_sintetiche(generi):
+    # Regole per tipo (id 1), non salvate: il benchmark non usa il database
+    parametri = {
+        RegolaAllarme.SOGLIA: {'minimo': 450, 'massimo': 550},
+        RegolaAllarme.VARIAZIONE: {'variazione_max': 0.08},
+        RegolaAllarme.ZSCORE: {'finestra': 100, 'soglia_z': 3},
+    }
+    return [RegolaAllarme(id=i, genere=genere, tipo_id=1, **parametri[genere]) for i, genere in enumerate(generi, 1)]
+
+
+class Command(BaseCommand):
+    help = 'Misura il tempo aggiunto per rilevazione dalla valutazione delle regole di allarme'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensori', type=int, default=100)
+        parser.add_argument('--righe', type=int, default=1000, help='rilevazioni per sensore')
+        parser.add_argument('--lotto', type=int, default=500, help='rilevazioni per salvataggio, come all\'ingest')
+
+    def handle(self, *args, **options):
+        letture = letture_sintetiche(options['sensori'], options['righe'])
+        lotto = options['lotto']
+        prove = [('nessuna', [])] + [(genere, [genere]) for genere, _ in RegolaAllarme.GENERI] + \
+            [('tutte', [genere for genere, _ in RegolaAllarme.GENERI])]
+        self.stdout.write('%d rilevazioni, lotti di %d' % (len(letture), lotto))
+        self.stdout.write('%-12s %12s %10s' % ('regole', 'us/lettura', 'allarmi'))
+        for nome, generi in prove:
+            regole = regole_sintetiche(generi)
+            motore = MotoreAllarmi(lambda: regole, lambda sensori: {}, ttl=3600)
+            allarmi = 0
+            inizio = perf_counter()
+            for i in range(0, len(letture), lotto):
+                nuovi_allarmi, nuovi = motore.valuta(letture[i:i + lotto])
+                motore.applica(nuovi)
+                allarmi += len(nuovi_allarmi)
+            durata = perf_counter() - inizio
+            self.stdout.write('%-12s %12.2f %10d' % (nome, durata / len(letture) * 1e6, allarmi))
@@ -0,0 +1,77 @@
+import gzip
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.fields import DateTimeField
+from rest_framework.renderers import JSONRenderer
+
+from GestioneSensori.archivio import leggi_serie
+from GestioneSensori.colonnare import SerieColonnare, decodifica
+from GestioneSensori.parser_stringhe import da_epoch
+
+
+def serie_sintetica(righe):
+    generatore = np.random.default_rng(0)
+    dataora = 1483228800 + np.cumsum(generatore.integers(1, 120, righe))
+    valore = (500 + np.cumsum(generatore.integers(-5, 6, righe))).astype(np.int32)
+    messaggio = np.where(generatore.random(righe) < 0.05, generatore.integers(0, 3, righe), -1).astype(np.int32)
+    return {'dataora': dataora, 'valore': valore, 'messaggio': messaggio, 'messaggi': ['ok', 'basso', 'alto']}
+
+
+def cronometra(funzione, ripetizioni):
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = perf_counter()
+        risultato = funzione()
+        durata = perf_counter() - inizio
+        migliore = durata if migliore is None else min(migliore, durata)
+    return risultato, migliore
+
+
+class Command(BaseCommand):
+    help = 'Confronta dimensione e tempo di codifica delle rilevazioni in JSON e nel formato colonnare'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--righe', type=int, default=100000, help='righe della serie sintetica')
+        parser.add_argument('--sensore', help='usa le rilevazioni di questo sensore invece di una serie sintetica')
+        parser.add_argument('--ripetizioni', type=int, default=3)
+
+    def handle(self, *args, **options):
+        id_sensore = options['sensore'] or 'sintetico'
+        serie = leggi_serie(id_sensore) if options['sensore'] else serie_sintetica(options['righe'])
+        if not len(serie['dataora']):
+            raise CommandError('Nessuna rilevazione per il sensore %s' % id_sensore)
+        dataora_json = DateTimeField().to_representation
+        messaggi = serie['messaggi']
+
+        def json():
+            # Come rilevazioni_api: un dizionario per riga, poi JSONRenderer
+            return JSONRenderer().render([
+                {
+                    'id_sensore': id_sensore,
+                    'dataora': dataora_json(da_epoch(dataora)),
+                    'valore': valore,
+                    'messaggio': messaggi[codice] if codice >= 0 else None,
+                }
+                for dataora, valore, codice in zip(
+                    serie['dataora'].tolist(), serie['valore'].tolist(), serie['messaggio'].tolist()
+                )
+            ])
+
+        def colonnare():
+            return SerieColonnare([
+                (id_sensore, serie['dataora'], serie['valore'], serie['messaggio'], messaggi)
+            ]).codifica()
+
+        righe = len(serie['dataora'])
+        self.stdout.write('%d righe, migliore di %d ripetizioni' % (righe, options['ripetizioni']))
+        self.stdout.write('%-10s %12s %12s %14s' % ('formato', 'byte', 'byte gzip', 'codifica ms'))
+        for nome, funzione in (('json', json), ('colonnare', colonnare)):
+            dati, durata = cronometra(funzione, options['ripetizioni'])
+            self.stdout.write('%-10s %12d %12d %14.1f' % (nome, len(dati), len(gzip.compress(dati)), durata * 1000))
+            if nome == 'colonnare':
+                decodificata, durata = cronometra(lambda: decodifica(dati), options['ripetizioni'])
+                if not np.array_equal(decodificata['valore'], serie['valore']):
+                    raise CommandError('La decodifica non restituisce la serie codificata')
+                self.stdout.write('%-10s %40.1f' % ('decodifica', durata * 1000))
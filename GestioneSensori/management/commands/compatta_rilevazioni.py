@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand
+
+from GestioneSensori.conservazione import politica_conservazione, limite_conservazione, dimensione_media_riga, \
+    aggregati_mancanti, completa_aggregati, stima_rilevazioni, stima_aggregati, elimina_rilevazioni, elimina_aggregati
+from GestioneSensori.models import AggregatoRilevazioni, Rilevazione, Sensore, Stringa, TipoSensore
+
+
+def formatta_byte(n):
+    if n is None:
+        return 'n/d'
+    for unita in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '%.1f %s' % (n, unita)
+        n /= 1024
+    return '%.1f TB' % n
+
+
+def descrivi_limite(limite):
+    return 'conservate per sempre' if limite is None else 'fino al %s' % limite.date()
+
+
+class Command(BaseCommand):
+    help = 'Applica la politica di conservazione: elimina rilevazioni e aggregati più vecchi dei limiti configurati'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='mostra cosa verrebbe eliminato senza eliminare')
+        parser.add_argument('--tipo', action='append', help='limita ai sensori di questo tipo (ripetibile)')
+        parser.add_argument('--lotto', type=int, help='righe eliminate per transazione')
+        parser.add_argument('--pausa-ms', type=int, help='pausa tra due lotti, per non rallentare l\'ingest')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.options = options
+        self.totali = {'rilevazioni': 0, 'stringhe': 0, 'aggregati': 0}
+        tipi = TipoSensore.objects.all()
+        if options['tipo']:
+            tipi = tipi.filter(tipo__in=options['tipo'])
+        for tipo in tipi:
+            self.compatta_tipo(tipo)
+        byte = [dimensione_media_riga(model) for model in (Rilevazione, Stringa, AggregatoRilevazioni)]
+        stima = None if None in byte else (
+            self.totali['rilevazioni'] * byte[0] + self.totali['stringhe'] * byte[1] + self.totali['aggregati'] * byte[2]
+        )
+        self.stdout.write('%s: %d rilevazioni, %d stringhe, %d aggregati (circa %s)' % (
+            'Da eliminare' if self.dry_run else 'Eliminati',
+            self.totali['rilevazioni'], self.totali['stringhe'], self.totali['aggregati'], formatta_byte(stima)
+        ))
+
+    def compatta_tipo(self, tipo):
+        politica = politica_conservazione(tipo.tipo)
+        limite = limite_conservazione(politica['rilevazioni'])
+        limiti_aggregati = {
+            scala: limite_conservazione(giorni) for scala, giorni in sorted(politica['aggregati'].items())
+        }
+        self.stdout.write('Tipo %s: rilevazioni %s, %s' % (
+            tipo.tipo, descrivi_limite(limite),
+            ', '.join('aggregati %ds %s' % (scala, descrivi_limite(lim)) for scala, lim in limiti_aggregati.items())
+        ))
+        for id_sensore in Sensore.objects.filter(tipo=tipo).order_by('id').values_list('id', flat=True):
+            conteggi = {'rilevazioni': 0, 'stringhe': 0, 'aggregati': 0}
+            if limite is not None:
+                if aggregati_mancanti(id_sensore, limite):
+                    # Prima di eliminare i dati grezzi gli aggregati devono essere completi
+                    self.stdout.write('  %s: aggregati da ricostruire prima dell\'eliminazione' % id_sensore)
+                    if not self.dry_run:
+                        completa_aggregati(id_sensore, limite)
+                if self.dry_run:
+                    conteggi.update(stima_rilevazioni(id_sensore, limite))
+                else:
+                    conteggi.update(elimina_rilevazioni(
+                        id_sensore, limite, self.options['lotto'], self.options['pausa_ms']
+                    ))
+            for scala, limite_scala in limiti_aggregati.items():
+                if limite_scala is None:
+                    continue
+                if self.dry_run:
+                    conteggi['aggregati'] += stima_aggregati(id_sensore, scala, limite_scala)
+                else:
+                    conteggi['aggregati'] += elimina_aggregati(
+                        id_sensore, scala, limite_scala, self.options['lotto'], self.options['pausa_ms']
+                    )
+            if any(conteggi.values()):
+                self.stdout.write('  %s: %d rilevazioni, %d stringhe, %d aggregati' % (
+                    id_sensore, conteggi['rilevazioni'], conteggi['stringhe'], conteggi['aggregati']
+                ))
+            for chiave in self.totali:
+                self.totali[chiave] += conteggi[chiave]
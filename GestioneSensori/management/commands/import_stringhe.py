@@ -0,0 +1,135 @@
+import gzip
+import os
+from collections import deque
+from multiprocessing import Pool
+from time import monotonic
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from GestioneSensori.ingest import MAX_LEN_STRINGA, salva_colonne, traduci_stringhe_mancanti
+from GestioneSensori.models import Sensore, Stringa
+from GestioneSensori.parser_stringhe import parse_batch
+
+codici_errore = {}
+
+
+def _inizializza_worker(codici):
+    global codici_errore
+    codici_errore = codici
+
+
+def _analizza_blocco(righe):
+    stringhe = []
+    for riga in righe:
+        try:
+            stringhe.append(riga.rstrip(b'\r\n').decode('utf-8'))
+        except UnicodeDecodeError:
+            stringhe.append(None)
+    return parse_batch(stringhe, codici_errore, max_len=MAX_LEN_STRINGA)
+
+
+def apri(percorso):
+    with open(percorso, 'rb') as f:
+        compresso = f.read(2) == b'\x1f\x8b'
+    return gzip.open(percorso, 'rb') if compresso else open(percorso, 'rb')
+
+
+def blocchi(f, dim_blocco):
+    """Restituisce blocchi di righe non vuote insieme all'offset (in byte non compressi) a fine blocco."""
+    righe = []
+    for riga in f:
+        if riga.strip():
+            righe.append(riga)
+        if len(righe) >= dim_blocco:
+            yield righe, f.tell()
+            righe = []
+    if righe:
+        yield righe, f.tell()
+
+
+class Command(BaseCommand):
+    help = 'Importa file di log (anche gzip) con una stringa per riga, salvandoli con insert multi-riga'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='+')
+        parser.add_argument('--da-byte', type=int, default=0,
+                            help='riprende il primo file da questo offset (byte non compressi)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='processi che scompongono le stringhe (0 = nel processo principale)')
+        parser.add_argument('--lotto', type=int, default=5000, help='righe per insert multi-riga')
+        parser.add_argument('--transazione', type=int, default=100000, help='righe per transazione')
+        parser.add_argument('--senza-traduzione', action='store_true',
+                            help='salva solo le stringhe e crea rilevazioni ed eccezioni alla fine')
+        parser.add_argument('--traduci-da-id', type=int,
+                            help="con --senza-traduzione, id della prima stringa da tradurre "
+                                 "(per riprendere dopo un'interruzione)")
+
+    def handle(self, *args, **options):
+        for percorso in options['file']:
+            if not os.path.isfile(percorso):
+                raise CommandError('File non trovato: %s' % percorso)
+        codici = dict(Sensore.objects.values_list('id', 'codice_errore'))
+        traduci = not options['senza_traduzione']
+        primo_id = options['traduci_da_id']
+        if not traduci and primo_id is None:
+            primo_id = (Stringa.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+            self.stdout.write('Le stringhe importate partono dall\'id %d (--traduci-da-id)' % primo_id)
+        # I worker non usano il database: la connessione non deve essere condivisa con i processi figli
+        connections.close_all()
+        self.workers = options['workers']
+        pool = Pool(self.workers, _inizializza_worker, (codici,)) if self.workers else None
+        if pool is None:
+            _inizializza_worker(codici)
+        self.totale = {'righe': 0, 'accettate': 0, 'rifiutate': 0}
+        self.inizio = monotonic()
+        try:
+            for n, percorso in enumerate(options['file']):
+                self.importa(percorso, options['da_byte'] if n == 0 else 0, pool, traduci, options)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if not traduci:
+            self.stdout.write('Traduzione delle stringhe importate...')
+            riepilogo = traduci_stringhe_mancanti(primo_id, options['lotto'])
+            self.stdout.write('Tradotte %(tradotte)d, duplicate %(duplicate)d, non valide %(non_valide)d' % riepilogo)
+        self.stdout.write('Import completato: %d righe, %d accettate, %d rifiutate in %.1f s' % (
+            self.totale['righe'], self.totale['accettate'], self.totale['rifiutate'], monotonic() - self.inizio
+        ))
+
+    def importa(self, percorso, da_byte, pool, traduci, options):
+        with apri(percorso) as f:
+            f.seek(da_byte)
+            risultati = deque()
+            in_transazione = []
+            for righe, offset in blocchi(f, options['lotto']):
+                if pool is None:
+                    in_transazione.append((_analizza_blocco(righe), offset))
+                else:
+                    # Si tengono in volo pochi blocchi per worker, così il file non viene caricato in memoria
+                    risultati.append((pool.apply_async(_analizza_blocco, (righe,)), offset))
+                    while len(risultati) > 2 * self.workers:
+                        risultato, offset_blocco = risultati.popleft()
+                        in_transazione.append((risultato.get(), offset_blocco))
+                if sum(len(colonne['stringa']) for colonne, _ in in_transazione) >= options['transazione']:
+                    self.salva(percorso, in_transazione, traduci)
+                    in_transazione = []
+            while risultati:
+                risultato, offset_blocco = risultati.popleft()
+                in_transazione.append((risultato.get(), offset_blocco))
+            if in_transazione:
+                self.salva(percorso, in_transazione, traduci)
+
+    def salva(self, percorso, blocchi_analizzati, traduci):
+        with transaction.atomic():
+            for colonne, _ in blocchi_analizzati:
+                esiti = salva_colonne(colonne, traduci=traduci)
+                accettate = sum(1 for esito in esiti if esito['status'] == 'ok')
+                self.totale['righe'] += len(esiti)
+                self.totale['accettate'] += accettate
+                self.totale['rifiutate'] += len(esiti) - accettate
+        durata = monotonic() - self.inizio
+        self.stdout.write('%s: %d righe (%.0f righe/s), riprendere con --da-byte %d' % (
+            percorso, self.totale['righe'], self.totale['righe'] / durata if durata else 0, blocchi_analizzati[-1][1]
+        ))
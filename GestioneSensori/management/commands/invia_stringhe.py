@@ -0,0 +1,41 @@
+import socket
+import sys
+from time import monotonic
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Client di prova per ascolta_sensori: invia le righe di un file (o dello standard input) via TCP o UDP'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', default='-', help="file con una stringa per riga ('-' per stdin)")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--tcp', type=int)
+        parser.add_argument('--udp', type=int)
+        parser.add_argument('--ripeti', type=int, default=1, help='numero di volte in cui inviare il file')
+
+    def handle(self, *args, **options):
+        if (options['tcp'] is None) == (options['udp'] is None):
+            raise CommandError('Specificare una sola tra --tcp e --udp')
+        if options['file'] == '-':
+            righe = sys.stdin.buffer.read().splitlines()
+        else:
+            with open(options['file'], 'rb') as f:
+                righe = f.read().splitlines()
+        righe = [riga for riga in righe if riga.strip()]
+        inizio = monotonic()
+        if options['tcp'] is not None:
+            with socket.create_connection((options['host'], options['tcp'])) as sock:
+                for _ in range(options['ripeti']):
+                    sock.sendall(b'\n'.join(righe) + b'\n')
+        else:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                for _ in range(options['ripeti']):
+                    for riga in righe:
+                        sock.sendto(riga + b'\n', (options['host'], options['udp']))
+        durata = monotonic() - inizio
+        inviate = len(righe) * options['ripeti']
+        self.stdout.write('Inviate %d righe in %.2f s (%.0f righe/s)' % (
+            inviate, durata, inviate / durata if durata else 0
+        ))
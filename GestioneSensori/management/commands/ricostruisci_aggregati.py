@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from GestioneSensori.aggregati import ricostruisci_aggregati
+from GestioneSensori.models import Sensore
+
+
+def data(valore):
+    try:
+        return timezone.make_aware(datetime.strptime(valore, '%Y-%m-%d'), timezone.utc)
+    except ValueError:
+        raise CommandError('Data non valida (formato AAAA-MM-GG): %s' % valore)
+
+
+class Command(BaseCommand):
+    help = 'Ricalcola dalle rilevazioni gli aggregati per minuto, ora e giorno (es. dopo cancellazioni o import)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensore', action='append', help='id del sensore (ripetibile)')
+        parser.add_argument('--dal', help='primo giorno da ricalcolare (AAAA-MM-GG, UTC)')
+        parser.add_argument('--al', help='ultimo giorno da ricalcolare (AAAA-MM-GG, UTC)')
+
+    def handle(self, *args, **options):
+        dal = data(options['dal']) if options['dal'] else None
+        al = data(options['al']) if options['al'] else None
+        sensori = options['sensore'] or list(Sensore.objects.order_by('id').values_list('id', flat=True))
+        for id_sensore in sensori:
+            ricostruisci_aggregati(id_sensore, dal, al)
+            self.stdout.write('Sensore %s: aggregati ricalcolati' % id_sensore)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from GestioneSensori.contatori_eccezioni import ricostruisci_contatori
+
+
+class Command(BaseCommand):
+    help = 'Ricalcola dalle eccezioni i totali per impianto e sensore e le eccezioni recenti della dashboard ' \
+           '(i contatori per giorno partono dal primo ingest e non vengono ricalcolati)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--impianto', type=int, action='append', help='id dell\'impianto (ripetibile)')
+
+    def handle(self, *args, **options):
+        impianti = ricostruisci_contatori(options['impianto'])
+        self.stdout.write('Contatori delle eccezioni ricalcolati per %d impianti' % len(impianti))
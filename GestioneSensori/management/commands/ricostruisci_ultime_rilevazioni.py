@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from GestioneSensori.models import Sensore
+from GestioneSensori.ultime_rilevazioni import ricostruisci_ultime
+
+
+class Command(BaseCommand):
+    help = 'Ricalcola dalle rilevazioni l\'ultima rilevazione ed eccezione di ogni sensore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensore', action='append', help='id del sensore (ripetibile)')
+
+    def handle(self, *args, **options):
+        sensori = options['sensore'] or list(Sensore.objects.order_by('id').values_list('id', flat=True))
+        for id_sensore in sensori:
+            ricostruisci_ultime(id_sensore)
+        self.stdout.write('Ultime rilevazioni ricalcolate per %d sensori' % len(sensori))
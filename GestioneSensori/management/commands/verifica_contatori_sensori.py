@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from GestioneSensori.contatori_sensori import verifica_contatori
+
+
+class Command(BaseCommand):
+    help = 'Confronta i contatori dei sensori per impianto e tipo con le installazioni e corregge quelli sbagliati'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='mostra le differenze senza correggerle')
+
+    def handle(self, *args, **options):
+        differenze = verifica_contatori(correggi=not options['dry_run'])
+        for id_impianto, (num_sensori, salvati, attesi) in sorted(differenze.items()):
+            self.stdout.write('impianto %d: %d sensori, per tipo %s; attesi %d, per tipo %s' % (
+                id_impianto, num_sensori, salvati, sum(attesi.values()), attesi
+            ))
+        self.stdout.write('%d impianti con contatori %s' % (
+            len(differenze), 'sbagliati' if options['dry_run'] else 'corretti'
+        ))
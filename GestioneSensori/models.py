@@ -1,16 +1,32 @@
-from datetime import datetime, timedelta
-from re import split
+from datetime import timedelta
+from math import ceil
 
 from django.conf import settings
 from django.contrib.auth.models import User, AbstractUser
-from django.db import connection
-from django.db.models import Model, CharField, IntegerField, ForeignKey, CASCADE, DateTimeField, DateField, \
-    EmailField, ManyToManyField, OneToOneField, PROTECT
-from django.db.models.signals import post_save
+from django.db import transaction, IntegrityError
+from django.db.models import Model, CharField, IntegerField, BigIntegerField, ForeignKey, CASCADE, DateTimeField, \
+    DateField, EmailField, ManyToManyField, OneToOneField, PROTECT, SET_NULL, F, FloatField, BooleanField, Q, \
+    Prefetch
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
+from GestioneSensori.cache_sensori import CacheSensori
+from GestioneSensori.duplicati import finestra_duplicati, chiave_rilevazione
+from GestioneSensori.parser_stringhe import LEN_DATETIME, scomponi, completa_info, completa_compatta, da_epoch
+from GestioneSensori.signals import rilevazioni_salvate
+
+
+def campi_salvati(istanza, esclusi):
+    # I campi che save() riscrive su una riga esistente: quelli mantenuti con update() restano fuori,
+    # come quelli non caricati (save() senza update_fields fa lo stesso)
+    differiti = istanza.get_deferred_fields()
+    return [
+        campo.name for campo in istanza._meta.concrete_fields
+        if not campo.primary_key and campo.name not in esclusi and campo.attname not in differiti
+    ]
+
 
 class Azienda(Model):
     ragione_sociale = CharField(max_length=30)
@@ -39,9 +55,10 @@ class Utente(AbstractUser):
     sesso = CharField(max_length=1)
 
     def get_impianti(self):
-        if self.is_staff:
-            return Impianto.objects.all().order_by('-id')
-        return Impianto.objects.filter(user=self.id).order_by('-id')
+        impianti = Impianto.objects.all() if self.is_staff else Impianto.objects.filter(user=self.id)
+        return impianti.order_by('-id').prefetch_related(Prefetch(
+            'contatori_tipi', queryset=ContatoreTipiImpianto.objects.select_related('tipo').order_by('tipo__tipo')
+        ))
 
     def get_impianto_attivo(self):
         return Impianto.objects.get(id=self.impianto_attivo_id)
@@ -72,12 +89,24 @@ class Impianto(Model):
     address = CharField(max_length=100, blank=True)
     user = ForeignKey('Utente', on_delete=CASCADE, db_column='user')
     data_creazione = DateTimeField(default=timezone.now)
+    # Sensori installati ora, mantenuto da contatori_sensori.py insieme a ContatoreTipiImpianto
+    num_sensori = IntegerField(default=0, editable=False)
+
+    def save(self, *args, **kwargs):
+        # num_sensori si aggiorna solo con update() in contatori_sensori.py: un save non riscrive il valore letto
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campi_salvati(self, ('num_sensori',))
+        super(Impianto, self).save(*args, **kwargs)
 
     def get_sensori(self):
         return Sensore.objects.raw(
-            'SELECT `sensori`.`id`, `sensori`.`tipo`, `sensori`.`marca`, `sensori`.`codice_errore` '
+            'SELECT `sensori`.`id`, `sensori`.`tipo`, `sensori`.`marca`, `sensori`.`codice_errore`, '
+            '`sensori`.`ultimo_contatto`, '
+            '`ultime_rilevazioni`.`dataora` AS `ultima_dataora`, `ultime_rilevazioni`.`valore` AS `ultimo_valore`, '
+            '`ultime_rilevazioni`.`messaggio` AS `ultimo_messaggio` '
             'FROM `sensori` '
             'INNER JOIN `installazioni` ON (`sensori`.`id` = `installazioni`.`sensore`) '
+            'LEFT JOIN `ultime_rilevazioni` ON (`sensori`.`id` = `ultime_rilevazioni`.`sensore`) '
             'WHERE (`installazioni`.`impianto` = %s AND installazioni.data_fine IS NULL)'
             'ORDER BY `sensori`.`data_creazione` DESC;',
             [self.id]
@@ -88,28 +117,60 @@ class Impianto(Model):
             .exclude(id__in=self.get_sensori()).distinct()
 
     def get_num_sensori(self):
-        return len(list(self.get_sensori()))
+        return self.num_sensori
 
     def get_tipi_sensori(self):
-        # return TipoSensore.objects.all().select_related().values('id', 'tipo')
-        # .annotate(num=Count('sensore__id_sensore'))  -- (peccato che non vada bene xD)
-        cursor = connection.cursor()
-        cursor.execute(
-            'SELECT DISTINCT `tipi_sensori`.`tipo`, COUNT(`sensori`.`tipo`) FROM `sensori` '
-            'INNER JOIN `installazioni` ON (`sensori`.`id` = `installazioni`.`sensore`) '
-            'INNER JOIN `tipi_sensori` ON (`sensori`.`tipo` = `tipi_sensori`.`id`) '
-            'WHERE (`installazioni`.`impianto` = %s AND `installazioni`.`data_fine` IS NULL) '
-            'GROUP BY tipo '
-            'ORDER BY tipo;',
-            [self.id]
-        )
-        return list(dict(tipo=result[0], num=result[1]) for result in cursor.fetchall())
+        # Dai contatori per tipo, già letti se l'impianto arriva da Utente.get_impianti
+        if 'contatori_tipi' in getattr(self, '_prefetched_objects_cache', {}):
+            contatori = self.contatori_tipi.all()
+        else:
+            contatori = self.contatori_tipi.select_related('tipo').order_by('tipo__tipo')
+        return [dict(tipo=contatore.tipo.tipo, num=contatore.num) for contatore in contatori]
+
+    def get_andamento(self, dal, al, scala=None):
+        scala = scala or AggregatoRilevazioni.scegli_scala(dal, al)
+        return AggregatoRilevazioni.objects.filter(
+            sensore__installazione__impianto=self.id, sensore__installazione__data_fine__isnull=True,
+            scala=scala, inizio__gte=AggregatoRilevazioni.inizio_bucket(dal, scala), inizio__lt=al
+        ).order_by('sensore_id', 'inizio')
+
+    def get_eccezioni_recenti(self, n=10):
+        ids = EccezioneRecente.objects.filter(impianto=self.id).order_by('-eccezione') \
+            .values_list('eccezione', flat=True)[:n]
+        return Eccezione.objects.filter(id__in=list(ids)).select_related('sensore').order_by('-id')
+
+    def get_eccezioni_per_sensore(self):
+        return TotaleEccezioni.objects.filter(impianto=self.id).order_by('sensore_id') \
+            .values('sensore', num=F('conteggio'))
+
+    def get_eccezioni_per_giorno(self, dal, al):
+        return ContatoreEccezioniImpianto.objects.filter(impianto=self.id, giorno__gte=dal, giorno__lte=al) \
+            .order_by('giorno').values_list('giorno', 'conteggio')
+
+    def get_statistiche(self, dal, al):
+        # Statistiche delle rilevazioni dei sensori attivi in [dal, al), per sensore, tipo e impianto
+        from GestioneSensori.statistiche import statistiche_sensori  # statistiche importa i modelli
+        return statistiche_sensori([sensore.id for sensore in self.get_sensori()],
+                                   int(dal.timestamp()), int(ceil(al.timestamp())))
+
+    def get_sensori_attivi(self, ore=24):
+        # Sensori che hanno inviato stringhe all'impianto nelle ultime ore (anche se poi spostati altrove)
+        limite = timezone.now() - timedelta(hours=ore)
+        return Sensore.objects.filter(
+            installazione__impianto=self.id, installazione__ultimo_contatto__gte=limite
+        ).distinct()
+
+    def get_sensori_silenziosi(self, ore=24):
+        # Sensori installati ora nell'impianto che non inviano stringhe da almeno ore (o non ne hanno mai inviate)
+        limite = timezone.now() - timedelta(hours=ore)
+        return Sensore.objects.filter(
+            Q(installazione__ultimo_contatto__lt=limite) | Q(installazione__ultimo_contatto__isnull=True),
+            installazione__impianto=self.id, installazione__data_fine__isnull=True
+        ).distinct()
 
     def get_sensori_attivi_24h(self):
-        date_from = timezone.now() - timedelta(days=1)
-        sensori24h = Sensore.objects.filter(impianto=self.id).distinct().select_related() \
-            .filter(rilevazione__dataora__gte=date_from)
-        return {'sensori24h': sensori24h, 'num': sensori24h.count()}
+        sensori24h = list(self.get_sensori_attivi(24))
+        return {'sensori24h': sensori24h, 'num': len(sensori24h)}
 
     def __str__(self):
         return self.name
@@ -124,12 +185,20 @@ class Installazione(Model):
     sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
     data_inizio = DateTimeField(default=timezone.now)  # default=datetime.now()
     data_fine = DateTimeField(null=True)
+    ultimo_contatto = DateTimeField(null=True, editable=False)  # ultima stringa ricevuta in questa installazione
+
+    def save(self, *args, **kwargs):
+        # ultimo_contatto avanza solo con update() in ultimo_contatto.py: un save non lo riporta indietro
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campi_salvati(self, ('ultimo_contatto',))
+        super(Installazione, self).save(*args, **kwargs)
 
     def __str__(self):
         return str(self.id)
 
     class Meta:
         db_table = 'installazioni'
+        index_together = ('impianto', 'ultimo_contatto')
 
 
 class TipoSensore(Model):
@@ -161,6 +230,14 @@ class Sensore(Model):
     codice_errore = CharField(max_length=30)
     impianto = ManyToManyField(Impianto, through='Installazione')
     data_creazione = DateTimeField(default=timezone.now)
+    # Arrivo dell'ultima stringa (rilevazione o eccezione), aggiornato all'ingest da ultimo_contatto.py
+    ultimo_contatto = DateTimeField(null=True, db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # Come Installazione.save: ultimo_contatto non si riscrive con il valore letto
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campi_salvati(self, ('ultimo_contatto',))
+        super(Sensore, self).save(*args, **kwargs)
 
     def get_last_installazione(self):
         return Installazione.objects.filter(impianto=self.impianto.last().id, sensore=self.id).last()
@@ -169,9 +246,24 @@ class Sensore(Model):
         return Rilevazione.objects.filter(
             sensore__id=self.id).exclude(valore__isnull=True).order_by('-dataora')
 
+    def get_andamento(self, dal, al, scala=None):
+        scala = scala or AggregatoRilevazioni.scegli_scala(dal, al)
+        return AggregatoRilevazioni.objects.filter(
+            sensore=self.id, scala=scala, inizio__gte=AggregatoRilevazioni.inizio_bucket(dal, scala), inizio__lt=al
+        ).order_by('inizio')
+
     def get_last_rilevazione(self):
-        last_ril = Rilevazione.objects.filter(sensore__id=self.id).last()
-        return last_ril if last_ril is not None else False
+        if 'ultima_dataora' in self.__dict__:
+            # Valori già letti insieme al sensore (Impianto.get_sensori): le colonne della raw query
+            # non passano dai converter del campo, la dataora arriva naive in UTC
+            dataora = self.ultima_dataora
+            if dataora is not None and timezone.is_naive(dataora):
+                dataora = timezone.make_aware(dataora, timezone.utc)
+            last_ril = UltimaRilevazione(sensore_id=self.id, dataora=dataora,
+                                         valore=self.ultimo_valore, messaggio=self.ultimo_messaggio)
+        else:
+            last_ril = UltimaRilevazione.objects.filter(sensore=self.id).first()
+        return last_ril if last_ril is not None and last_ril.dataora is not None else False
 
     def get_impianto(self):
         return self.impianto.last()
@@ -190,60 +282,77 @@ class Sensore(Model):
         ordering = ['data_creazione']
 
 
+class StringaDuplicata(Exception):
+    pass
+
+
 class Stringa(Model):
-    stringa = CharField(max_length=200)
-    LEN_DATETIME = 14
+    stringa = CharField(max_length=2000)
+    LEN_DATETIME = LEN_DATETIME
 
     def get_info_stringa(self):
-        string = str(self.stringa)
-        split_space = split(' ', string)
-        id_sensore = split_space[0]
-        other = split_space[1]
-        split_ln = split('(\d+)', other)
-        numeric = split_ln[1]
-        messaggio = split_ln[2]
-        info = {
-            'stringa': string,
-            'id_sensore': id_sensore,
-            'messaggio': messaggio,
-            'numeric': numeric
-        }
-        sensore = Sensore.objects.get(id=info['id_sensore'])
-        if numeric == str(sensore.codice_errore):
-            return info
-        valore = numeric[self.LEN_DATETIME::]
-        dataora_str = numeric[0:self.LEN_DATETIME]
-        dataora_obj = timezone.make_aware(
-            datetime.strptime(dataora_str, '%Y%m%d%H%M%S'),
-            timezone.get_current_timezone()
-        )
-        info.update({
-            'dataora': dataora_obj,
-            'valore': valore,
-        })
-        return info
+        info = scomponi(str(self.stringa))
+        sensore = cache_sensori.get(info['id_sensore'])
+        if sensore is None:
+            raise Sensore.DoesNotExist('Sensore matching query does not exist.')
+        if 'letture' in info:
+            return completa_compatta(info)
+        return completa_info(info, sensore['codice_errore'])
 
     def traduci(self):
         info = self.get_info_stringa()
-        sensore = Sensore.objects.get(id=info['id_sensore'])
-        if info['numeric'] != str(sensore.codice_errore):
-            ril = Rilevazione()
-            ril.stringa_id = self.id
-            ril.sensore_id = info['id_sensore']
-            ril.messaggio = info.get('messaggio', 'Nessuno')
-            ril.valore = info['valore']
-            ril.dataora = info['dataora']
-            ril.save()
+        if 'letture' in info:
+            self.salva_letture(info['id_sensore'], info['letture'])
+        elif 'valore' in info:
+            self.salva_letture(info['id_sensore'], [{
+                'dataora': info['dataora'],
+                'valore': info['valore'],
+                'messaggio': info.get('messaggio', 'Nessuno'),
+            }])
         else:
             ecc = Eccezione()
             ecc.stringa_id = self.id
             ecc.sensore_id = info['id_sensore']
             ecc.messaggio = info.get('messaggio', 'Nessuno')
             ecc.save()
+            rilevazioni_salvate.send(sender=Stringa, rilevazioni=[], eccezioni=[ecc])
+
+    def salva_letture(self, id_sensore, letture):
+        chiavi = [chiave_rilevazione(id_sensore, ril['dataora'].timestamp(), ril['valore']) for ril in letture]
+        duplicate = finestra_duplicati.filtra(chiavi)
+        nuove = [
+            (chiave, Rilevazione(stringa_id=self.id, sensore_id=id_sensore, messaggio=ril['messaggio'],
+                                 valore=ril['valore'], dataora=ril['dataora']))
+            for posizione, (chiave, ril) in enumerate(zip(chiavi, letture)) if posizione not in duplicate
+        ]
+        if not nuove:
+            raise StringaDuplicata(self.stringa)
+        try:
+            with transaction.atomic():
+                Rilevazione.objects.bulk_create([ril for _, ril in nuove])
+        except IntegrityError:
+            presenti = Rilevazione.chiavi_presenti([chiave for chiave, _ in nuove])
+            mancanti = [(chiave, ril) for chiave, ril in nuove if chiave not in presenti]
+            finestra_duplicati.conta_duplicate_db(len(nuove) - len(mancanti))
+            nuove = mancanti
+            try:
+                with transaction.atomic():
+                    Rilevazione.objects.bulk_create([ril for _, ril in nuove])
+            except IntegrityError:
+                # Un altro processo ha scritto le stesse rilevazioni nel frattempo
+                salvate = Rilevazione.salva_una_alla_volta([ril for _, ril in nuove])
+                finestra_duplicati.conta_duplicate_db(len(nuove) - len(salvate))
+                nuove = [nuove[posizione] for posizione in salvate]
+            if not nuove:
+                raise StringaDuplicata(self.stringa)
+        scritte = [chiave for chiave, _ in nuove]
+        transaction.on_commit(lambda: finestra_duplicati.registra(scritte))
+        rilevazioni_salvate.send(sender=Stringa, rilevazioni=[ril for _, ril in nuove], eccezioni=[])
 
     def save(self, *args, **kwargs):
-        super(Stringa, self).save(*args, **kwargs)
-        self.traduci()
+        with transaction.atomic():
+            super(Stringa, self).save(*args, **kwargs)
+            self.traduci()
 
     def __str__(self):
         return self.stringa
@@ -265,20 +374,331 @@ class Eccezione(Model):
 
 
 class Rilevazione(Model):
-    stringa = OneToOneField('Stringa', on_delete=CASCADE, db_column='stringa')
+    stringa = ForeignKey('Stringa', on_delete=CASCADE, db_column='stringa')
     sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
     dataora = DateTimeField(auto_now=False, auto_now_add=False)
     valore = IntegerField()
     messaggio = CharField(max_length=255, null=True)
 
+    @staticmethod
+    def chiavi_presenti(chiavi):
+        if not chiavi:
+            return set()
+        presenti = Rilevazione.objects.filter(
+            sensore__in={chiave[0] for chiave in chiavi},
+            dataora__range=(da_epoch(min(chiave[1] for chiave in chiavi)),
+                            da_epoch(max(chiave[1] for chiave in chiavi))),
+        ).values_list('sensore', 'dataora', 'valore')
+        return {chiave_rilevazione(id_sensore, dataora.timestamp(), valore) for id_sensore, dataora, valore in presenti}
+
+    @staticmethod
+    def salva_una_alla_volta(rilevazioni):
+        """
+        Salva le rilevazioni ognuna nel proprio savepoint, saltando quelle già presenti (anche se scritte da un
+        altro processo dopo l'inizio della transazione). Restituisce le posizioni di quelle salvate.
+        """
+        salvate = []
+        for posizione, rilevazione in enumerate(rilevazioni):
+            try:
+                with transaction.atomic():
+                    Rilevazione.objects.bulk_create([rilevazione])
+            except IntegrityError:
+                continue
+            salvate.append(posizione)
+        return salvate
+
     def __str__(self):
         return str(self.id)
 
     class Meta:
         db_table = 'rilevazioni'
+        unique_together = ('sensore', 'dataora', 'valore')
+
+
+class UltimaRilevazione(Model):
+    # Ultima rilevazione (per dataora) ed ultima eccezione di ogni sensore, aggiornate all'ingest
+    sensore = OneToOneField('Sensore', on_delete=CASCADE, primary_key=True, db_column='sensore',
+                            related_name='ultima_rilevazione')
+    dataora = DateTimeField(null=True)
+    valore = IntegerField(null=True)
+    messaggio = CharField(max_length=255, null=True)
+    eccezione = ForeignKey('Eccezione', on_delete=SET_NULL, null=True, db_column='eccezione', related_name='+')
+    messaggio_eccezione = CharField(max_length=255, null=True)
+
+    def __str__(self):
+        return str(self.sensore_id)
+
+    class Meta:
+        db_table = 'ultime_rilevazioni'
+
+
+class AggregatoRilevazioni(Model):
+    SCALA_MINUTO = 60
+    SCALA_ORA = 3600
+    SCALA_GIORNO = 86400
+    SCALE = (SCALA_MINUTO, SCALA_ORA, SCALA_GIORNO)
+    MAX_PUNTI = 1500
+
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
+    scala = IntegerField()  # durata del bucket in secondi
+    inizio = DateTimeField()
+    conteggio = IntegerField()
+    minimo = IntegerField()
+    massimo = IntegerField()
+    somma = BigIntegerField()
+    ultimo_valore = IntegerField()
+    ultima_dataora = DateTimeField()
+
+    def get_media(self):
+        return self.somma / self.conteggio if self.conteggio else None
+
+    @classmethod
+    def scegli_scala(cls, dal, al):
+        # La scala più fine che copre l'intervallo con al massimo MAX_PUNTI bucket
+        durata = (al - dal).total_seconds()
+        for scala in cls.SCALE:
+            if durata / scala <= cls.MAX_PUNTI:
+                return scala
+        return cls.SCALA_GIORNO
+
+    @staticmethod
+    def inizio_bucket(dataora, scala):
+        return da_epoch(int(dataora.timestamp()) // scala * scala)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'aggregati_rilevazioni'
+        unique_together = ('sensore', 'scala', 'inizio')
+
+
+class ContatoreTipiImpianto(Model):
+    # Sensori installati ora nell'impianto per tipo, mantenuto da contatori_sensori.py
+    impianto = ForeignKey('Impianto', on_delete=CASCADE, db_column='impianto', related_name='contatori_tipi')
+    tipo = ForeignKey('TipoSensore', on_delete=CASCADE, db_column='tipo')
+    num = IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'contatori_tipi_impianti'
+        unique_together = ('impianto', 'tipo')
+
+
+class ContatoreEccezioni(Model):
+    # Eccezioni di un sensore per giorno (UTC) di arrivo, aggiornate all'ingest (contatori_eccezioni.py)
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
+    giorno = DateField()
+    conteggio = IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'contatori_eccezioni'
+        unique_together = ('sensore', 'giorno')
+
+
+class InizioContatoriEccezioni(Model):
+    # Giorno (UTC) di avvio dei contatori di ContatoreEccezioni, in una sola riga (id 1): prima non esistevano
+    giorno = DateField()
+
+    @classmethod
+    def corrente(cls):
+        return cls.objects.filter(id=1).values_list('giorno', flat=True).first()
+
+    def __str__(self):
+        return str(self.giorno)
+
+    class Meta:
+        db_table = 'inizio_contatori_eccezioni'
+
+
+class ContatoreEccezioniImpianto(Model):
+    # Eccezioni per giorno dei sensori installati nell'impianto al momento dell'arrivo
+    impianto = ForeignKey('Impianto', on_delete=CASCADE, db_column='impianto')
+    giorno = DateField()
+    conteggio = IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'contatori_eccezioni_impianti'
+        unique_together = ('impianto', 'giorno')
+
+
+class TotaleEccezioni(Model):
+    impianto = ForeignKey('Impianto', on_delete=CASCADE, db_column='impianto')
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
+    conteggio = IntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'totali_eccezioni'
+        unique_together = ('impianto', 'sensore')
+
+
+class EccezioneRecente(Model):
+    # Ultime settings.ECCEZIONI_RECENTI eccezioni di ogni impianto
+    impianto = ForeignKey('Impianto', on_delete=CASCADE, db_column='impianto')
+    eccezione = ForeignKey('Eccezione', on_delete=CASCADE, db_column='eccezione', related_name='+')
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'eccezioni_recenti'
+
+
+class RegolaAllarme(Model):
+    # Regola valutata ad ogni rilevazione salvata, per un sensore o per tutti i sensori di un tipo
+    SOGLIA = 'soglia'
+    VARIAZIONE = 'variazione'
+    ZSCORE = 'zscore'
+    GENERI = (
+        (SOGLIA, 'Valore fuori da [minimo, massimo]'),
+        (VARIAZIONE, 'Variazione oltre variazione_max al secondo'),
+        (ZSCORE, 'Z-score oltre soglia_z rispetto alla media mobile di circa finestra rilevazioni'),
+    )
+
+    genere = CharField(max_length=20, choices=GENERI)
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, null=True, blank=True, db_column='sensore')
+    tipo = ForeignKey('TipoSensore', on_delete=CASCADE, null=True, blank=True, db_column='tipo')
+    minimo = FloatField(null=True, blank=True)
+    massimo = FloatField(null=True, blank=True)
+    variazione_max = FloatField(null=True, blank=True)
+    finestra = IntegerField(default=100)
+    soglia_z = FloatField(default=3)
+    attiva = BooleanField(default=True)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'regole_allarmi'
+
+
+class StatoRegola(Model):
+    # Checkpoint dello stato in memoria del motore degli allarmi (allarmi.py) per regola e sensore
+    regola = ForeignKey('RegolaAllarme', on_delete=CASCADE, db_column='regola')
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
+    dataora = FloatField(null=True)  # secondi epoch dell'ultima rilevazione valutata
+    valore = FloatField(null=True)
+    media = FloatField(default=0)
+    varianza = FloatField(default=0)
+    conteggio = IntegerField(default=0)
+    in_allarme = BooleanField(default=False)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'stati_regole'
+        unique_together = ('regola', 'sensore')
+
+
+class Allarme(Model):
+    regola = ForeignKey('RegolaAllarme', on_delete=CASCADE, db_column='regola')
+    sensore = ForeignKey('Sensore', on_delete=CASCADE, db_column='sensore')
+    dataora = DateTimeField()
+    valore = IntegerField()
+    descrizione = CharField(max_length=255)
+    data_creazione = DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = 'allarmi'
+
+
+class VersioneCatalogo(Model):
+    # Contatore delle modifiche al catalogo dei sensori, in una sola riga (id 1): dà ETag e Last-Modified alle API
+    versione = BigIntegerField(default=0)
+    modificato = DateTimeField(default=timezone.now)
+
+    @classmethod
+    def corrente(cls):
+        versione = cls.objects.filter(id=1).values_list('versione', 'modificato').first()
+        return versione or (0, None)
+
+    @classmethod
+    def incrementa(cls):
+        # Last-Modified ha la risoluzione del secondo: ogni versione porta modificato almeno al secondo
+        # successivo, altrimenti due modifiche nello stesso secondo darebbero un 304 a chi usa If-Modified-Since
+        adesso = timezone.now().replace(microsecond=0)
+        with transaction.atomic():
+            precedente = cls.objects.select_for_update().filter(id=1).values_list('modificato', flat=True).first()
+            if precedente is None:
+                _, creata = cls.objects.get_or_create(id=1, defaults={'versione': 1, 'modificato': adesso})
+                if creata:
+                    return
+                precedente = cls.objects.select_for_update().filter(id=1).values_list('modificato', flat=True)[0]
+            modificato = max(adesso, precedente.replace(microsecond=0) + timedelta(seconds=1))
+            cls.objects.filter(id=1).update(versione=F('versione') + 1, modificato=modificato)
+
+    def __str__(self):
+        return str(self.versione)
+
+    class Meta:
+        db_table = 'versione_catalogo'
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created and not kwargs.get('raw', False):
         Token.objects.create(user=instance)
+
+
+def carica_sensori(ids):
+    sensori = {
+        sensore['id']: {
+            'id_sensore': sensore['id'],
+            'codice_errore': sensore['codice_errore'],
+            'tipo_id': sensore['tipo'],
+            'tipo': sensore['tipo__tipo'],
+            'marca_id': sensore['marca'],
+            'marca': sensore['marca__marca'],
+            'impianto': None,
+        }
+        for sensore in Sensore.objects.filter(id__in=ids)
+        .values('id', 'codice_errore', 'tipo', 'tipo__tipo', 'marca', 'marca__marca')
+    }
+    installazioni = Installazione.objects.filter(sensore__in=list(sensori), data_fine__isnull=True) \
+        .order_by('id').values_list('sensore', 'impianto')
+    for id_sensore, id_impianto in installazioni:
+        sensori[id_sensore]['impianto'] = id_impianto
+    return sensori
+
+
+cache_sensori = CacheSensori(carica_sensori, settings.CACHE_SENSORI_MAX, settings.CACHE_SENSORI_TTL)
+
+
+@receiver([post_save, post_delete], sender=Sensore)
+def invalida_cache_sensore(sender, instance=None, **kwargs):
+    cache_sensori.invalida(instance.id)
+    VersioneCatalogo.incrementa()
+
+
+@receiver([post_save, post_delete], sender=Installazione)
+def invalida_cache_installazione(sender, instance=None, **kwargs):
+    cache_sensori.invalida(instance.sensore_id)
+    VersioneCatalogo.incrementa()
+
+
+@receiver([post_save, post_delete], sender=TipoSensore)
+@receiver([post_save, post_delete], sender=MarcaSensore)
+def svuota_cache_sensori(sender, **kwargs):
+    cache_sensori.svuota()
+    VersioneCatalogo.incrementa()
+
+
+@receiver([post_save, post_delete], sender=Impianto)
+def incrementa_versione_impianto(sender, **kwargs):
+    # Il proprietario dell'impianto decide quali sensori vede un utente non staff
+    VersioneCatalogo.incrementa()
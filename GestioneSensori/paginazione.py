@@ -0,0 +1,76 @@
+import json
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+SALT_CURSORE = 'GestioneSensori.paginazione'
+
+
+class CursoreNonValido(ValueError):
+    pass
+
+
+def codifica_cursore(valori):
+    # Firmato: il client lo ripassa così com'è, senza poterne costruire o modificare uno
+    return signing.dumps([{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in valori], salt=SALT_CURSORE)
+
+
+def decodifica_cursore(token):
+    try:
+        valori = signing.loads(token, salt=SALT_CURSORE)
+    except signing.BadSignature:
+        raise CursoreNonValido('cursor non valido')
+    return [parse_datetime(v['dt']) if isinstance(v, dict) else v for v in valori]
+
+
+def filtro_dopo(campi, valori):
+    """Condizione (campi) > (valori) in ordine lessicografico, per ripartire dopo l'ultima riga letta."""
+    filtro = Q()
+    for i in reversed(range(len(campi))):
+        uguali = {campo: valore for campo, valore in zip(campi[:i], valori[:i])}
+        filtro |= Q(**uguali, **{'%s__gt' % campi[i]: valori[i]})
+    return filtro
+
+
+def pagina_keyset(queryset, campi, dopo=None, dimensione=1000):
+    """
+    Una pagina di righe (dizionari da values()) ordinate per campi, che devono identificare la riga.
+    Restituisce le righe e i valori dei campi dell'ultima, da usare come cursore, o None se non ce ne sono altre.
+    """
+    queryset = queryset.order_by(*campi)
+    if dopo is not None:
+        queryset = queryset.filter(filtro_dopo(campi, dopo))
+    righe = list(queryset[:dimensione + 1])
+    if len(righe) <= dimensione:
+        return righe, None
+    righe = righe[:dimensione]
+    return righe, [righe[-1][campo] for campo in campi]
+
+
+def pagine_keyset(queryset, campi, dimensione=1000):
+    """Tutte le righe, una pagina alla volta: la memoria resta limitata anche senza cursori lato server."""
+    dopo = None
+    while True:
+        righe, dopo = pagina_keyset(queryset, campi, dopo, dimensione)
+        if righe:
+            yield righe
+        if dopo is None:
+            return
+
+
+def json_in_streaming(elementi, dimensione_blocco=1000):
+    """Lista JSON prodotta un blocco di elementi alla volta."""
+    yield '['
+    blocco = []
+    primo = True
+    for elemento in elementi:
+        blocco.append(json.dumps(elemento))
+        if len(blocco) >= dimensione_blocco:
+            yield ('' if primo else ',') + ','.join(blocco)
+            primo = False
+            blocco = []
+    if blocco:
+        yield ('' if primo else ',') + ','.join(blocco)
+    yield ']'
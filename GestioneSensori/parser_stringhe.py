@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+LEN_DATETIME = 14
+FORMATO_DATETIME = '%Y%m%d%H%M%S'
+MAX_VALORE = 2147483647
+MAX_LEN_MESSAGGIO = 255
+
+MARCATORE_COMPATTA = '~'
+VERSIONI_COMPATTE = ('1',)
+
+EPOCH = datetime(1970, 1, 1)
+UN_SECONDO = timedelta(seconds=1)
+
+
+CIFRE = '0123456789'
+
+
+def _fine_cifre(testo, inizio, cifre):
+    fine = inizio
+    while fine < len(testo) and testo[fine].isdecimal() is cifre:
+        fine += 1
+    return fine
+
+
+def scomponi_stringa(string):
+    # Equivale a split(' ') seguito da split('(\d+)') sul secondo campo: se manca lo spazio
+    # o il secondo campo non contiene cifre viene sollevato IndexError come prima.
+    id_sensore, spazio, resto = string.partition(' ')
+    if not spazio:
+        raise IndexError('stringa senza separatore')
+    other = resto.partition(' ')[0]
+    coda = other.lstrip(CIFRE)
+    if len(coda) < len(other) and not coda[:1].isdecimal():
+        numeric = other[:len(other) - len(coda)]
+    else:
+        inizio_numeric = _fine_cifre(other, 0, False)
+        if inizio_numeric == len(other):
+            raise IndexError('stringa senza parte numerica')
+        fine_numeric = _fine_cifre(other, inizio_numeric, True)
+        numeric = other[inizio_numeric:fine_numeric]
+        coda = other[fine_numeric:]
+    return {
+        'stringa': string,
+        'id_sensore': id_sensore,
+        'messaggio': coda[:_fine_cifre(coda, 0, False)],
+        'numeric': numeric
+    }
+
+
+def decodifica_dataora(dataora_str):
+    if len(dataora_str) != LEN_DATETIME:
+        # Con meno di 14 cifre strptime accetta campi a larghezza variabile: si mantiene lo stesso comportamento
+        return datetime.strptime(dataora_str, FORMATO_DATETIME)
+    data, ora = divmod(int(dataora_str), 1000000)
+    anno_mese, giorno = divmod(data, 100)
+    anno, mese = divmod(anno_mese, 100)
+    ore_minuti, secondi = divmod(ora, 100)
+    ore, minuti = divmod(ore_minuti, 100)
+    return datetime(anno, mese, giorno, ore, minuti, secondi)
+
+
+def completa_info(info, codice_errore):
+    numeric = info['numeric']
+    if numeric == str(codice_errore):
+        return info
+    info.update({
+        'dataora': timezone.make_aware(
+            decodifica_dataora(numeric[0:LEN_DATETIME]),
+            timezone.get_current_timezone()
+        ),
+        'valore': numeric[LEN_DATETIME::],
+    })
+    return info
+
+
+def e_compatta(string):
+    return string.partition(' ')[2][:2] == MARCATORE_COMPATTA + ' '
+
+
+def scomponi_compatta(string):
+    """
+    Formato compatto: '<id> ~ <versione> <dataora base> <delta>:<valore>[:<messaggio>] ...' dove ogni delta
+    sono i secondi trascorsi dalla lettura precedente (dalla dataora base per la prima).
+    Il secondo campo '~' non contiene cifre, quindi nessuna stringa valida nel formato originale è compatta.
+    Le letture sono restituite come (secondi dalla base, valore, messaggio).
+    """
+    campi = string.split(' ')
+    if len(campi) < 5 or campi[2] not in VERSIONI_COMPATTE:
+        raise ValueError('stringa compatta non valida')
+    base = campi[3]
+    if len(base) != LEN_DATETIME or not base.isdigit():
+        raise ValueError('dataora base non valida')
+    letture = []
+    secondi = 0
+    for campo in campi[4:]:
+        delta, _, resto = campo.partition(':')
+        valore, _, messaggio = resto.partition(':')
+        if not (delta.isdigit() and valore.isdigit()) or len(messaggio) > MAX_LEN_MESSAGGIO:
+            raise ValueError('lettura non valida: %s' % campo)
+        secondi += int(delta)
+        valore = int(valore)
+        if valore > MAX_VALORE:
+            raise ValueError('valore fuori intervallo')
+        letture.append((secondi, valore, messaggio))
+    return {
+        'stringa': string,
+        'id_sensore': campi[0],
+        'versione': int(campi[2]),
+        'base': decodifica_dataora(base),
+        'letture': letture,
+    }
+
+
+def completa_compatta(info):
+    base = timezone.make_aware(info['base'], timezone.get_current_timezone())
+    info['letture'] = [
+        {'dataora': base + timedelta(seconds=secondi), 'valore': valore, 'messaggio': messaggio}
+        for secondi, valore, messaggio in info['letture']
+    ]
+    return info
+
+
+def scomponi(string):
+    return scomponi_compatta(string) if e_compatta(string) else scomponi_stringa(string)
+
+
+def parse_stringa(string, codice_errore):
+    if e_compatta(string):
+        return completa_compatta(scomponi_compatta(string))
+    return completa_info(scomponi_stringa(string), codice_errore)
+
+
+def id_sensore_stringa(string):
+    return string.partition(' ')[0] if isinstance(string, str) else None
+
+
+def parse_batch(stringhe, codici_errore, max_len=None):
+    """
+    Scompone una lista di stringhe in colonne parallele (una posizione per stringa).
+    'dataora' contiene il timestamp epoch in secondi, 'valore' l'intero letto; per le eccezioni
+    (parte numerica uguale al codice errore del sensore) entrambi valgono None.
+    Per le stringhe compatte 'letture' contiene la lista di (epoch, valore, messaggio), altrimenti None.
+    Le stringhe scartate hanno il motivo in 'errore', altrimenti None.
+    """
+    tz = timezone.get_current_timezone()
+    tz_utc = str(tz) == 'UTC'
+
+    def epoch(naive):
+        if tz_utc:
+            return (naive - EPOCH) // UN_SECONDO
+        return int(timezone.make_aware(naive, tz).timestamp())
+
+    colonne = {'stringa': [], 'id_sensore': [], 'dataora': [], 'valore': [], 'messaggio': [],
+               'eccezione': [], 'letture': [], 'errore': []}
+    for string in stringhe:
+        id_sensore = messaggio = dataora = valore = letture = errore = None
+        eccezione = False
+        if not isinstance(string, str) or (max_len is not None and len(string) > max_len):
+            errore = 'bad format'
+        else:
+            try:
+                info = scomponi(string)
+                id_sensore = info['id_sensore']
+                if id_sensore not in codici_errore:
+                    errore = 'id_sensore non presente nel sistema'
+                elif 'letture' in info:
+                    base = epoch(info['base'])
+                    letture = [(base + secondi, valore, messaggio) for secondi, valore, messaggio in info['letture']]
+                elif len(info['messaggio']) > MAX_LEN_MESSAGGIO:
+                    raise ValueError('messaggio troppo lungo')
+                elif info['numeric'] == str(codici_errore[id_sensore]):
+                    messaggio = info['messaggio']
+                    eccezione = True
+                else:
+                    numeric = info['numeric']
+                    messaggio = info['messaggio']
+                    valore = int(numeric[LEN_DATETIME::])
+                    if valore > MAX_VALORE:
+                        raise ValueError('valore fuori intervallo')
+                    dataora = epoch(decodifica_dataora(numeric[0:LEN_DATETIME]))
+            except (IndexError, ValueError):
+                messaggio = dataora = valore = letture = None
+                errore = 'bad format'
+        colonne['stringa'].append(string)
+        colonne['id_sensore'].append(id_sensore)
+        colonne['dataora'].append(dataora)
+        colonne['valore'].append(valore)
+        colonne['messaggio'].append(messaggio)
+        colonne['eccezione'].append(eccezione)
+        colonne['letture'].append(letture)
+        colonne['errore'].append(errore)
+    return colonne
+
+
+def letture_colonne(colonne, i):
+    """Letture (epoch, valore, messaggio) della stringa in posizione i, sia nel formato originale che compatto."""
+    if colonne['letture'][i] is not None:
+        return colonne['letture'][i]
+    return [(colonne['dataora'][i], colonne['valore'][i], colonne['messaggio'][i])]
+
+
+def da_epoch(secondi):
+    return datetime.fromtimestamp(secondi, timezone.utc)
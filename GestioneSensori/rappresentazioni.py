@@ -0,0 +1,77 @@
+"""
+Percorso di lettura delle API: query con values() sulle sole colonne necessarie e dizionari di risposta
+costruiti direttamente, senza istanziare modelli né serializer. Ogni funzione fa un numero costante di query,
+qualunque sia il numero di righe.
+"""
+from rest_framework.fields import DateTimeField
+
+from GestioneSensori.models import Sensore, Rilevazione, UltimaRilevazione, cache_sensori
+
+dataora_json = DateTimeField().to_representation
+
+
+def query_sensori(utente):
+    # Senza distinct un sensore installato più volte negli impianti dell'utente comparirebbe più volte
+    if utente.is_staff:
+        query = Sensore.objects.all()
+    else:
+        query = Sensore.objects.filter(impianto__user=utente).distinct()
+    return query.values('id', 'codice_errore')
+
+
+def ultima_rilevazione_json(ultima):
+    if ultima is None or ultima.dataora is None:
+        return None
+    return {
+        'dataora': dataora_json(ultima.dataora),
+        'valore': ultima.valore,
+        'messaggio': ultima.messaggio,
+    }
+
+
+def sensore_json(sensore, codice_errore=None):
+    # sensore è una voce di cache_sensori
+    return {
+        'id_sensore': sensore['id_sensore'],
+        'tipo': sensore['tipo'],
+        'marca': sensore['marca'],
+        'codice_errore': sensore['codice_errore'] if codice_errore is None else codice_errore,
+    }
+
+
+def sensori_json(righe, ultima_rilevazione=False):
+    """Righe di query_sensori: tipo e marca dalla cache dei sensori, le ultime rilevazioni con una sola query."""
+    sensori = cache_sensori.get_many(data['id'] for data in righe)
+    elementi = [sensore_json(sensori[data['id']], data['codice_errore']) for data in righe]
+    if ultima_rilevazione:
+        ultime = UltimaRilevazione.objects.in_bulk([data['id'] for data in righe])
+        for elemento in elementi:
+            elemento['ultima_rilevazione'] = ultima_rilevazione_json(ultime.get(elemento['id_sensore']))
+    return elementi
+
+
+def ultima_rilevazione_sensore(id_sensore):
+    return ultima_rilevazione_json(UltimaRilevazione.objects.filter(sensore=id_sensore).first())
+
+
+def rilevazioni_json(id_sensore, righe):
+    # Righe con dataora, valore e messaggio di un solo sensore
+    return [
+        {
+            'id_sensore': id_sensore,
+            'dataora': dataora_json(data['dataora']),
+            'valore': data['valore'],
+            'messaggio': data['messaggio'],
+        }
+        for data in righe
+    ]
+
+
+def rilevazione_json(id_rilevazione):
+    """La rilevazione con questo id, o None se non esiste (anche per id non numerici)."""
+    if not str(id_rilevazione).isdigit():
+        return None
+    data = Rilevazione.objects.filter(id=id_rilevazione).values('sensore', 'dataora', 'valore', 'messaggio').first()
+    if data is None:
+        return None
+    return rilevazioni_json(data['sensore'], [data])[0]
@@ -0,0 +1,23 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from GestioneSensori.colonnare import CONTENT_TYPE, SerieColonnare
+
+
+class ColonnareRenderer(BaseRenderer):
+    """
+    Rilevazioni nel formato binario colonnare (Accept: application/x-rilevazioni-colonnare o ?format=colonnare).
+    Le viste passano una SerieColonnare; errori e risposte che non sono serie di rilevazioni
+    vengono restituiti in JSON.
+    """
+    media_type = CONTENT_TYPE
+    format = 'colonnare'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, SerieColonnare):
+            return data.codifica()
+        risposta = (renderer_context or {}).get('response')
+        if risposta is not None:
+            risposta['Content-Type'] = JSONRenderer.media_type
+        return JSONRenderer().render(data, renderer_context=renderer_context)
@@ -139,3 +139,64 @@ LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/panel/'
 
 SECURE_BROWSER_XSS_FILTER = True
+
+# Ingest rilevazioni
+
+INGEST_BATCH_MAX = 5000
+INGEST_STREAM_LOTTO = 1000
+
+# Con INGEST_ASYNC add_rilevazione_api risponde 202 e le stringhe vengono salvate a gruppi da un thread
+INGEST_ASYNC = False
+INGEST_CODA_MAX = 20000
+INGEST_FLUSH_ITEMS = 500
+INGEST_FLUSH_MS = 200
+
+# Finestra in memoria per scartare le rilevazioni ritrasmesse (stesso sensore, dataora e valore)
+DUPLICATI_FINESTRA = 3600  # secondi
+DUPLICATI_BUCKET = 12
+DUPLICATI_MAX_CHIAVI = 1000000
+
+CACHE_SENSORI_MAX = 10000
+CACHE_SENSORI_TTL = 300  # secondi
+# Corpo delle risposte di api/sensori/ per utente e versione del catalogo (cache di Django)
+CACHE_CATALOGO_TTL = 300  # secondi
+
+# Conservazione dei dati (manage.py compatta_rilevazioni), in giorni; None = per sempre
+RETENZIONE_RILEVAZIONI_GIORNI = 30
+RETENZIONE_AGGREGATI_GIORNI = {
+    60: 365,  # aggregati al minuto
+    3600: None,  # aggregati orari
+    86400: None,  # aggregati giornalieri
+}
+# Eccezioni per tipo di sensore, es. {'temperatura': {'rilevazioni': 90, 'aggregati': {60: 730}}}
+RETENZIONE_PER_TIPO = {}
+RETENZIONE_LOTTO = 5000
+RETENZIONE_PAUSA_MS = 50
+
+# Archivio colonnare delle rilevazioni storiche (manage.py archivia_rilevazioni)
+ARCHIVIO_DIR = os.path.join(BASE_DIR, 'archivio')
+ARCHIVIO_RIGHE_SEGMENTO = 1000000
+ARCHIVIO_RITARDO_GIORNI = 1  # i giorni più recenti restano solo nel database (dati in ritardo)
+
+# Punti massimi per le serie ridotte di api/rilevazioni/ (parametri points e bucket)
+RILEVAZIONI_MAX_PUNTI = 5000
+RILEVAZIONI_LTTB_MAX_GIORNI = 31  # metodo=lttb legge tutte le rilevazioni grezze di [from, to)
+SERIE_MAX_SENSORI = 500  # api/rilevazioni/serie/, statistiche/ ed export/
+
+# Paginazione keyset delle API a lista (parametri page_size e cursor) e streaming (stream=1)
+API_PAGINA = 1000
+API_PAGINA_MAX = 10000
+API_STREAM_BLOCCO = 2000
+
+# Righe lette per blocco dall'export di api/rilevazioni/export/
+EXPORT_BLOCCO = 10000
+
+# Ultimo contatto dei sensori: al più una scrittura ogni tanti secondi per sensore
+ULTIMO_CONTATTO_GRANULARITA = 60
+
+# Eccezioni recenti conservate per impianto (dashboard)
+ECCEZIONI_RECENTI = 50
+
+# Motore delle regole di allarme valutate all'ingest (allarmi.py)
+ALLARMI_REGOLE_TTL = 60  # secondi prima di rileggere le regole modificate da un altro processo
+ALLARMI_CHECKPOINT_SECONDI = 60
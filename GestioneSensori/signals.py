@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Inviato, dentro la transazione di salvataggio, dopo ogni inserimento di rilevazioni ed eccezioni
+# (Stringa.traduci e percorsi di ingest a lotti). Le istanze potrebbero non avere la pk valorizzata.
+rilevazioni_salvate = Signal(providing_args=['rilevazioni', 'eccezioni'])
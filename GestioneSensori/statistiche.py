@@ -0,0 +1,115 @@
+import numpy as np
+from django.db.models import Sum
+
+from GestioneSensori.archivio import leggi_serie_sensori
+from GestioneSensori.models import ContatoreEccezioni, InizioContatoriEccezioni, cache_sensori
+from GestioneSensori.parser_stringhe import da_epoch
+
+PERCENTILI = (50, 95, 99)
+
+
+def statistiche_gruppi(gruppi, valori, n):
+    """
+    Statistiche dei valori raggruppati per codice di gruppo (0..n-1), per tutti i gruppi insieme: conteggio,
+    minimo, massimo, media, deviazione standard (della popolazione) e percentili (interpolazione lineare,
+    come np.percentile). I gruppi senza valori hanno conteggio 0 e le altre statistiche a NaN.
+    """
+    gruppi = np.asarray(gruppi, dtype=np.int64)
+    ordine = np.lexsort((valori, gruppi))
+    gruppi = gruppi[ordine]
+    valori = np.asarray(valori, dtype=np.float64)[ordine]
+    conteggio = np.bincount(gruppi, minlength=n)
+    # Ordinati per gruppo e valore: ogni gruppo è un tratto contiguo e già ordinato
+    inizio = np.cumsum(conteggio) - conteggio
+    pieni = conteggio > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media = np.bincount(gruppi, weights=valori, minlength=n) / conteggio
+        dev_std = np.sqrt(np.bincount(gruppi, weights=(valori - media[gruppi]) ** 2, minlength=n) / conteggio)
+    statistiche = {
+        'conteggio': conteggio,
+        'minimo': np.full(n, np.nan),
+        'massimo': np.full(n, np.nan),
+        'media': media,
+        'dev_std': dev_std,
+    }
+    statistiche['minimo'][pieni] = valori[inizio[pieni]]
+    statistiche['massimo'][pieni] = valori[inizio[pieni] + conteggio[pieni] - 1]
+    for percentile in PERCENTILI:
+        posizione = inizio[pieni] + (conteggio[pieni] - 1) * percentile / 100
+        sotto = np.floor(posizione).astype(np.int64)
+        sopra = np.ceil(posizione).astype(np.int64)
+        colonna = np.full(n, np.nan)
+        colonna[pieni] = valori[sotto] + (valori[sopra] - valori[sotto]) * (posizione - sotto)
+        statistiche['p%d' % percentile] = colonna
+    return statistiche
+
+
+def _in_json(statistiche, i):
+    def numero(valore, tipo=float):
+        return None if np.isnan(valore) else tipo(round(valore, 6))
+    elemento = {'conteggio': int(statistiche['conteggio'][i])}
+    for nome in ('minimo', 'massimo'):
+        elemento[nome] = numero(statistiche[nome][i], int)
+    for nome in ['media', 'dev_std'] + ['p%d' % percentile for percentile in PERCENTILI]:
+        elemento[nome] = numero(statistiche[nome][i])
+    return elemento
+
+
+def con_messaggio_serie(serie):
+    # Le rilevazioni senza messaggio hanno codice -1 oppure il codice della stringa vuota
+    pieni = np.array([bool(messaggio) for messaggio in serie['messaggi']] + [False], dtype=bool)
+    return pieni[np.where(serie['messaggio'] >= 0, serie['messaggio'], -1)]
+
+
+def statistiche_sensori(sensori, dal=None, al=None):
+    """
+    Statistiche delle rilevazioni in [dal, al) (secondi epoch) per sensore, per tipo di sensore e per
+    tutti i sensori insieme. Le serie arrivano da leggi_serie_sensori (archivio e una query sul database)
+    e vengono elaborate in un solo array. messaggi conta le rilevazioni con un messaggio nella finestra;
+    eccezioni le eccezioni arrivate nei giorni (UTC) toccati dalla finestra, dai contatori per giorno, ed è
+    None se la finestra non comincia dopo il primo giorno contato (InizioContatoriEccezioni).
+    """
+    info = cache_sensori.get_many(sensori)
+    serie = leggi_serie_sensori(sensori, dal, al)
+    lunghezze = np.array([len(serie[id_sensore]['valore']) for id_sensore in sensori], dtype=np.int64)
+    valori = np.concatenate([serie[id_sensore]['valore'] for id_sensore in sensori] or [np.empty(0)])
+    con_messaggio = np.concatenate([con_messaggio_serie(serie[id_sensore]) for id_sensore in sensori] or [np.empty(0)])
+    per_sensore = np.repeat(np.arange(len(sensori)), lunghezze)
+    tipi = sorted({info[id_sensore]['tipo'] for id_sensore in sensori})
+    tipo_sensore = np.array([tipi.index(info[id_sensore]['tipo']) for id_sensore in sensori], dtype=np.int64)
+    # Il primo giorno contato è parziale: le eccezioni arrivate prima dell'avvio dei contatori mancano
+    inizio_contatori = InizioContatoriEccezioni.corrente()
+    contate = inizio_contatori is not None and dal is not None and da_epoch(dal).date() > inizio_contatori
+    eccezioni = ContatoreEccezioni.objects.none()
+    if contate:
+        eccezioni = ContatoreEccezioni.objects.filter(sensore__in=sensori, giorno__gte=da_epoch(dal).date())
+    if al is not None:
+        eccezioni = eccezioni.filter(giorno__lte=da_epoch(al - 1).date())
+    eccezioni = dict(eccezioni.values('sensore').annotate(n=Sum('conteggio')).values_list('sensore', 'n'))
+    eccezioni = np.array([eccezioni.get(id_sensore, 0) for id_sensore in sensori], dtype=np.int64)
+    messaggi = np.bincount(per_sensore, weights=con_messaggio, minlength=len(sensori)).astype(np.int64)
+
+    statistiche = statistiche_gruppi(per_sensore, valori, len(sensori))
+    statistiche_tipi = statistiche_gruppi(tipo_sensore[per_sensore], valori, len(tipi))
+    statistiche_totali = statistiche_gruppi(np.zeros(len(valori), dtype=np.int64), valori, 1)
+    sensori_tipo = np.bincount(tipo_sensore, minlength=len(tipi))
+    messaggi_tipo = np.bincount(tipo_sensore, weights=messaggi, minlength=len(tipi)).astype(np.int64)
+    eccezioni_tipo = np.bincount(tipo_sensore, weights=eccezioni, minlength=len(tipi)).astype(np.int64)
+    risultato = {
+        'sensori': [
+            dict(id_sensore=id_sensore, tipo=info[id_sensore]['tipo'], messaggi=int(messaggi[i]),
+                 eccezioni=int(eccezioni[i]), **_in_json(statistiche, i))
+            for i, id_sensore in enumerate(sensori)
+        ],
+        'tipi': [
+            dict(tipo=tipo, sensori=int(sensori_tipo[i]), messaggi=int(messaggi_tipo[i]),
+                 eccezioni=int(eccezioni_tipo[i]), **_in_json(statistiche_tipi, i))
+            for i, tipo in enumerate(tipi)
+        ],
+        'totale': dict(sensori=len(sensori), messaggi=int(messaggi.sum()), eccezioni=int(eccezioni.sum()),
+                       **_in_json(statistiche_totali, 0)),
+    }
+    if not contate:
+        for elemento in risultato['sensori'] + risultato['tipi'] + [risultato['totale']]:
+            elemento['eccezioni'] = None
+    return risultato
@@ -0,0 +1,557 @@
+import asyncio
+import gzip
+from datetime import date, datetime
+from re import split
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from GestioneSensori.models import Azienda, Utente, Impianto, TipoSensore, MarcaSensore, Sensore, Installazione, \
+    Stringa, StringaDuplicata, Rilevazione, UltimaRilevazione, AggregatoRilevazioni, RegolaAllarme, StatoRegola, \
+    ContatoreEccezioni, InizioContatoriEccezioni, cache_sensori
+from GestioneSensori import ultimo_contatto
+from GestioneSensori.allarmi import MotoreAllarmi, carica_regole, carica_stati
+from GestioneSensori.api_views import bucket_sensori
+from GestioneSensori.archivio import leggi_serie_sensori
+from GestioneSensori.ingest import salva_stringhe
+from GestioneSensori.management.commands.ascolta_sensori import Command as AscoltaSensori
+from GestioneSensori.parser_stringhe import LEN_DATETIME, MAX_LEN_MESSAGGIO, MAX_VALORE, scomponi, completa_info, \
+    parse_batch, da_epoch
+
+
+def get_info_stringa_originale(string, codice_errore):
+    # Stringa.scomponi_stringa e Stringa.completa_info prima del parser a larghezza fissa, come riferimento
+    split_space = split(' ', string)
+    id_sensore = split_space[0]
+    other = split_space[1]
+    split_ln = split(r'(\d+)', other)
+    numeric = split_ln[1]
+    messaggio = split_ln[2]
+    info = {
+        'stringa': string,
+        'id_sensore': id_sensore,
+        'messaggio': messaggio,
+        'numeric': numeric
+    }
+    if numeric == str(codice_errore):
+        return info
+    info.update({
+        'dataora': timezone.make_aware(
+            datetime.strptime(numeric[0:LEN_DATETIME], '%Y%m%d%H%M%S'),
+            timezone.get_current_timezone()
+        ),
+        'valore': numeric[LEN_DATETIME::],
+    })
+    return info
+
+
+CODICI_ERRORE = {'S1': '999', 'S-2': 999, 'S3': '0'}
+
+STRINGHE = [
+    # valore e messaggio
+    'S1 2017010112000010',
+    'S1 20170101120000123456',
+    'S1 2017123123595942Batteria scarica',
+    'S1 2017060112000042 seguito ignorato',
+    'S1 201701011200000',
+    'S1 20170101120000007',
+    'S1 20170101120000' + str(MAX_VALORE),
+    'S1 20170101120000' + str(MAX_VALORE + 1),
+    'S1 20200229235959100',
+    'S1 2017010112000010' + 'x' * MAX_LEN_MESSAGGIO,
+    'S1 2017010112000010' + 'x' * (MAX_LEN_MESSAGGIO + 1),
+    # valori negativi e decimali: il segno e il punto chiudono la parte numerica
+    'S1 20170101120000-5',
+    'S1 2017010112000012.5',
+    'S1 20170101120000.5',
+    # messaggio vuoto, o prima della parte numerica
+    'S1 20170101120000',
+    'S1 abc2017010112000010',
+    'S1 ab2017010112000010cd34',
+    # dataora corta o a larghezza variabile (strptime)
+    'S1 2017111',
+    'S1 201711112',
+    'S1 2017010112000',
+    'S1 2017',
+    # codice errore
+    'S1 999',
+    'S1 999Guasto',
+    'S1 999 Guasto',
+    'S-2 999',
+    'S-2 0999',
+    'S3 0',
+    'S3 00',
+    # stringhe non valide
+    '',
+    'S1',
+    'S1 ',
+    'S1  2017010112000010',
+    'S1 abc',
+    'S1 20171301120000 5',
+    'S1 20170230120000 5',
+    'S1 20170101250000 5',
+    'S1 2017010112000010١',
+    'S1 ١٢',
+]
+
+
+def codice_errore(stringa):
+    return CODICI_ERRORE.get(stringa.partition(' ')[0], '999')
+
+
+class ParserStringheTest(SimpleTestCase):
+
+    def originale(self, stringa):
+        try:
+            return get_info_stringa_originale(stringa, codice_errore(stringa))
+        except (IndexError, ValueError):
+            return None
+
+    def assert_equivalenti(self):
+        for stringa in STRINGHE:
+            with self.subTest(stringa=stringa):
+                atteso = self.originale(stringa)
+                if atteso is None:
+                    with self.assertRaises((IndexError, ValueError)):
+                        completa_info(scomponi(stringa), codice_errore(stringa))
+                    continue
+                info = completa_info(scomponi(stringa), codice_errore(stringa))
+                self.assertEqual(info, atteso)
+                if 'dataora' in info:
+                    self.assertTrue(timezone.is_aware(info['dataora']))
+
+    def assert_batch_equivalente(self):
+        colonne = parse_batch(STRINGHE, CODICI_ERRORE)
+        for i, stringa in enumerate(STRINGHE):
+            with self.subTest(stringa=stringa):
+                atteso = self.originale(stringa)
+                self.assertIsNone(colonne['letture'][i])
+                if atteso is None:
+                    self.assertEqual(colonne['errore'][i], 'bad format')
+                elif 'dataora' not in atteso:
+                    self.assertIsNone(colonne['errore'][i])
+                    self.assertEqual(colonne['id_sensore'][i], atteso['id_sensore'])
+                    self.assertTrue(colonne['eccezione'][i])
+                    self.assertEqual(colonne['messaggio'][i], atteso['messaggio'])
+                    self.assertIsNone(colonne['dataora'][i])
+                    self.assertIsNone(colonne['valore'][i])
+                elif not atteso['valore'] or int(atteso['valore']) > MAX_VALORE or \
+                        len(atteso['messaggio']) > MAX_LEN_MESSAGGIO:
+                    # Controlli in più di parse_batch: il vecchio percorso falliva al salvataggio della rilevazione
+                    self.assertEqual(colonne['errore'][i], 'bad format')
+                else:
+                    self.assertIsNone(colonne['errore'][i])
+                    self.assertEqual(colonne['id_sensore'][i], atteso['id_sensore'])
+                    self.assertFalse(colonne['eccezione'][i])
+                    self.assertEqual(da_epoch(colonne['dataora'][i]), atteso['dataora'])
+                    self.assertEqual(colonne['valore'][i], int(atteso['valore']))
+                    self.assertEqual(colonne['messaggio'][i], atteso['messaggio'])
+
+    def test_scomponi_equivale_a_get_info_stringa(self):
+        self.assert_equivalenti()
+
+    def test_parse_batch_equivale_a_get_info_stringa(self):
+        self.assert_batch_equivalente()
+
+    @override_settings(TIME_ZONE='Europe/Rome')
+    def test_fuso_orario_non_utc(self):
+        self.assert_equivalenti()
+        self.assert_batch_equivalente()
+
+    def test_parse_batch_scarta_sensori_sconosciuti_e_non_stringhe(self):
+        colonne = parse_batch(['X 2017010112000010', None, 'S1 2017010112000010'], CODICI_ERRORE, max_len=18)
+        self.assertEqual(colonne['errore'], ['id_sensore non presente nel sistema', 'bad format', 'bad format'])
+
+
+class AscoltaSensoriTest(SimpleTestCase):
+
+    def ricevi(self, blocchi, limite):
+        comando = AscoltaSensori()
+        ricevute = []
+        comando.coda = mock.Mock(accoda=lambda stringa: ricevute.append(stringa) or True)
+        comando.righe_non_valide = comando.connessioni = 0
+
+        async def connessione():
+            reader = asyncio.StreamReader(limit=limite)
+
+            async def invia():
+                # Un blocco alla volta, come dal socket
+                for blocco in blocchi:
+                    reader.feed_data(blocco)
+                    await asyncio.sleep(0)
+                reader.feed_eof()
+            await asyncio.gather(invia(), comando.gestisci_connessione(reader, mock.Mock()))
+        asyncio.run(connessione())
+        return ricevute, comando.righe_non_valide
+
+    def test_riga_troppo_lunga_scartata_fino_all_a_capo(self):
+        blocchi = [b'S1 uno\n', b'x' * 30, b'y' * 30, b'zz\nS1 due\n', b'x' * 30 + b'\nS1 tre']
+        self.assertEqual(self.ricevi(blocchi, 16), (['S1 uno', 'S1 due', 'S1 tre'], 2))
+
+
+class ApiTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        azienda = Azienda.objects.create(ragione_sociale='a', partita_iva='1', email='a@a.it', telefono='1',
+                                         sito_web='a.it')
+        cls.staff = Utente.objects.create(username='staff', data_nascita=date(1990, 1, 1), azienda=azienda,
+                                          is_staff=True)
+        cls.cliente = Utente.objects.create(username='cliente', data_nascita=date(1990, 1, 1), azienda=azienda)
+        cls.impianto = Impianto.objects.create(name='impianto', city='c', user=cls.cliente)
+        cls.tipo = TipoSensore.objects.create(tipo='temperatura')
+        cls.marca = MarcaSensore.objects.create(marca='marca')
+        cls.sensori = []
+        for i in range(5):
+            sensore = Sensore.objects.create(id='S%d' % i, tipo=cls.tipo, marca=cls.marca, codice_errore='999')
+            sensore.set_installazione(cls.impianto)
+            cls.sensori.append(sensore)
+
+    def setUp(self):
+        cache_sensori.svuota()
+        cache.clear()
+
+    def client_di(self, utente):
+        client = APIClient()
+        client.force_authenticate(utente)
+        return client
+
+
+@override_settings(INGEST_STREAM_LOTTO=10)
+class IngestStreamTest(ApiTestCase):
+
+    def invia(self, corpo):
+        return self.client_di(self.staff).post('/api/rilevazioni/add/stream/', corpo, content_type='text/plain',
+                                               HTTP_CONTENT_ENCODING='gzip')
+
+    def righe(self, n):
+        return ''.join('S0 20170101%06d%d\n' % (i, 1000 + i * 7919 % 104729) for i in range(n)).encode('utf-8')
+
+    def test_gzip_integro(self):
+        risposta = self.invia(gzip.compress(self.righe(50)))
+        self.assertEqual(risposta.status_code, 201)
+        self.assertEqual((risposta.data['status'], risposta.data['accettate'], risposta.data['troncato']),
+                         ('ok', 50, False))
+
+    def test_gzip_troncato_salva_le_righe_lette(self):
+        compresso = gzip.compress(self.righe(2000))
+        risposta = self.invia(compresso[:len(compresso) // 2])
+        self.assertEqual(risposta.status_code, 201)
+        self.assertEqual(risposta.data['status'], 'partial')
+        self.assertTrue(risposta.data['troncato'])
+        self.assertGreater(risposta.data['accettate'], 0)
+        self.assertLess(risposta.data['accettate'], 2000)
+        self.assertEqual(Rilevazione.objects.count(), risposta.data['accettate'])
+
+    def test_gzip_non_valido_senza_righe(self):
+        risposta = self.invia(b'non gzip')
+        self.assertEqual(risposta.status_code, 400)
+        self.assertEqual((risposta.data['status'], risposta.data['accettate'], risposta.data['troncato']),
+                         ('partial', 0, True))
+
+
+class IngestConcorrenteTest(ApiTestCase):
+    """Rilevazioni scritte da un altro processo dopo il controllo dei duplicati: non visibili a chiavi_presenti."""
+
+    def setUp(self):
+        super().setUp()
+        Stringa.objects.bulk_create([Stringa(stringa='S1 2018010112000010')])
+        Rilevazione.objects.create(stringa=Stringa.objects.get(), sensore=self.sensori[1], valore=10,
+                                   dataora=datetime(2018, 1, 1, 12, tzinfo=timezone.utc))
+        self.invisibili = mock.patch.object(Rilevazione, 'chiavi_presenti', return_value=set())
+        self.invisibili.start()
+        self.addCleanup(self.invisibili.stop)
+
+    def test_salva_stringhe(self):
+        esiti = salva_stringhe(['S1 2018010112000010', 'S1 2018010112000111', 'S1 999'])
+        self.assertEqual(esiti, [{'status': 'ok', 'duplicata': True}, {'status': 'ok'}, {'status': 'ok'}])
+        self.assertEqual(Rilevazione.objects.filter(sensore='S1').count(), 2)
+        self.assertEqual(Stringa.objects.filter(stringa='S1 2018010112000010').count(), 1)
+
+    def test_stringa_save(self):
+        with self.assertRaises(StringaDuplicata):
+            Stringa.objects.create(stringa='S1 2018010112000010')
+        Stringa.objects.create(stringa='S1 ~ 1 20180101120000 0:10 60:11')
+        self.assertEqual(sorted(Rilevazione.objects.filter(sensore='S1').values_list('valore', flat=True)), [10, 11])
+
+
+class EliminaRilevazioneTest(ApiTestCase):
+
+    def test_aggiorna_ultima_rilevazione_e_aggregati(self):
+        salva_stringhe(['S2 2019010112000010', 'S2 2019010112010020', 'S2 2019010112020030'])
+        self.cliente.impianto_attivo = self.impianto
+        self.cliente.save()
+        self.client.force_login(self.cliente)
+        ultima = Rilevazione.objects.get(sensore='S2', valore=30)
+        self.assertEqual(self.client.get('/rilevazioni/elimina/', {'id': ultima.id}).status_code, 302)
+        self.assertEqual(self.sensori[2].get_last_rilevazione().valore, 20)
+        giorno = AggregatoRilevazioni.objects.get(sensore='S2', scala=AggregatoRilevazioni.SCALA_GIORNO)
+        self.assertEqual((giorno.conteggio, giorno.massimo, giorno.somma, giorno.ultimo_valore), (2, 20, 30, 20))
+        self.assertEqual(AggregatoRilevazioni.objects.filter(sensore='S2', scala=AggregatoRilevazioni.SCALA_MINUTO)
+                         .count(), 2)
+
+
+class CampionamentoTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        salva_stringhe(['S3 2020010112%02d00%d' % (minuto, minuto) for minuto in range(30)])
+
+    def test_points_usa_i_bucket_per_default(self):
+        risposta = self.client_di(self.staff).get('/api/rilevazioni/', {'id_sensore': 'S3', 'points': 3})
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(sum(bucket['conteggio'] for bucket in risposta.data), 30)
+        self.assertIn('minimo', risposta.data[0])
+
+    def test_lttb_richiede_un_intervallo_limitato(self):
+        client = self.client_di(self.staff)
+        parametri = {'id_sensore': 'S3', 'points': 5, 'metodo': 'lttb'}
+        self.assertEqual(client.get('/api/rilevazioni/', parametri).status_code, 400)
+        parametri.update({'from': '2020-01-01', 'to': '2020-03-01'})
+        self.assertEqual(client.get('/api/rilevazioni/', parametri).status_code, 400)
+        parametri['to'] = '2020-01-02'
+        risposta = client.get('/api/rilevazioni/', parametri)
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual([punto['valore'] for punto in risposta.data][::4], [0, 29])
+
+
+class SerieSensoriTest(ApiTestCase):
+    """Sensori con la stessa data_creazione: le righe vanno raggruppate per sensore e non per la sua ordering."""
+
+    def setUp(self):
+        super().setUp()
+        Sensore.objects.filter(id__in=['S3', 'S4']).update(data_creazione=timezone.now())
+        salva_stringhe(['S%d 2021010112%02d00%d' % (3 + minuto % 2, minuto, minuto) for minuto in range(6)])
+
+    def test_leggi_serie_sensori(self):
+        serie = leggi_serie_sensori(['S3', 'S4'])
+        self.assertEqual((list(serie['S3']['valore']), list(serie['S4']['valore'])), ([0, 2, 4], [1, 3, 5]))
+
+    def test_bucket_sensori(self):
+        inizio = int(datetime(2021, 1, 1, 12, tzinfo=timezone.utc).timestamp())
+        bucket = bucket_sensori(['S3', 'S4'], inizio, inizio + 3600, 60)
+        self.assertEqual(list(bucket['S3']['inizio']), [inizio, inizio + 120, inizio + 240])
+        self.assertEqual(list(bucket['S4']['inizio']), [inizio + 60, inizio + 180, inizio + 300])
+
+
+    @override_settings(SERIE_MAX_SENSORI=2)
+    def test_limiti_serie_ed_export(self):
+        client = self.client_di(self.staff)
+        parametri = {'id_sensore': 'S3,S4', 'from': '2021-01-01', 'to': '2021-01-02'}
+        self.assertEqual(client.get('/api/rilevazioni/serie/', parametri).status_code, 400)
+        risposta = client.get('/api/rilevazioni/serie/', dict(parametri, bucket=60))
+        self.assertEqual([len(serie['rilevazioni']) for serie in risposta.data], [3, 3])
+        risposta = client.get('/api/rilevazioni/export/', parametri)
+        self.assertEqual(risposta['Content-Disposition'], 'attachment; filename="rilevazioni_sensori_2.csv"')
+        for url in ('/api/rilevazioni/serie/', '/api/rilevazioni/export/'):
+            risposta = client.get(url, dict(parametri, id_sensore='S2,S3,S4', bucket=60))
+            self.assertEqual(risposta.status_code, 400)
+
+
+class StatisticheEccezioniTest(ApiTestCase):
+
+    def test_eccezioni_null_prima_dei_contatori(self):
+        salva_stringhe(['S3 2021010112000010'])
+        self.assertEqual(InizioContatoriEccezioni.corrente(), timezone.now().date())
+        client = self.client_di(self.staff)
+        parametri = {'id_sensore': 'S3', 'from': '2021-01-01', 'to': '2021-01-02'}
+        risposta = client.get('/api/rilevazioni/statistiche/', parametri)
+        self.assertEqual((risposta.data['sensori'][0]['eccezioni'], risposta.data['totale']['eccezioni']),
+                         (None, None))
+        InizioContatoriEccezioni.objects.update(giorno=date(2020, 12, 31))
+        ContatoreEccezioni.objects.create(sensore_id='S3', giorno=date(2021, 1, 1), conteggio=2)
+        risposta = client.get('/api/rilevazioni/statistiche/', parametri)
+        self.assertEqual((risposta.data['sensori'][0]['eccezioni'], risposta.data['totale']['eccezioni']), (2, 2))
+
+
+class UltimoContattoTest(ApiTestCase):
+    """Le modifiche a sensori e installazioni non riportano indietro l'ultimo contatto scritto dall'ingest."""
+
+    def setUp(self):
+        super().setUp()
+        self.contatto = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        self.installazione = Installazione.objects.get(sensore='S1')
+        Sensore.objects.filter(id='S1').update(ultimo_contatto=self.contatto)
+        Installazione.objects.filter(sensore='S1').update(ultimo_contatto=self.contatto)
+        self.staff.impianto_attivo = self.impianto
+        self.staff.save()
+        self.client.force_login(self.staff)
+
+    def ultimi_contatti(self):
+        return (Sensore.objects.get(id='S1').ultimo_contatto, Installazione.objects.get(sensore='S1').ultimo_contatto)
+
+    def test_save_con_istanze_lette_prima(self):
+        self.sensori[1].codice_errore = '998'
+        self.sensori[1].save()
+        self.installazione.data_fine = timezone.now()
+        self.installazione.save()
+        self.assertEqual(self.ultimi_contatti(), (self.contatto, self.contatto))
+
+    def test_modifica_ed_elimina_sensore(self):
+        risposta = self.client.post('/sensori/modifica/?id_sensore=S1',
+                                    {'tipo': self.tipo.id, 'marca': self.marca.id, 'codice_errore': '998'})
+        self.assertEqual(risposta.status_code, 302)
+        self.assertEqual(self.client.get('/sensori/elimina/', {'id': 'S1'}).status_code, 302)
+        self.assertEqual(Sensore.objects.get(id='S1').codice_errore, '998')
+        self.assertIsNotNone(Installazione.objects.get(sensore='S1').data_fine)
+        self.assertEqual(self.ultimi_contatti(), (self.contatto, self.contatto))
+
+    def test_scrittura_fallita_non_registrata(self):
+        adesso = datetime(2031, 1, 1, tzinfo=timezone.utc)
+        with mock.patch.dict(ultimo_contatto._scritti, clear=True):
+            with mock.patch.object(QuerySet, 'update', side_effect=DatabaseError):
+                with self.assertRaises(DatabaseError):
+                    ultimo_contatto.registra_contatto(['S1'], adesso)
+            self.assertNotIn('S1', ultimo_contatto._scritti)
+            ultimo_contatto.registra_contatto(['S1'], adesso)
+            self.assertEqual(self.ultimi_contatti(), (adesso, adesso))
+
+
+class ContatoriSensoriTest(ApiTestCase):
+
+    def test_modifica_impianto_non_riscrive_num_sensori(self):
+        impianto = Impianto.objects.get(id=self.impianto.id)
+        Sensore.objects.create(id='S5', tipo=self.tipo, marca=self.marca, codice_errore='999') \
+            .set_installazione(self.impianto)
+        impianto.city = 'altra'
+        impianto.save()
+        self.client.force_login(self.staff)
+        risposta = self.client.post('/impianti/modifica/?id=%d' % self.impianto.id,
+                                    {'name': 'nuovo', 'city': 'c', 'address': '', 'user': self.cliente.id})
+        self.assertEqual(risposta.status_code, 302)
+        self.assertEqual(Impianto.objects.filter(id=self.impianto.id).values_list('name', 'num_sensori')[0],
+                         ('nuovo', 6))
+
+    def test_eliminazioni_senza_ricalcoli_per_installazione(self):
+        sensore = Sensore.objects.get(id='S0')
+        Installazione.objects.filter(sensore=sensore).update(data_fine=timezone.now())
+        for _ in range(3):
+            sensore.set_installazione(self.impianto)
+            Installazione.objects.filter(sensore=sensore).update(data_fine=timezone.now())
+        sensore.set_installazione(self.impianto)
+        with mock.patch('GestioneSensori.contatori_sensori.ricalcola_contatori') as ricalcola:
+            sensore.delete()
+            self.assertEqual(ricalcola.call_count, 1)
+            Impianto.objects.get(id=self.impianto.id).delete()
+            self.assertEqual(ricalcola.call_count, 1)
+        self.assertFalse(Installazione.objects.exists())
+
+
+class CheckpointAllarmiTest(ApiTestCase):
+    """Due processi che valutano lo stesso sensore: il checkpoint tiene lo stato più recente."""
+
+    def setUp(self):
+        super().setUp()
+        self.regola = RegolaAllarme.objects.create(genere=RegolaAllarme.SOGLIA, tipo=self.tipo, massimo=50)
+
+    def valuta(self, motore, ora, valore):
+        _, nuovi = motore.valuta([('S0', self.tipo.id, datetime(2022, 1, 1, ora, tzinfo=timezone.utc), valore)])
+        motore.applica(nuovi)
+
+    def test_checkpoint_non_torna_indietro(self):
+        primo, secondo = (MotoreAllarmi(carica_regole, carica_stati, 60) for _ in range(2))
+        self.valuta(primo, 10, 60)
+        self.valuta(secondo, 12, 20)
+        secondo.checkpoint()
+        primo.checkpoint()
+        stato = StatoRegola.objects.get(regola=self.regola, sensore='S0')
+        self.assertEqual((stato.valore, stato.in_allarme), (20, False))
+        self.valuta(primo, 11, 70)
+        self.assertEqual(primo.stati[(self.regola.id, 'S0')].valore, 20)
+
+
+class CatalogoCondizionaleTest(ApiTestCase):
+
+    def test_304_con_etag_e_last_modified(self):
+        client = self.client_di(self.staff)
+        risposta = client.get('/api/sensori/')
+        self.assertEqual(risposta.status_code, 200)
+        self.assertEqual(client.get('/api/sensori/', HTTP_IF_NONE_MATCH=risposta['ETag']).status_code, 304)
+        self.assertEqual(client.get('/api/sensori/', HTTP_IF_MODIFIED_SINCE=risposta['Last-Modified']).status_code,
+                         304)
+
+    def test_modifiche_nello_stesso_secondo_cambiano_last_modified(self):
+        client = self.client_di(self.staff)
+        date = []
+        for codice_errore in ('998', '997'):
+            prima = client.get('/api/sensori/')
+            self.sensori[0].codice_errore = codice_errore
+            self.sensori[0].save()
+            dopo = client.get('/api/sensori/', HTTP_IF_MODIFIED_SINCE=prima['Last-Modified'])
+            self.assertEqual(dopo.status_code, 200)
+            self.assertNotEqual(dopo['Last-Modified'], prima['Last-Modified'])
+            date.append(dopo['Last-Modified'])
+        self.assertNotEqual(date[0], date[1])
+
+
+class QueryApiLetturaTest(ApiTestCase):
+    """Query per richiesta delle API di lettura: costanti, qualunque sia il numero di sensori e rilevazioni."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # bulk_create: senza il post_save che tradurrebbe la stringa
+        Stringa.objects.bulk_create([Stringa(stringa='S0 2017010112000010')])
+        stringa = Stringa.objects.get()
+        rilevazioni = [
+            Rilevazione(stringa=stringa, sensore=sensore, dataora=datetime(2017, 1, 1, 12, i, tzinfo=timezone.utc),
+                        valore=i, messaggio='')
+            for sensore in cls.sensori for i in range(3)
+        ]
+        Rilevazione.objects.bulk_create(rilevazioni)
+        cls.id_rilevazione = Rilevazione.objects.latest('id').id
+        UltimaRilevazione.objects.bulk_create([
+            UltimaRilevazione(sensore=sensore, dataora=datetime(2017, 1, 1, 12, 2, tzinfo=timezone.utc), valore=2)
+            for sensore in cls.sensori
+        ])
+
+    def assert_query(self, utente, url, fredda, calda):
+        # fredda: cache dei sensori vuota; calda: cache dei sensori piena, ma non quella dei corpi del catalogo
+        client = self.client_di(utente)
+        with self.assertNumQueries(fredda):
+            risposta = client.get(url)
+        self.assertEqual(risposta.status_code, 200)
+        cache.clear()
+        with self.assertNumQueries(calda):
+            self.assertEqual(client.get(url).data, risposta.data)
+        return risposta.data
+
+    def test_sensori_api(self):
+        for utente in (self.staff, self.cliente):
+            with self.subTest(utente=utente.username):
+                self.assertEqual(len(self.assert_query(utente, '/api/sensori/', 4, 2)), 5)
+                cache_sensori.svuota()
+                self.assertEqual(len(self.assert_query(utente, '/api/sensori/?page_size=2', 4, 2)['results']), 2)
+                cache_sensori.svuota()
+                sensori = self.assert_query(utente, '/api/sensori/?ultima_rilevazione=1', 4, 2)
+                self.assertEqual([sensore['ultima_rilevazione']['valore'] for sensore in sensori], [2] * 5)
+                cache_sensori.svuota()
+
+    def test_show_sensore_api(self):
+        self.assertEqual(self.assert_query(self.staff, '/api/sensori/show/?id_sensore=S1', 3, 1)['id_sensore'], 'S1')
+        cache_sensori.svuota()
+        sensore = self.assert_query(self.staff, '/api/sensori/show/?id_sensore=S1&ultima_rilevazione=1', 3, 1)
+        self.assertEqual(sensore['ultima_rilevazione']['valore'], 2)
+
+    def test_rilevazioni_api(self):
+        self.assertEqual(len(self.assert_query(self.staff, '/api/rilevazioni/?id_sensore=S1', 3, 1)), 3)
+
+    def test_show_rilevazione_api(self):
+        rilevazione = self.assert_query(self.staff, '/api/rilevazioni/show/?id=%d' % self.id_rilevazione, 1, 1)
+        self.assertEqual(rilevazione['id_sensore'], 'S4')
+
+    def test_sensore_installato_due_volte_compare_una_volta(self):
+        # S0 spostato in un secondo impianto dello stesso utente: due installazioni nei suoi impianti
+        secondo = Impianto.objects.create(name='secondo', city='c', user=self.cliente)
+        Installazione.objects.filter(sensore='S0').update(data_fine=timezone.now())
+        Installazione.objects.create(impianto=secondo, sensore=self.sensori[0], data_inizio=timezone.now())
+        altro = Utente.objects.create(username='altro', data_nascita=date(1990, 1, 1), azienda=self.cliente.azienda)
+        Sensore.objects.create(id='X1', tipo=self.tipo, marca=self.marca, codice_errore='999') \
+            .set_installazione(Impianto.objects.create(name='altro', city='c', user=altro))
+        sensori = self.client_di(self.cliente).get('/api/sensori/').data
+        self.assertEqual(sorted(sensore['id_sensore'] for sensore in sensori), ['S0', 'S1', 'S2', 'S3', 'S4'])
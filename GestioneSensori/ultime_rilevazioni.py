@@ -0,0 +1,89 @@
+from django.db import connection, transaction
+from django.db.models import Max
+from django.dispatch import receiver
+
+from GestioneSensori.models import Eccezione, Rilevazione, UltimaRilevazione
+from GestioneSensori.signals import rilevazioni_salvate
+
+COLONNE = ('sensore', 'dataora', 'valore', 'messaggio', 'eccezione', 'messaggio_eccezione')
+
+# La rilevazione avanza solo con una dataora più recente, l'eccezione solo con un id maggiore.
+# Su MySQL le assegnazioni sono valutate da sinistra a destra: dataora ed eccezione vanno aggiornate per ultime.
+UPSERT = {
+    'mysql': (
+        'ON DUPLICATE KEY UPDATE '
+        '`valore` = IF(`dataora` IS NULL OR VALUES(`dataora`) > `dataora`, VALUES(`valore`), `valore`), '
+        '`messaggio` = IF(`dataora` IS NULL OR VALUES(`dataora`) > `dataora`, VALUES(`messaggio`), `messaggio`), '
+        '`dataora` = IF(`dataora` IS NULL OR VALUES(`dataora`) > `dataora`, VALUES(`dataora`), `dataora`), '
+        '`messaggio_eccezione` = IF(VALUES(`eccezione`) > COALESCE(`eccezione`, 0), '
+        'VALUES(`messaggio_eccezione`), `messaggio_eccezione`), '
+        '`eccezione` = IF(VALUES(`eccezione`) > COALESCE(`eccezione`, 0), VALUES(`eccezione`), `eccezione`);'
+    ),
+    'sqlite': (
+        'ON CONFLICT (`sensore`) DO UPDATE SET '
+        '`valore` = CASE WHEN `dataora` IS NULL OR excluded.`dataora` > `dataora` '
+        'THEN excluded.`valore` ELSE `valore` END, '
+        '`messaggio` = CASE WHEN `dataora` IS NULL OR excluded.`dataora` > `dataora` '
+        'THEN excluded.`messaggio` ELSE `messaggio` END, '
+        '`dataora` = CASE WHEN `dataora` IS NULL OR excluded.`dataora` > `dataora` '
+        'THEN excluded.`dataora` ELSE `dataora` END, '
+        '`messaggio_eccezione` = CASE WHEN excluded.`eccezione` > COALESCE(`eccezione`, 0) '
+        'THEN excluded.`messaggio_eccezione` ELSE `messaggio_eccezione` END, '
+        '`eccezione` = CASE WHEN excluded.`eccezione` > COALESCE(`eccezione`, 0) '
+        'THEN excluded.`eccezione` ELSE `eccezione` END;'
+    ),
+}
+
+
+def aggiorna_ultime(letture, eccezioni):
+    """
+    Aggiorna l'ultima rilevazione di ogni sensore da letture (id_sensore, dataora, valore, messaggio)
+    ed eccezioni (id_sensore, id_eccezione, messaggio).
+    """
+    ultime = {}
+    for id_sensore, dataora, valore, messaggio in letture:
+        ultima = ultime.setdefault(id_sensore, [None, None, None, None, None])
+        if ultima[0] is None or dataora > ultima[0]:
+            ultima[0:3] = [dataora, valore, messaggio]
+    for id_sensore, id_eccezione, messaggio in eccezioni:
+        ultima = ultime.setdefault(id_sensore, [None, None, None, None, None])
+        if id_eccezione is not None and (ultima[3] is None or id_eccezione > ultima[3]):
+            ultima[3:5] = [id_eccezione, messaggio]
+    if not ultime:
+        return
+    adatta = connection.ops.adapt_datetimefield_value
+    righe = [
+        (id_sensore, adatta(ultima[0]), ultima[1], ultima[2], ultima[3], ultima[4])
+        for id_sensore, ultima in sorted(ultime.items())
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO `%s` (%s) VALUES %s %s' % (
+                UltimaRilevazione._meta.db_table,
+                ', '.join('`%s`' % colonna for colonna in COLONNE),
+                ', '.join(['(%s)' % ', '.join(['%s'] * len(COLONNE))] * len(righe)),
+                UPSERT[connection.vendor],
+            ),
+            [valore for riga in righe for valore in riga]
+        )
+
+
+@receiver(rilevazioni_salvate)
+def aggiorna_ultime_ingest(sender, rilevazioni=(), eccezioni=(), **kwargs):
+    aggiorna_ultime(
+        [(ril.sensore_id, ril.dataora, ril.valore, ril.messaggio) for ril in rilevazioni],
+        [(ecc.sensore_id, ecc.id, ecc.messaggio) for ecc in eccezioni],
+    )
+
+
+def ricostruisci_ultime(id_sensore):
+    """Ricalcola dalle tabelle grezze l'ultima rilevazione e l'ultima eccezione di un sensore."""
+    with transaction.atomic():
+        UltimaRilevazione.objects.filter(sensore=id_sensore).delete()
+        ultima = Rilevazione.objects.filter(sensore=id_sensore).order_by('-dataora', '-id') \
+            .values_list('sensore', 'dataora', 'valore', 'messaggio').first()
+        id_eccezione = Eccezione.objects.filter(sensore=id_sensore).aggregate(ultima=Max('id'))['ultima']
+        eccezioni = []
+        if id_eccezione is not None:
+            eccezioni.append((id_sensore, id_eccezione, Eccezione.objects.get(id=id_eccezione).messaggio))
+        aggiorna_ultime([ultima] if ultima else [], eccezioni)
@@ -0,0 +1,62 @@
+from datetime import timedelta
+from threading import Lock
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from GestioneSensori.models import Sensore, Installazione
+from GestioneSensori.signals import rilevazioni_salvate
+
+_scritti = {}
+_lock = Lock()
+
+
+def registra_contatto(sensori, adesso=None):
+    """
+    Porta ultimo_contatto dei sensori e delle loro installazioni attuali ad adesso. Le scritture sono
+    monotone (solo se il valore salvato è più vecchio) e al più una ogni ULTIMO_CONTATTO_GRANULARITA
+    secondi per sensore in ogni processo: l'ultimo contatto può essere indietro di tanto.
+    """
+    adesso = adesso or timezone.now()
+    soglia = adesso - timedelta(seconds=settings.ULTIMO_CONTATTO_GRANULARITA)
+    with _lock:
+        da_scrivere = [id_sensore for id_sensore in sensori if _scritti.get(id_sensore, soglia) <= soglia]
+    if not da_scrivere:
+        return
+    # update() non invia segnali: l'ultimo contatto non cambia la versione del catalogo dei sensori
+    precedente = Q(ultimo_contatto__isnull=True) | Q(ultimo_contatto__lt=adesso)
+    with transaction.atomic():
+        Sensore.objects.filter(precedente, id__in=da_scrivere).update(ultimo_contatto=adesso)
+        Installazione.objects.filter(precedente, sensore__in=da_scrivere, data_fine__isnull=True) \
+            .update(ultimo_contatto=adesso)
+    # Solo dopo la scrittura: se fallisce, la prossima stringa del sensore riprova
+    with _lock:
+        for id_sensore in da_scrivere:
+            if _scritti.get(id_sensore, soglia) < adesso:
+                _scritti[id_sensore] = adesso
+
+
+@receiver(rilevazioni_salvate)
+def registra_contatto_ingest(sender, rilevazioni=(), eccezioni=(), **kwargs):
+    sensori = {ril.sensore_id for ril in rilevazioni} | {ecc.sensore_id for ecc in eccezioni}
+    if sensori:
+        # Dopo il commit: le righe dei sensori non restano bloccate per tutta la transazione di ingest
+        transaction.on_commit(lambda: registra_contatto(sensori))
+
+
+def sensori_silenziosi(ore, impianti=None):
+    """
+    Le installazioni attuali (di tutti gli impianti o di quelli indicati) il cui sensore non invia stringhe
+    da almeno ore, con una query sull'indice (impianto, ultimo_contatto) delle installazioni.
+    """
+    limite = timezone.now() - timedelta(hours=ore)
+    installazioni = Installazione.objects.filter(
+        Q(ultimo_contatto__lt=limite) | Q(ultimo_contatto__isnull=True), data_fine__isnull=True
+    )
+    if impianti is not None:
+        installazioni = installazioni.filter(impianto__in=impianti)
+    return installazioni.order_by('impianto_id', 'ultimo_contatto', 'sensore_id') \
+        .values('impianto', 'impianto__name', 'sensore', 'ultimo_contatto')
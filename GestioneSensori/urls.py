@@ -64,9 +64,17 @@ urlpatterns = [
     url(r'^get_auth_token/$', views_api.obtain_auth_token, name='get_auth_token'),
     # Url API Sensori
     url(r'^api/sensori/$', api_views.sensori_api, name='api_sensori'),
+    url(r'^api/sensori/silenziosi/$', api_views.sensori_silenziosi_api, name='api_sensori_silenziosi'),
     url(r'^api/sensori/show/$', api_views.show_sensore_api, name='api_show_sensore'),
     # Url API Rilevazioni
     url(r'^api/rilevazioni/$', api_views.rilevazioni_api, name='api_rilevazioni'),
     url(r'^api/rilevazioni/show/$', api_views.show_rilevazione_api, name='api_show_rilevazione'),
     url(r'^api/rilevazioni/add/$', api_views.add_rilevazione_api, name='api_add_rilevazione'),
+    url(r'^api/rilevazioni/add/batch/$', api_views.add_rilevazioni_batch_api, name='api_add_rilevazioni_batch'),
+    url(r'^api/rilevazioni/add/stream/$', api_views.add_rilevazioni_stream_api, name='api_add_rilevazioni_stream'),
+    url(r'^api/rilevazioni/export/$', api_views.export_rilevazioni_api, name='api_export_rilevazioni'),
+    url(r'^api/rilevazioni/serie/$', api_views.serie_rilevazioni_api, name='api_serie_rilevazioni'),
+    url(r'^api/rilevazioni/statistiche/$', api_views.statistiche_rilevazioni_api, name='api_statistiche_rilevazioni'),
+    # Url API Metriche
+    url(r'^api/metriche/$', api_views.metriche_api, name='api_metriche'),
 ]
@@ -4,17 +4,20 @@ from urllib.parse import urlencode
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.db.models import Count, ProtectedError
+from django.db import transaction
+from django.db.models import ProtectedError
 from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
 from django.utils import timezone
 
+from GestioneSensori.aggregati import ricostruisci_aggregati
 from GestioneSensori.decorators import impianto_attivo_required, staff_required
 from GestioneSensori.forms import ImpiantoForm, SensoreForm, UtenteForm, SensoreEditForm, UtenteEditForm, \
     SpostaSensoreForm, TipoSensoreForm, MarcaSensoreForm
 from GestioneSensori.models import Impianto, Utente, Sensore, Rilevazione, Installazione, TipoSensore, \
-    Eccezione, MarcaSensore
+    MarcaSensore
+from GestioneSensori.ultime_rilevazioni import ricostruisci_ultime
 
 
 def get_data(req, type_req):
@@ -134,7 +137,7 @@ def elimina_sensore(request):
         datetime.now(),
         timezone.get_current_timezone()
     )
-    installazione.save()
+    installazione.save(update_fields=['data_fine'])
     return HttpResponseRedirect(reverse('sensori'))
 
 
@@ -197,7 +200,7 @@ def sposta_sensore(request):
                     datetime.now(),
                     timezone.get_current_timezone()
                 )
-                installazione.save()
+                installazione.save(update_fields=['data_fine'])
                 Installazione.objects.create(
                     impianto=Impianto.objects.get(id=imp_post),
                     sensore=sensore,
@@ -232,7 +235,7 @@ def ripristina_sensore(request):
     sensore = get_object_or_404(Sensore, id=get_data(request, 'GET')['id_sensore'])
     ultima_installazione = Installazione.objects.filter(sensore=sensore.id).last()
     ultima_installazione.data_fine = None
-    ultima_installazione.save()
+    ultima_installazione.save(update_fields=['data_fine'])
     return HttpResponseRedirect(reverse('sensori'))
 
 
@@ -309,7 +312,11 @@ def elimina_rilevazione(request):
     imp_sensore = sensore.impianto.get(installazione__data_fine__isnull=True)
     if request.user.impianto_attivo_id != imp_sensore.id:
         raise PermissionDenied('Non puoi operare su sensori che non sono presenti nell\'impianto attivo scelto.')
-    ril.delete()
+    with transaction.atomic():
+        ril.delete()
+        # Ultima rilevazione e aggregati vengono aggiornati solo all'ingest: si ricalcolano quelli toccati
+        ricostruisci_ultime(sensore.id)
+        ricostruisci_aggregati(sensore.id, ril.dataora, ril.dataora)
     return super_redirect('rilevazioni', id_sensore=str(sensore.id))
 
 
@@ -404,13 +411,8 @@ def modifica_utente(request):
 @login_required
 @impianto_attivo_required
 def dashboard(request):
-    eccezioni = Eccezione.objects.filter(
-        sensore__impianto=request.user.impianto_attivo_id).order_by('-id').distinct()
-    list_id_ecc = [ril.id for ril in eccezioni]
-    andamento_eccezioni = Eccezione.objects.all().filter(id__in=list_id_ecc) \
-        .values('sensore').annotate(num=Count('id'))
-
+    impianto = request.user.impianto_attivo
     return render(request, 'dashboard.html', {
-        'ril_ecc': eccezioni[:10],
-        'ril_and': andamento_eccezioni
+        'ril_ecc': impianto.get_eccezioni_recenti(10),
+        'ril_and': impianto.get_eccezioni_per_sensore()
     })